@@ -1,21 +1,56 @@
+import abc
 import asyncio
+import bisect
+import collections
+import contextlib
+import hashlib
+import heapq
+import itertools
+import argparse
 import unicodedata, re
 import os
-import io
+import sys
 import json
 import logging
-from datetime import datetime
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import math
+import queue
+import shutil
+import signal
+import socket
+import sqlite3
+import tempfile
+import uuid
+import contextvars
+import gzip
+import threading
+import time
+import traceback
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile
+from telegram.error import RetryAfter
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
+    TypeHandler,
+    ApplicationHandlerStop,
     ContextTypes,
     filters,
 )
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseDownload
+from google_auth_httplib2 import AuthorizedHttp, Request as GoogleAuthRequest
+import httplib2
+import numpy as np
+import openpyxl
+import pandas as pd
 from pytz import timezone
 
 # Zona horaria de Lima (UTC-5)
@@ -25,11 +60,87 @@ LIMA_TZ = timezone("America/Lima")
 BOT_TOKEN = os.getenv("BOT_TOKEN") # Token del bot
 NOMBRE_CARPETA_DRIVE = "ASISTENCIA_BOT"  # Carpeta principal
 DRIVE_ID = "0AOy_EhsaSY_HUk9PVA"  # ID de la unidad compartida
-ALLOWED_CHATS = [-1002640857147, -4718591093, -4831456255, -1002814603547, -1002838776671, -4951443286, -4870196969, -4824829490, -4979512409, -4903731585, -4910534813, -4845865029, -4643755320, -4860386920]  # Reemplaza con los IDs de tus grupos
+# Lista por defecto; se reemplaza por el contenido de CHATS_PERMITIDOS_FILE si existe
+ALLOWED_CHATS = {-1002640857147, -4718591093, -4831456255, -1002814603547, -1002838776671, -4951443286, -4870196969, -4824829490, -4979512409, -4903731585, -4910534813, -4845865029, -4643755320, -4860386920}  # Reemplaza con los IDs de tus grupos
+
+# Archivo JSON con los chats permitidos: [-100..., -4...] o {"chats": [...]}.
+# Se recarga en caliente (sin reiniciar) cuando cambia su fecha de modificación.
+CHATS_PERMITIDOS_FILE = os.getenv("CHATS_PERMITIDOS_FILE", "chats_permitidos.json")
+CHATS_RECARGA_SEG = float(os.getenv("CHATS_RECARGA_SEG", "30"))  # cada cuánto mirar el archivo
+
+_chats_mtime = None
+_chats_revisado = 0.0
+
+def recargar_chats_permitidos(forzar: bool = False):
+    """
+    Relee CHATS_PERMITIDOS_FILE si cambió. Como mucho un stat() cada CHATS_RECARGA_SEG.
+    Si el archivo no existe o está mal formado se conserva la lista anterior.
+    """
+    global ALLOWED_CHATS, _chats_mtime, _chats_revisado
+    ahora = time.monotonic()
+    if not forzar and ahora - _chats_revisado < CHATS_RECARGA_SEG:
+        return
+    _chats_revisado = ahora
+
+    try:
+        mtime = os.stat(CHATS_PERMITIDOS_FILE).st_mtime
+    except OSError:
+        return
+    if mtime == _chats_mtime:
+        return
+
+    try:
+        with open(CHATS_PERMITIDOS_FILE, encoding="utf-8") as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            data = data.get("chats", [])
+        nuevos = {int(c) for c in data}
+    except (OSError, ValueError, TypeError) as e:
+        logger.error(f"[ERROR] No se pudo leer {CHATS_PERMITIDOS_FILE}: {e}")
+        return
+
+    _chats_mtime = mtime
+    ALLOWED_CHATS = nuevos
+    logger.info(f"[DEBUG] Chats permitidos recargados: {len(nuevos)} chats")
+
+# Usuarios con acceso a comandos de supervisión (/resumen, ...), p.ej. "123,456"
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
+
+# Comandos de supervisión que un admin puede usar por privado (el resto del flujo, no)
+COMANDOS_ADMIN = {"resumen", "exportar"}
+
+def es_admin(update: Update) -> bool:
+    user = update.effective_user
+    return user is not None and user.id in ADMIN_IDS
+
+def es_comando_admin(update: Update) -> bool:
+    """True si el mensaje es /resumen, /exportar... (con o sin @bot)."""
+    texto = (update.message.text or "") if update.message else ""
+    if not texto.startswith("/"):
+        return False
+    return texto[1:].split(maxsplit=1)[0].split("@", 1)[0].lower() in COMANDOS_ADMIN
 
 def chat_permitido(chat_id: int) -> bool:
     """Verifica si el chat está permitido"""
-    return chat_id in ALLOWED_CHATS
+    recargar_chats_permitidos()
+    return chat_id in ALLOWED_CHATS or chat_id in INQUILINO_POR_CHAT
+
+def update_permitido(update: Update) -> bool:
+    """True si el update viene de un chat permitido o es un comando de supervisor por privado."""
+    chat = update.effective_chat
+    if chat is not None and chat.type == "private" and es_admin(update) and es_comando_admin(update):
+        return True  # los supervisores pueden usar sus comandos por privado
+    return chat is not None and chat_permitido(chat.id)
+
+async def filtrar_chats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Primer grupo de handlers: descarta cualquier update de un chat no permitido
+    antes de que llegue a los demás handlers (comandos, fotos, callbacks).
+    PlanificadorUpdates ya los descarta antes de asignarles carril; esto cubre
+    lo que entre por otro camino.
+    """
+    if not update_permitido(update):
+        raise ApplicationHandlerStop
 
 # -------------------- MENSAJE ES PARA BOT --------------------
 
@@ -92,37 +203,103 @@ SCOPES = [
     "https://www.googleapis.com/auth/spreadsheets",
 ]
 
-def get_services():
-    creds_info = json.loads(CREDENTIALS_JSON)
+GOOGLE_POOL_SIZE = int(os.getenv("GOOGLE_POOL_SIZE", "8"))           # conexiones keep-alive máximas
+GOOGLE_TIMEOUT_SEG = float(os.getenv("GOOGLE_TIMEOUT_SEG", "30"))      # timeout de socket por llamada
+GOOGLE_RENOVAR_ANTES_SEG = int(os.getenv("GOOGLE_RENOVAR_ANTES_SEG", "300"))  # renovar token 5 min antes
+
+class PoolHttp:
+    """
+    Pool acotado y thread-safe de conexiones httplib2 keep-alive.
+    httplib2.Http no es seguro entre hilos: cada request toma una instancia libre
+    (o crea una si no hay y no se llegó al máximo) y la devuelve al terminar.
+    Así los hilos del executor no comparten socket y reutilizan el TLS ya negociado.
+    """
+
+    follow_redirects = True
+    redirect_codes = frozenset((300, 301, 302, 303, 307, 308))
+
+    def __init__(self, tamano: int, timeout: float, cuota=None):
+        self.timeout = timeout
+        self.cuota = cuota  # CuotaGoogle del inquilino (None = sin límite de ritmo)
+        self.connections = {}  # lo pide AuthorizedHttp; las conexiones reales viven en cada Http
+        self._libres = queue.LifoQueue()  # LIFO: reusa la conexión usada más recientemente
+        self._cupos = threading.BoundedSemaphore(tamano)
+
+    def request(self, uri, method="GET", body=None, headers=None,
+                redirections=httplib2.DEFAULT_MAX_REDIRECTS, connection_type=None):
+        if self.cuota is not None:
+            self.cuota.esperar()
+        self._cupos.acquire()
+        try:
+            http = self._libres.get_nowait()
+        except queue.Empty:
+            http = httplib2.Http(timeout=self.timeout)
+        try:
+            return http.request(
+                uri, method=method, body=body, headers=headers,
+                redirections=redirections, connection_type=connection_type,
+            )
+        except Exception:
+            http.close()  # socket posiblemente roto: se reabre en el próximo uso
+            raise
+        finally:
+            self._libres.put(http)
+            self._cupos.release()
+
+    def close(self):
+        while True:
+            try:
+                self._libres.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class HttpAutorizado(AuthorizedHttp):
+    """
+    AuthorizedHttp compartido por Drive y Sheets. Renueva el token antes de que
+    venza y bajo un lock, para que varios hilos no lo refresquen a la vez.
+    """
+
+    def __init__(self, credentials, http=None):
+        super().__init__(credentials, http=http)
+        self._lock_token = threading.Lock()  # uno por credencial (inquilino)
+
+    def _renovar_si_vence(self):
+        creds = self.credentials
+        limite = datetime.utcnow() + timedelta(seconds=GOOGLE_RENOVAR_ANTES_SEG)
+        if creds.token and creds.expiry and creds.expiry > limite:
+            return
+        with self._lock_token:
+            if creds.token and creds.expiry and creds.expiry > limite:
+                return  # otro hilo ya lo renovó
+            creds.refresh(GoogleAuthRequest(self.http))
+            logger.info(f"[DEBUG] Token de Google renovado (vence {creds.expiry})")
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        self._renovar_si_vence()
+        return super().request(uri, method, body, headers, **kwargs)
+
+
+def get_services(credentials_json: str = CREDENTIALS_JSON, pool: int = GOOGLE_POOL_SIZE, cuota=None):
+    creds_info = json.loads(credentials_json)
     creds = service_account.Credentials.from_service_account_info(
         creds_info, scopes=SCOPES
     )
-    drive = build("drive", "v3", credentials=creds)
-    sheets = build("sheets", "v4", credentials=creds)
+    http = HttpAutorizado(creds, http=PoolHttp(pool, GOOGLE_TIMEOUT_SEG, cuota))
+    drive = build("drive", "v3", http=http, cache_discovery=False)
+    sheets = build("sheets", "v4", http=http, cache_discovery=False)
     return drive, sheets
 
 # --- Google Sheets helpers ---
 
 # --- Helpers de Google Sheets (colócalos junto a tus otras funciones de Sheets) ---
 
-def set_cell_value(spreadsheet_id: str, sheet_title: str, a1: str, value):
-    """
-    Escribe un solo valor en la celda A1 indicada (por ejemplo 'F12') en la hoja 'sheet_title'.
-    """
-    body = {"values": [[value]]}
-    sheets_service.spreadsheets().values().update(
-        spreadsheetId=spreadsheet_id,
-        range=f"{sheet_title}!{a1}",
-        valueInputOption="USER_ENTERED",
-        body=body
-    ).execute()
-
 def update_single_cell(spreadsheet_id: str, sheet_title: str, col_letter: str, row: int, value):
     """
     Actualiza UNA sola celda en formato A1 (p.ej. Registros!F2) usando USER_ENTERED.
     No toca fórmulas de otras columnas.
     """
-    range_name = f"{sheet_title}!{col_letter}{row}"
+    range_name = rango(sheet_title, f"{col_letter}{row}")
     body = {"values": [[value]]}
     try:
         sheets_service.spreadsheets().values().update(
@@ -137,13 +314,24 @@ def update_single_cell(spreadsheet_id: str, sheet_title: str, col_letter: str, r
         raise
 
 
-# Inicializa servicios (¡debe ir antes de usar drive_service/sheets_service!)
-drive_service, sheets_service = get_services()
+class ServicioDelInquilino:
+    """Reenvía cada uso al cliente (drive/sheets) del inquilino del contexto actual."""
+
+    def __init__(self, atributo: str):
+        self._atributo = atributo
 
-def gs_set_cell(spreadsheet_id: str, row: int, header: str, value):
+    def __getattr__(self, nombre):
+        return getattr(getattr(inquilino_actual(), self._atributo), nombre)
+
+
+# Los clientes reales viven en cada Inquilino (ver MULTI-INQUILINO)
+drive_service = ServicioDelInquilino("drive")
+sheets_service = ServicioDelInquilino("sheets")
+
+def gs_set_cell(spreadsheet_id: str, row: int, header: str, value, sheet_title: str | None = None):
     """Escribe una sola celda por encabezado sin tocar fórmulas de otras columnas."""
     col = COL[header]  # p.ej. "D" para "TIPO DE TRABAJO"
-    rng = f"{SHEET_TITLE}!{col}{row}"
+    rng = rango(sheet_title or titulo_hoja(), f"{col}{row}")
     body = {"values": [[value]]}
     # sheets_service debe ser tu cliente de Google Sheets (v4)
     sheets_service.spreadsheets().values().update(
@@ -154,9 +342,13 @@ def gs_set_cell(spreadsheet_id: str, row: int, header: str, value):
     ).execute()
 
 
-def get_or_create_main_folder():
+def literal_q(valor: str) -> str:
+    """Valor entre comillas para el parámetro q de Drive: escapa \\ y '."""
+    return "'" + valor.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+def get_or_create_main_folder(drive_id: str = DRIVE_ID, nombre_carpeta: str = NOMBRE_CARPETA_DRIVE):
     """Busca la carpeta principal en la unidad compartida. Si no existe, la crea."""
-    query = f"name='{NOMBRE_CARPETA_DRIVE}' and '{DRIVE_ID}' in parents and trashed=false"
+    query = f"name={literal_q(nombre_carpeta)} and '{drive_id}' in parents and trashed=false"
     results = drive_service.files().list(
         q=query,
         fields="files(id, name)",
@@ -169,9 +361,9 @@ def get_or_create_main_folder():
 
     # Crear carpeta si no existe
     metadata = {
-        "name": NOMBRE_CARPETA_DRIVE,
+        "name": nombre_carpeta,
         "mimeType": "application/vnd.google-apps.folder",
-        "parents": [DRIVE_ID]
+        "parents": [drive_id]
     }
     folder = drive_service.files().create(
         body=metadata,
@@ -180,8 +372,9 @@ def get_or_create_main_folder():
     ).execute()
     return folder["id"]
 
-# ID de la carpeta principal
-MAIN_FOLDER_ID = get_or_create_main_folder()
+def carpeta_principal() -> str:
+    """ID de la carpeta principal del inquilino actual (se resuelve una vez por inquilino)."""
+    return inquilino_actual().carpeta_id
 
 # ================== Google Sheets (constantes) ==================
 SHEET_MIME = "application/vnd.google-apps.spreadsheet"
@@ -243,8 +436,8 @@ def nombre_archivo_grupo(update: Update) -> str:
 def buscar_archivo_en_drive(nombre_archivo: str, mime: str | None = None):
     # Reemplaza tu versión anterior por esta (acepta mime opcional)
     q = [
-        f"name='{nombre_archivo}'",
-        f"'{MAIN_FOLDER_ID}' in parents",
+        f"name={literal_q(nombre_archivo)}",
+        f"'{carpeta_principal()}' in parents",
         "trashed=false",
     ]
     if mime:
@@ -261,14 +454,155 @@ def buscar_archivo_en_drive(nombre_archivo: str, mime: str | None = None):
     return files[0] if files else None
 
 
+# -------------------- ROLLOVER DE PESTAÑAS --------------------
+# En modo "mensual" cada mes se escribe en su propia pestaña ("Registros Octubre 2026")
+# para que la hoja viva no crezca sin límite. Las pestañas de meses cerrados las
+# mueve la tarea nocturna (ver COMPACTAR_HORA) a un spreadsheet de archivo por año
+# ("<grupo> - Archivo 2026"); nunca se archiva dentro de un handler.
+# La pestaña histórica "Registros" (sin mes) no se toca.
+ROLLOVER_REGISTROS = os.getenv("ROLLOVER_REGISTROS", "mensual").lower()  # "mensual" | "ninguno"
+ROLLOVER_MESES_VIVOS = int(os.getenv("ROLLOVER_MESES_VIVOS", "2"))  # mes actual + anterior
+
+# (spreadsheet_id, pestaña) -> sheetId de las pestañas ya verificadas en este proceso:
+# evita un spreadsheets.get por evento
+_HOJAS_LISTAS = {}
+
+def rango(sheet_title: str, a1: str) -> str:
+    """Rango A1 con el nombre de pestaña entre comillas (las mensuales llevan espacios)."""
+    return f"'{sheet_title}'!{a1}"
+
+def titulo_hoja(fecha: datetime | None = None) -> str:
+    """Pestaña de registros que corresponde a `fecha` (por defecto, ahora en Lima)."""
+    if ROLLOVER_REGISTROS != "mensual":
+        return SHEET_TITLE
+    fecha = fecha or datetime.now(LIMA_TZ)
+    return f"{SHEET_TITLE} {MESES[fecha.month - 1]} {fecha.year}"
+
+def periodo_de_hoja(sheet_title: str) -> int | None:
+    """'Registros Octubre 2026' -> 2026*12 + 9. None si no es una pestaña mensual."""
+    m = re.fullmatch(rf"{re.escape(SHEET_TITLE)} (\w+) (\d{{4}})", sheet_title)
+    if not m or m.group(1) not in MESES:
+        return None
+    return int(m.group(2)) * 12 + MESES.index(m.group(1))
+
+def _crear_pestana_mes(spreadsheet_id: str, sheet_title: str, props: list[dict]) -> int:
+    """
+    Crea la pestaña del mes. Si hay una pestaña de registros anterior la duplica
+    (conserva formato, encabezados y fórmulas de la fila 1) y vacía sus filas de datos.
+    Devuelve el sheetId de la pestaña nueva.
+    """
+    previas = [p for p in props if periodo_de_hoja(p["title"]) is not None or p["title"] == SHEET_TITLE]
+    if not previas:
+        requests = [{
+            "addSheet": {
+                "properties": {
+                    "title": sheet_title,
+                    "gridProperties": {"frozenRowCount": 1}
+                }
+            }
+        }]
+    else:
+        plantilla = max(previas, key=lambda p: periodo_de_hoja(p["title"]) or -1)
+        nuevo_id = max(p["sheetId"] for p in props) + 1
+        requests = [{
+            "duplicateSheet": {
+                "sourceSheetId": plantilla["sheetId"],
+                "insertSheetIndex": 0,
+                "newSheetId": nuevo_id,
+                "newSheetName": sheet_title,
+            }
+        }]
+        # La API no deja borrar todas las filas no congeladas: se borran de la 3 en
+        # adelante y la 2 solo se limpia (conserva su formato)
+        filas = plantilla.get("gridProperties", {}).get("rowCount", 1)
+        if filas > 2:
+            requests.append({
+                "deleteDimension": {
+                    "range": {"sheetId": nuevo_id, "dimension": "ROWS", "startIndex": 2, "endIndex": filas}
+                }
+            })
+        if filas > 1:
+            requests.append({
+                "updateCells": {
+                    "range": {"sheetId": nuevo_id, "startRowIndex": 1, "endRowIndex": 2},
+                    "fields": "userEnteredValue",
+                }
+            })
+    resp = sheets_service.spreadsheets().batchUpdate(
+        spreadsheetId=spreadsheet_id,
+        body={"requests": requests}
+    ).execute()
+    logger.info(f"[DEBUG] Rollover: creada pestaña '{sheet_title}' en {spreadsheet_id}")
+    if not previas:
+        return resp["replies"][0]["addSheet"]["properties"]["sheetId"]
+    return nuevo_id
+
+def periodo_limite_vivo() -> int:
+    """Último periodo (año*12 + mes) que ya se considera cerrado y va al archivo."""
+    ahora = datetime.now(LIMA_TZ)
+    return ahora.year * 12 + ahora.month - 1 - ROLLOVER_MESES_VIVOS
+
+def _archivar_periodos_cerrados(spreadsheet_id: str, nombre: str, props: list[dict]):
+    """
+    Mueve las pestañas mensuales cerradas al spreadsheet '<nombre> - Archivo <año>'.
+    Copia y borrado son llamadas separadas: si el archivo ya tiene la pestaña (el
+    borrado falló otra noche), solo se borra la del grupo.
+    """
+    limite = periodo_limite_vivo()
+    archivos, archivadas = {}, {}
+    for p in props:
+        periodo = periodo_de_hoja(p["title"])
+        if periodo is None or periodo > limite:
+            continue
+        anio = periodo // 12
+        if anio not in archivos:
+            archivos[anio] = buscar_o_crear_spreadsheet(f"{nombre} - Archivo {anio}")
+            meta = sheets_service.spreadsheets().get(
+                spreadsheetId=archivos[anio],
+                fields="sheets.properties.title"
+            ).execute()
+            archivadas[anio] = {s["properties"]["title"] for s in meta.get("sheets", [])}
+
+        if p["title"] in archivadas[anio]:
+            sheets_service.spreadsheets().batchUpdate(
+                spreadsheetId=spreadsheet_id,
+                body={"requests": [{"deleteSheet": {"sheetId": p["sheetId"]}}]}
+            ).execute()
+            logger.info(f"[DEBUG] Rollover: '{p['title']}' ya estaba en {archivos[anio]}, solo se borra del grupo")
+            continue
+
+        copia = sheets_service.spreadsheets().sheets().copyTo(
+            spreadsheetId=spreadsheet_id,
+            sheetId=p["sheetId"],
+            body={"destinationSpreadsheetId": archivos[anio]}
+        ).execute()
+        sheets_service.spreadsheets().batchUpdate(
+            spreadsheetId=archivos[anio],
+            body={"requests": [{"updateSheetProperties": {
+                "properties": {"sheetId": copia["sheetId"], "title": p["title"]},
+                "fields": "title",
+            }}]}
+        ).execute()
+        archivadas[anio].add(p["title"])
+        sheets_service.spreadsheets().batchUpdate(
+            spreadsheetId=spreadsheet_id,
+            body={"requests": [{"deleteSheet": {"sheetId": p["sheetId"]}}]}
+        ).execute()
+        logger.info(f"[DEBUG] Rollover: '{p['title']}' archivada en {archivos[anio]}")
+
+
 #-------------Crear (si falta) el spreadsheet del grupo y asegurar hoja/encabezados--------------#
 
 def ensure_spreadsheet_for_group(update: Update) -> str:
     """
     Asegura que exista el Google Sheet para este grupo y devuelve su file_id.
-    Si no existe, lo crea dentro de MAIN_FOLDER_ID.
+    Si no existe, lo crea dentro de la carpeta principal.
     """
-    name = nombre_archivo_grupo(update)
+    return buscar_o_crear_spreadsheet(nombre_archivo_grupo(update))
+
+
+def buscar_o_crear_spreadsheet(name: str) -> str:
+    """file_id del Google Sheet `name` en la carpeta principal; lo crea si no existe."""
     archivo = buscar_archivo_en_drive(name, SHEET_MIME)
     if archivo:
         return archivo["id"]
@@ -276,7 +610,7 @@ def ensure_spreadsheet_for_group(update: Update) -> str:
     meta = {
         "name": name,
         "mimeType": SHEET_MIME,
-        "parents": [MAIN_FOLDER_ID],
+        "parents": [carpeta_principal()],
     }
     created = drive_service.files().create(
         body=meta,
@@ -286,59 +620,96 @@ def ensure_spreadsheet_for_group(update: Update) -> str:
     return created["id"]
 
 
-def ensure_sheet_and_headers(spreadsheet_id: str):
+def ensure_sheet_and_headers(spreadsheet_id: str, sheet_title: str | None = None) -> str:
     """
-    Asegura que exista una pestaña llamada SHEET_TITLE y que la fila 1 tenga HEADERS.
-    Además congela fila 1 (opcional).
+    Asegura que exista la pestaña de registros (por defecto la del mes actual,
+    ver titulo_hoja) y que la fila 1 tenga HEADERS. Devuelve el nombre de la pestaña.
+    Cada pestaña se verifica una sola vez por proceso.
     """
-    # 1) Obtener metadata
-    meta = sheets_service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
-    sheets = meta.get("sheets", [])
-    sheet_id = None
-    for s in sheets:
-        if s["properties"]["title"] == SHEET_TITLE:
-            sheet_id = s["properties"]["sheetId"]
-            break
+    sheet_title = sheet_title or titulo_hoja()
+    if (spreadsheet_id, sheet_title) in _HOJAS_LISTAS:
+        return sheet_title
 
-    requests = []
+    # 1) Obtener metadata
+    meta = sheets_service.spreadsheets().get(
+        spreadsheetId=spreadsheet_id,
+        fields="properties.title,sheets.properties"
+    ).execute()
+    props = [s["properties"] for s in meta.get("sheets", [])]
 
-    # 2) Crear la hoja si no existe
+    # 2) Crear la hoja si no existe (los meses cerrados los archiva la tarea nocturna)
+    sheet_id = next((p["sheetId"] for p in props if p["title"] == sheet_title), None)
     if sheet_id is None:
-        requests.append({
-            "addSheet": {
-                "properties": {
-                    "title": SHEET_TITLE,
-                    "gridProperties": {"frozenRowCount": 1}
-                }
-            }
-        })
-        sheets_service.spreadsheets().batchUpdate(
-            spreadsheetId=spreadsheet_id,
-            body={"requests": requests}
-        ).execute()
+        sheet_id = _crear_pestana_mes(spreadsheet_id, sheet_title, props)
 
-    # 3) Asegurar headers en A1:I1
+    # 3) Asegurar headers en A1:I1 (y los de las derivadas, en la misma lectura)
+    fin = _letra_col(_indice_col(DERIVADAS_COL) + len(DERIVADAS_HEADERS) - 1) if COLUMNAS_DERIVADAS else "I"
     vr = sheets_service.spreadsheets().values().get(
         spreadsheetId=spreadsheet_id,
-        range=f"{SHEET_TITLE}!A1:I1"
+        range=rango(sheet_title, f"A1:{fin}1")
     ).execute()
     row = vr.get("values", [])
-    if not row or row[0] != HEADERS:
+    if not row or row[0][:len(HEADERS)] != HEADERS:
         sheets_service.spreadsheets().values().update(
             spreadsheetId=spreadsheet_id,
-            range=f"{SHEET_TITLE}!A1:I1",
+            range=rango(sheet_title, "A1:I1"),
             valueInputOption="RAW",
             body={"values": [HEADERS]}
         ).execute()
+    inicio = _indice_col(DERIVADAS_COL)
+    if COLUMNAS_DERIVADAS and (not row or row[0][inicio:inicio + len(DERIVADAS_HEADERS)] != DERIVADAS_HEADERS):
+        preparar_columnas_derivadas(spreadsheet_id, sheet_id)
+    if GEOCERCA_ACTIVA:
+        sheets_service.spreadsheets().values().batchUpdate(
+            spreadsheetId=spreadsheet_id,
+            body={"valueInputOption": "RAW", "data": [
+                {"range": rango(sheet_title, f"{GEO_COL_SEDE}1"), "values": [["SEDE"]]},
+                {"range": rango(sheet_title, f"{GEO_COL_DISTANCIA}1"), "values": [["DISTANCIA SEDE (m)"]]},
+            ]}
+        ).execute()
+
+    _HOJAS_LISTAS[(spreadsheet_id, sheet_title)] = sheet_id
+    return sheet_title
+
+def _formato_columnas(sheet_id: int, inicio: int, fin: int, tipo: str, patron: str) -> dict:
+    return {"repeatCell": {
+        "range": {"sheetId": sheet_id, "startRowIndex": 1, "startColumnIndex": inicio, "endColumnIndex": fin},
+        "cell": {"userEnteredFormat": {"numberFormat": {"type": tipo, "pattern": patron}}},
+        "fields": "userEnteredFormat.numberFormat",
+    }}
+
+def preparar_columnas_derivadas(spreadsheet_id: str, sheet_id: int):
+    """
+    Encabezados de las derivadas y formatos de número para los valores tipados (RAW):
+    FECHA como fecha, horas como hh:mm y duraciones como [h]:mm. Un solo batchUpdate.
+    """
+    inicio = _indice_col(DERIVADAS_COL)
+    requests = [
+        {"updateCells": {
+            "start": {"sheetId": sheet_id, "rowIndex": 0, "columnIndex": inicio},
+            "rows": [{"values": [{"userEnteredValue": {"stringValue": h}} for h in DERIVADAS_HEADERS]}],
+            "fields": "userEnteredValue",
+        }},
+        _formato_columnas(sheet_id, HEADERS.index("FECHA"), HEADERS.index("FECHA") + 1, "DATE", "yyyy-mm-dd"),
+        _formato_columnas(sheet_id, HEADERS.index(COLUMNAS_HORA[0]), HEADERS.index(COLUMNAS_HORA[-1]) + 1, "TIME", "hh:mm"),
+        _formato_columnas(sheet_id, inicio, inicio + 2, "TIME", "[h]:mm"),
+    ]
+    sheets_service.spreadsheets().batchUpdate(
+        spreadsheetId=spreadsheet_id,
+        body={"requests": requests}
+    ).execute()
+    logger.info(f"[DEBUG] Columnas derivadas preparadas en {spreadsheet_id} (sheetId {sheet_id})")
 
-def append_base_row(spreadsheet_id: str, data: dict) -> int:
+def append_base_row(spreadsheet_id: str, data: dict, sheet_title: str | None = None, ancla: str | None = None) -> int:
     """
     Inserta una nueva fila (vacía o con base) bajo los HEADERS y devuelve el número de fila insertada.
-    Devuelve el NÚMERO de fila (2, 3, 4, ...).
+    Devuelve el NÚMERO de fila (2, 3, 4, ...). Con `ancla`, además la etiqueta con
+    developer metadata (ver anclar_fila) para poder escribirle aunque se reordene la hoja.
     """
+    sheet_title = sheet_title or titulo_hoja()
     ahora = datetime.now(LIMA_TZ)
     payload = {
-        "MES": ahora.strftime("%B"),
+        "MES": MESES[ahora.month - 1],
         "FECHA": ahora.strftime("%Y-%m-%d"),
         "CUADRILLA": data.get("CUADRILLA", ""),
         "TIPO DE TRABAJO": data.get("TIPO DE TRABAJO", ""),
@@ -348,12 +719,12 @@ def append_base_row(spreadsheet_id: str, data: dict) -> int:
         "HORA BREAK IN": "",
         "HORA SALIDA": "",
     }
-    row = [[payload.get(h, "") for h in HEADERS]]
+    row = [[valor_tipado(h, payload.get(h, "")) for h in HEADERS]]
 
     resp = sheets_service.spreadsheets().values().append(
         spreadsheetId=spreadsheet_id,
-        range=f"{SHEET_TITLE}!A:A",
-        valueInputOption="USER_ENTERED",
+        range=rango(sheet_title, "A:A"),
+        valueInputOption=ENTRADA_JORNADA,
         insertDataOption="INSERT_ROWS",
         body={"values": row}
     ).execute()
@@ -365,26 +736,305 @@ def append_base_row(spreadsheet_id: str, data: dict) -> int:
         a1 = updated_range.split("!")[1].split(":")[0]  # "A5"
         fila = int(''.join([c for c in a1 if c.isdigit()]))
     except Exception:
-        fila = None
-    return fila or 2  # fallback
+        # Adivinar la fila (antes: la 2) escribía luego sobre la jornada de otra cuadrilla
+        raise RuntimeError(f"append_base_row: no se pudo leer la fila de '{updated_range}'")
+    if ancla:
+        anclar_fila(spreadsheet_id, sheet_title, fila, ancla)
+    return fila
 
-def update_cell(spreadsheet_id: str, col_key: str, row: int, value: str):
+def update_cell(spreadsheet_id: str, col_key: str, row: int, value: str, sheet_title: str | None = None):
     """
     Actualiza UNA celda (col_key es el encabezado, no la letra).
     """
     col_letter = COL[col_key]
     sheets_service.spreadsheets().values().update(
         spreadsheetId=spreadsheet_id,
-        range=f"{SHEET_TITLE}!{col_letter}{row}",
+        range=rango(sheet_title or titulo_hoja(), f"{col_letter}{row}"),
         valueInputOption="USER_ENTERED",
         body={"values": [[value]]}
     ).execute()
 
+# -------------------- ANCLAJE DE FILAS (developer metadata) --------------------
+# Cada fila base lleva un developer metadata CLAVE_ANCLA = ud["ancla"] pegado a la
+# fila: si alguien ordena, filtra o inserta filas en la hoja, la etiqueta se mueve
+# con ella. Las escrituras de la jornada van por values.batchUpdateByDataFilter con
+# ese ancla (una sola llamada, igual que antes), así que siempre caen en la fila
+# correcta; la respuesta trae la fila actual y con eso se refresca ud["row"].
+# Costo: anclar la fila base es una llamada más por jornada (createDeveloperMetadata
+# necesita el número de fila, que solo se conoce tras el values.append). La tarea
+# nocturna borra las anclas de días cerrados que ya no usa ninguna sesión.
+CLAVE_ANCLA = "asistencia_jornada"
+
+def nueva_ancla() -> str:
+    return uuid.uuid4().hex[:12]
+
+def sheet_id_de(spreadsheet_id: str, sheet_title: str) -> int:
+    if (spreadsheet_id, sheet_title) not in _HOJAS_LISTAS:
+        ensure_sheet_and_headers(spreadsheet_id, sheet_title)
+    return _HOJAS_LISTAS[(spreadsheet_id, sheet_title)]
+
+def anclar_fila(spreadsheet_id: str, sheet_title: str, row: int, ancla: str):
+    sheets_service.spreadsheets().batchUpdate(
+        spreadsheetId=spreadsheet_id,
+        body={"requests": [{"createDeveloperMetadata": {"developerMetadata": {
+            "metadataKey": CLAVE_ANCLA,
+            "metadataValue": ancla,
+            "location": {"dimensionRange": {
+                "sheetId": sheet_id_de(spreadsheet_id, sheet_title),
+                "dimension": "ROWS",
+                "startIndex": row - 1,
+                "endIndex": row,
+            }},
+            "visibility": "DOCUMENT",
+        }}}]}
+    ).execute()
+
+def mapa_anclas(spreadsheet_id: str) -> dict[str, tuple[int, int]]:
+    """ancla -> (sheetId, fila actual) de todas las filas ancladas, en un solo developerMetadata.search."""
+    resp = sheets_service.spreadsheets().developerMetadata().search(
+        spreadsheetId=spreadsheet_id,
+        body={"dataFilters": [{"developerMetadataLookup": {"metadataKey": CLAVE_ANCLA}}]}
+    ).execute()
+    mapa = {}
+    for m in resp.get("matchedDeveloperMetadata", []):
+        md = m["developerMetadata"]
+        dr = md.get("location", {}).get("dimensionRange")
+        if dr:
+            mapa[md["metadataValue"]] = (dr.get("sheetId", 0), dr["startIndex"] + 1)
+    return mapa
+
+def escribir_en_jornada(ud: dict, updates: dict[str, str]):
+    """
+    Escribe {encabezado: valor} en la fila de la jornada. Con ancla, por DataFilter
+    (los None de la fila no se tocan, así no se pisan fórmulas); sesiones antiguas
+    sin ancla siguen escribiendo por número de fila.
+    """
+    ssid = ud["spreadsheet_id"]
+    tipados = {header: valor_tipado(header, valor) for header, valor in updates.items()}
+    if not ud.get("ancla"):
+        gs_update_cells(ssid, ud["row"], tipados, ud.get("sheet_title", SHEET_TITLE), ENTRADA_JORNADA)
+        anotar_derivadas(ud, updates)
+        return
+
+    indices = {header: _indice_col(COL[header]) for header in updates}
+    fila = [None] * (max(indices.values()) + 1)
+    for header, i in indices.items():
+        fila[i] = tipados[header]
+    resp = sheets_service.spreadsheets().values().batchUpdateByDataFilter(
+        spreadsheetId=ssid,
+        body={
+            "valueInputOption": ENTRADA_JORNADA,
+            "data": [{
+                "dataFilter": {"developerMetadataLookup": {"metadataKey": CLAVE_ANCLA, "metadataValue": ud["ancla"]}},
+                "majorDimension": "ROWS",
+                "values": [fila],
+            }],
+        }
+    ).execute()
+    respuestas = resp.get("responses", [])
+    if not resp.get("totalUpdatedCells") or not respuestas:
+        raise RuntimeError(f"La fila de la jornada ({ud['ancla']}) ya no existe en {ssid}")
+    ud["row"] = _parse_row_from_updated_range(respuestas[0]["updatedRange"])
+    anotar_derivadas(ud, updates)
+
+# -------------------- COLUMNAS DERIVADAS CALCULADAS POR EL BOT --------------------
+# Con COLUMNAS_DERIVADAS=1 las columnas que antes eran fórmulas (desde DERIVADAS_COL,
+# p.ej. J:L) las calcula el bot: horas trabajadas, duración del break y observaciones.
+# Las escrituras por evento pasan a RAW con valores tipados (horas como fracción de
+# día, FECHA como número de serie), así Sheets no reinterpreta nada ni recalcula
+# fórmulas en cada foto. Las derivadas de cada jornada tocada se acumulan en memoria
+# y se escriben cada DERIVADAS_INTERVALO_SEG: un batchUpdateByDataFilter por
+# spreadsheet (la última versión de cada fila gana; el apagado vacía lo pendiente y
+# lo que no se pudo escribir va al snapshot de sesiones). La compactación renumera
+# las filas pendientes sin ancla; mientras corre no se vuelca nada.
+# Los formatos de número (fecha, hh:mm, [h]:mm) se fijan una vez al poner los
+# encabezados de las derivadas; las pestañas nuevas los heredan al duplicarse.
+COLUMNAS_DERIVADAS = os.getenv("COLUMNAS_DERIVADAS", "0") == "1"
+DERIVADAS_INTERVALO_SEG = float(os.getenv("DERIVADAS_INTERVALO_SEG", "60"))
+DERIVADAS_COL = os.getenv("DERIVADAS_COL", "J")
+DERIVADAS_HEADERS = ["HORAS TRABAJADAS", "DURACIÓN BREAK", "OBSERVACIONES"]
+COLUMNAS_HORA = ("HORA INGRESO", "HORA BREAK OUT", "HORA BREAK IN", "HORA SALIDA")
+ENTRADA_JORNADA = "RAW" if COLUMNAS_DERIVADAS else "USER_ENTERED"
+
+# inquilino -> {clave_fila: {spreadsheet_id, sheet_title, row, ancla, valores}}
+DERIVADAS_PENDIENTES: dict[str, dict[str, dict]] = {}
+_DERIVADAS_LOCK = threading.Lock()  # se anota desde los hilos de google_io
+_VOLCADO_DERIVADAS = asyncio.Lock()  # volcado y compactación no se cruzan
+
+def valor_tipado(header: str, valor):
+    """'08:15' -> 0.34375 y '2026-10-19' -> número de serie, solo con COLUMNAS_DERIVADAS."""
+    if not COLUMNAS_DERIVADAS or not isinstance(valor, str):
+        return valor
+    if header in COLUMNAS_HORA and re.fullmatch(r"\d{1,2}:\d{2}", valor):
+        return _minutos_celda(valor) / 1440
+    if header == "FECHA" and re.fullmatch(r"\d{4}-\d{2}-\d{2}", valor):
+        return (datetime.strptime(valor, "%Y-%m-%d") - EPOCA_SHEETS).days
+    return valor
+
+def _minutos_celda(valor) -> int | None:
+    """Hora como fracción de día o texto 'HH:MM' -> minutos desde las 00:00 (None si vacía)."""
+    if isinstance(valor, (int, float)) and not isinstance(valor, bool):
+        return round(valor % 1 * 1440)
+    m = re.match(r"\s*(\d{1,2}):(\d{2})", str(valor or ""))
+    return int(m.group(1)) * 60 + int(m.group(2)) if m else None
+
+def calcular_derivadas(valores: dict) -> list:
+    """{encabezado: valor} de la jornada -> valores de DERIVADAS_HEADERS (duraciones en días)."""
+    ingreso, b_out, b_in, salida = (_minutos_celda(valores.get(h)) for h in COLUMNAS_HORA)
+    duracion_break = (b_in - b_out) % 1440 if b_out is not None and b_in is not None else None
+    trabajado = None
+    if ingreso is not None and salida is not None:
+        trabajado = (salida - ingreso) % 1440 - (duracion_break or 0)  # % 1440: turnos que cruzan medianoche
+
+    observaciones = []
+    h, m = (int(x) for x in ANALISIS_INGRESO_TARDE.split(":"))
+    if ingreso is not None and ingreso > h * 60 + m:
+        observaciones.append("Ingreso tarde")
+    if duracion_break is not None and duracion_break > ANALISIS_BREAK_MAX_MIN:
+        observaciones.append("Break largo")
+    if salida is not None and b_out is None:
+        observaciones.append("Sin break")
+    if salida is not None and b_out is not None and b_in is None:
+        observaciones.append("Break sin regreso")
+    if valores.get("ATS/PETAR") == "No":
+        observaciones.append("ATS/PETAR No")
+    return [
+        "" if trabajado is None else trabajado / 1440,
+        "" if duracion_break is None else duracion_break / 1440,
+        "; ".join(observaciones),
+    ]
+
+def anotar_derivadas(ud: dict, updates: dict):
+    """Acumula en `ud` lo escrito en la jornada y deja su fila pendiente para el próximo lote."""
+    if not COLUMNAS_DERIVADAS or not (set(COLUMNAS_HORA) | {"ATS/PETAR"}) & updates.keys():
+        return
+    fila = ud.get("ancla") or ud["row"]
+    valores = ud.get("valores_jornada")
+    if not valores or valores.get("_fila") != fila:  # jornada nueva: se empieza de cero
+        valores = ud["valores_jornada"] = {"_fila": fila}
+    valores.update(updates)
+    ref = {
+        "spreadsheet_id": ud["spreadsheet_id"], "sheet_title": ud.get("sheet_title", SHEET_TITLE),
+        "row": ud["row"], "ancla": ud.get("ancla"), "valores": dict(valores),
+    }
+    with _DERIVADAS_LOCK:
+        DERIVADAS_PENDIENTES.setdefault(inquilino_actual().nombre, {})[clave_fila(ud)] = ref
+
+def escribir_derivadas(pendientes: dict[str, dict]) -> dict[str, dict]:
+    """Un batchUpdateByDataFilter por spreadsheet. Devuelve las filas que no se pudieron escribir."""
+    inicio = _indice_col(DERIVADAS_COL)
+    fin = _letra_col(inicio + len(DERIVADAS_HEADERS) - 1)
+    por_spreadsheet = collections.defaultdict(dict)
+    for clave, ref in pendientes.items():
+        por_spreadsheet[ref["spreadsheet_id"]][clave] = ref
+
+    fallidas = {}
+    for ssid, refs in por_spreadsheet.items():
+        data = []
+        for ref in refs.values():
+            derivadas = calcular_derivadas(ref["valores"])
+            if ref["ancla"]:
+                data.append({
+                    "dataFilter": {"developerMetadataLookup": {"metadataKey": CLAVE_ANCLA, "metadataValue": ref["ancla"]}},
+                    "majorDimension": "ROWS",
+                    "values": [[None] * inicio + derivadas],
+                })
+            else:
+                data.append({
+                    "dataFilter": {"a1Range": rango(ref["sheet_title"], f"{DERIVADAS_COL}{ref['row']}:{fin}{ref['row']}")},
+                    "majorDimension": "ROWS",
+                    "values": [derivadas],
+                })
+        try:
+            sheets_service.spreadsheets().values().batchUpdateByDataFilter(
+                spreadsheetId=ssid,
+                body={"valueInputOption": "RAW", "data": data}
+            ).execute()
+            logger.info(f"[DEBUG] Derivadas: {len(data)} filas escritas en {ssid}")
+        except Exception as e:
+            logger.error(f"[ERROR] Derivadas en {ssid}: {e}")
+            fallidas.update(refs)
+    return fallidas
+
+async def volcar_derivadas():
+    async with _VOLCADO_DERIVADAS:
+        await _volcar_derivadas()
+
+async def _volcar_derivadas():
+    with _DERIVADAS_LOCK:
+        lotes = dict(DERIVADAS_PENDIENTES)
+        DERIVADAS_PENDIENTES.clear()
+    for nombre, pendientes in lotes.items():
+        token = INQUILINO_ACTUAL.set(INQUILINOS[nombre])
+        try:
+            fallidas = await google_io(escribir_derivadas, pendientes)
+        except Exception as e:
+            logger.error(f"[ERROR] volcar_derivadas ({nombre}): {e}")
+            fallidas = pendientes
+        finally:
+            INQUILINO_ACTUAL.reset(token)
+        if fallidas:
+            with _DERIVADAS_LOCK:
+                cola = DERIVADAS_PENDIENTES.setdefault(nombre, {})
+                for clave, ref in fallidas.items():
+                    cola.setdefault(clave, ref)  # si ya hay una versión más nueva, gana esa
+
+async def escritura_derivadas():
+    while True:
+        await asyncio.sleep(DERIVADAS_INTERVALO_SEG)
+        await volcar_derivadas()
+
 # -------------------- ESTADOS TEMPORALES --------------------
 user_data = {}
 
+def asegurar_fila(update: Update, ud: dict) -> tuple[str, str, int]:
+    """
+    Devuelve (spreadsheet_id, pestaña, fila) de la jornada del chat. Si falta el
+    spreadsheet o la fila (no debería, pero por seguridad) los crea y los guarda en `ud`.
+    La pestaña queda fijada al crear la fila: una jornada que cruza fin de mes sigue
+    escribiendo en la pestaña donde empezó.
+    """
+    spreadsheet_id = ud.get("spreadsheet_id")
+    if not spreadsheet_id:
+        spreadsheet_id = ensure_spreadsheet_for_group(update)
+        ud["spreadsheet_id"] = spreadsheet_id
+        logger.info(f"[DEBUG] asegurar_fila: asegurado spreadsheet_id={spreadsheet_id}")
+
+    row = ud.get("row")
+    if not row:
+        # ¿Ya se creó la fila base de esta jornada (p.ej. antes de un reinicio)? Reusarla.
+        clave = clave_evento(update.effective_chat.id, "fila_base", ud)
+        previa = IDEMPOTENCIA.ver(clave)
+        if previa:
+            ref = json.loads(previa)
+            if ref["spreadsheet_id"] == spreadsheet_id:
+                ud["sheet_title"], ud["row"] = ref["sheet_title"], ref["row"]
+                if ref.get("ancla"):
+                    ud["ancla"] = ref["ancla"]
+                logger.info(f"[DEBUG] asegurar_fila: reusando fila base {ref['row']} ({clave})")
+                return spreadsheet_id, ud["sheet_title"], ud["row"]
+
+        sheet_title = ensure_sheet_and_headers(spreadsheet_id)
+        base = {
+            "CUADRILLA": ud.get("cuadrilla", ""),
+            "TIPO DE TRABAJO": ud.get("tipo", ""),
+        }
+        ancla = nueva_ancla()
+        row = append_base_row(spreadsheet_id, base, sheet_title, ancla)
+        ud["sheet_title"] = sheet_title
+        ud["row"] = row
+        ud["ancla"] = ancla
+        IDEMPOTENCIA.registrar(clave, json.dumps(
+            {"spreadsheet_id": spreadsheet_id, "sheet_title": sheet_title, "row": row, "ancla": ancla}
+        ))
+        logger.info(f"[DEBUG] asegurar_fila: creada fila base -> sheet={spreadsheet_id}, pestaña='{sheet_title}', row={row}")
+
+    # Sesiones anteriores al rollover no guardan pestaña: eran de "Registros"
+    return spreadsheet_id, ud.get("sheet_title", SHEET_TITLE), row
+
 # -------------------- BOT INFO --------------------
 BOT_USERNAME = None
+TAREAS_FONDO = []  # tareas periódicas lanzadas en al_iniciar, se cancelan en al_detener
 
 async def init_bot_info(app):
     global BOT_USERNAME
@@ -392,6 +1042,114 @@ async def init_bot_info(app):
     BOT_USERNAME = f"@{bot_info.username}"
     logger.info(f"Bot iniciado como {BOT_USERNAME}")
 
+async def al_iniciar(app):
+    """post_init: corre una vez, con el loop ya levantado."""
+    VIGILANTE.iniciar()
+    await init_bot_info(app)
+    COLA_SALIDA.iniciar()
+    TAREAS_FONDO.append(asyncio.create_task(en_cada_inquilino(reconstruir_agregados)))
+    if COMPACTAR_HORA:
+        TAREAS_FONDO.append(asyncio.create_task(compactacion_diaria()))
+    if ANALISIS_HORA:
+        TAREAS_FONDO.append(asyncio.create_task(analisis_nocturno()))
+    if COLUMNAS_DERIVADAS:
+        TAREAS_FONDO.append(asyncio.create_task(escritura_derivadas()))
+
+async def al_detener(app):
+    """post_stop: ya sin recibir updates, pero con el bot todavía usable (su cliente
+    HTTP se cierra recién en app.shutdown): las descargas de fotos y la cola de
+    salida aún pueden terminar."""
+    await drenar_escrituras()
+    if COLUMNAS_DERIVADAS:
+        await volcar_derivadas()  # después: las últimas escrituras también anotan derivadas
+    for tarea in TAREAS_FONDO:
+        tarea.cancel()
+    await asyncio.gather(*TAREAS_FONDO, return_exceptions=True)
+    TAREAS_FONDO.clear()
+    VIGILANTE.detener()
+    await COLA_SALIDA.detener()
+
+async def al_apagar(app):
+    """post_shutdown: corre con el bot ya cerrado; solo queda guardar las sesiones."""
+    if REPLICAS is None:  # con réplicas las sesiones ya viven en el KV
+        guardar_snapshot_sesiones()
+
+# -------------------- APAGADO ORDENADO --------------------
+# Al recibir SIGTERM run_polling deja de pedir updates; luego al_detener espera
+# (hasta APAGADO_PLAZO_SEG) las escrituras a Google y las descargas de fotos que
+# sigan en curso, antes de que app.shutdown cierre el cliente HTTP del bot; después
+# al_apagar guarda user_data comprimido en SNAPSHOT_SESIONES. El siguiente arranque
+# lo recarga y lo borra, así un despliegue no corta jornadas a medias.
+APAGADO_PLAZO_SEG = float(os.getenv("APAGADO_PLAZO_SEG", "20"))
+SNAPSHOT_SESIONES = os.getenv("SNAPSHOT_SESIONES", "sesiones.json.gz")
+SNAPSHOT_MAX_HORAS = float(os.getenv("SNAPSHOT_MAX_HORAS", "12"))  # más viejo = se descarta
+
+ESCRITURAS_PENDIENTES = set()
+
+def google_io(fn, *args) -> asyncio.Future:
+    """
+    run_in_executor para llamadas a Google, en el executor del inquilino actual y con
+    su contexto; queda registrado para que el apagado lo espere.
+    """
+    ctx = contextvars.copy_context()
+    futuro = asyncio.get_running_loop().run_in_executor(inquilino_actual().executor, ctx.run, fn, *args)
+    ESCRITURAS_PENDIENTES.add(futuro)
+    futuro.add_done_callback(ESCRITURAS_PENDIENTES.discard)
+    return futuro
+
+async def drenar_escrituras(plazo: float = APAGADO_PLAZO_SEG):
+    if not ESCRITURAS_PENDIENTES:
+        return
+    logger.info(f"[DEBUG] Apagado: esperando {len(ESCRITURAS_PENDIENTES)} escrituras a Google")
+    _, pendientes = await asyncio.wait(set(ESCRITURAS_PENDIENTES), timeout=plazo)
+    if pendientes:
+        logger.error(f"[ERROR] Apagado: {len(pendientes)} escrituras sin terminar tras {plazo:.0f}s")
+
+def guardar_snapshot_sesiones(ruta: str = SNAPSHOT_SESIONES):
+    with _DERIVADAS_LOCK:  # filas derivadas que no se pudieron volcar
+        derivadas = {nombre: dict(refs) for nombre, refs in DERIVADAS_PENDIENTES.items() if refs}
+    datos = {"t": time.time(), "sesiones": user_data, "derivadas": derivadas}
+    tmp = ruta + ".tmp"
+    with gzip.open(tmp, "wt", encoding="utf-8") as f:
+        json.dump(datos, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp, ruta)
+    logger.info(f"[DEBUG] Apagado: {len(user_data)} sesiones y "
+                f"{sum(map(len, derivadas.values()))} filas derivadas guardadas en {ruta}")
+
+def cargar_snapshot_sesiones(ruta: str = SNAPSHOT_SESIONES):
+    try:
+        with gzip.open(ruta, "rt", encoding="utf-8") as f:
+            datos = json.load(f)
+        sesiones = {int(chat_id): ud for chat_id, ud in datos.get("sesiones", {}).items()}
+        derivadas = {nombre: dict(refs) for nombre, refs in datos.get("derivadas", {}).items()}
+    except FileNotFoundError:
+        return
+    except Exception as e:
+        # Se deja aparte para revisarlo: borrarlo perdería las sesiones sin dejar rastro
+        logger.error(f"[ERROR] Snapshot de sesiones ilegible ({ruta}), se guarda como {ruta}.corrupt: {e}")
+        with contextlib.suppress(OSError):
+            os.replace(ruta, ruta + ".corrupt")
+        return
+    # Un snapshot se usa una sola vez: tras una caída no debe resucitar sesiones viejas
+    os.remove(ruta)
+    edad_horas = (time.time() - datos.get("t", 0)) / 3600
+    if edad_horas > SNAPSHOT_MAX_HORAS:
+        logger.warning(f"[WARN] Snapshot de sesiones de hace {edad_horas:.1f} h: se descarta")
+        return
+    for chat_id, ud in sesiones.items():
+        user_data.setdefault(chat_id, ud)
+    with _DERIVADAS_LOCK:
+        for nombre, refs in derivadas.items():
+            if nombre not in INQUILINOS:
+                logger.warning(f"[WARN] Snapshot: {len(refs)} filas derivadas de un inquilino que ya no existe ({nombre})")
+                continue
+            cola = DERIVADAS_PENDIENTES.setdefault(nombre, {})
+            for clave, ref in refs.items():
+                cola.setdefault(clave, ref)
+    logger.info(f"[DEBUG] {len(sesiones)} sesiones y {sum(map(len, derivadas.values()))} "
+                f"filas derivadas restauradas desde {ruta}")
+
+
 #_--------------------Insertar la fila base y obtener el número de fila----------#
 def _parse_row_from_updated_range(updated_range: str) -> int:
     # Ej: "Registros!A2:I2" o "'Registros'!A2:I2"
@@ -400,12 +1158,12 @@ def _parse_row_from_updated_range(updated_range: str) -> int:
     row = int(re.findall(r"\d+", a1)[0])
     return row
 
-def gs_append_base_row(ssid: str, data: dict) -> int:
+def gs_append_base_row(ssid: str, data: dict, sheet_title: str | None = None) -> int:
     # Ordenar valores según HEADERS
     row_vals = [[ data.get(h, "") for h in HEADERS ]]
     resp = sheets_service.spreadsheets().values().append(
         spreadsheetId=ssid,
-        range=f"{SHEET_TITLE}!A:I",
+        range=rango(sheet_title or titulo_hoja(), "A:I"),
         valueInputOption="USER_ENTERED",
         insertDataOption="INSERT_ROWS",
         body={"values": row_vals}
@@ -414,491 +1172,2690 @@ def gs_append_base_row(ssid: str, data: dict) -> int:
 
 #-------------------Actualizar celdas específicas (sin tocar fórmulas en J+)--------#
 
-def gs_update_cells(ssid: str, row: int, updates: dict[str, str]):
+def gs_update_cells(ssid: str, row: int, updates: dict[str, str], sheet_title: str | None = None,
+                    entrada: str = "USER_ENTERED"):
     # updates: {"TIPO DE TRABAJO": "Ordenamiento", "HORA INGRESO": "08:15"}
+    sheet_title = sheet_title or titulo_hoja()
     data = []
     for header, value in updates.items():
         col = COL[header]
-        data.append({"range": f"{SHEET_TITLE}!{col}{row}", "values": [[value]]})
+        data.append({"range": rango(sheet_title, f"{col}{row}"), "values": [[value]]})
     sheets_service.spreadsheets().values().batchUpdate(
         spreadsheetId=ssid,
-        body={"valueInputOption":"USER_ENTERED", "data": data}
+        body={"valueInputOption": entrada, "data": data}
     ).execute()
 
-# -------------------- VALIDACIÓN DE CONTENIDO --------------------
-
-async def validar_contenido(update: Update, tipo: str):
-    if tipo == "texto" and not update.message.text:
-        await update.message.reply_text("⚠️ Debes enviar el *nombre de tu cuadrilla* en texto. ✍️📝")
-        return False
-    if tipo == "foto" and not update.message.photo:
-        await update.message.reply_text("⚠️ Debes enviar una *foto*, no texto.🤳📸")
-        return False
-    return True
-
-# -------------------- COMANDOS DEL BOT --------------------
+# -------------------- VIGILANCIA DEL EVENT LOOP Y HEALTHCHECKS --------------------
+# Una tarea en el loop late cada WATCHDOG_INTERVALO_SEG y mide cuánto se atrasa.
+# Un hilo aparte revisa ese latido: si el loop lleva más de WATCHDOG_UMBRAL_SEG sin
+# latir, registra la pila del hilo del loop (sys._current_frames), que muestra la
+# llamada bloqueante culpable. HEALTH_PORT expone:
+#   /healthz -> 200 mientras el loop lata (liveness: si falla, reiniciar)
+#   /readyz  -> 200 si además el bot inició y Google respondió hace poco (readiness)
+# Google se prueba por inquilino, cada uno en su executor: uno caído no tumba a los
+# demás; /readyz falla solo si ninguno responde (el detalle dice cuál falla).
+WATCHDOG_INTERVALO_SEG = float(os.getenv("WATCHDOG_INTERVALO_SEG", "0.5"))
+WATCHDOG_UMBRAL_SEG = float(os.getenv("WATCHDOG_UMBRAL_SEG", "1"))
+HEALTH_PORT = int(os.getenv("HEALTH_PORT", "0"))               # 0 = sin endpoints HTTP
+HEALTH_LAG_MAX_SEG = float(os.getenv("HEALTH_LAG_MAX_SEG", "30"))  # más que esto = loop colgado
+GOOGLE_CHEQUEO_SEG = float(os.getenv("GOOGLE_CHEQUEO_SEG", "60"))
+
+
+class VigilanteLoop:
+    def __init__(self, intervalo: float, umbral: float):
+        self.intervalo = intervalo
+        self.umbral = umbral
+        self.ultimo_latido = time.monotonic()
+        self.lag = 0.0
+        self.lag_max = 0.0
+        self.hilo_loop = None
+        self.google_visto: dict[str, float] = {}   # inquilino -> última respuesta de Google
+        self.google_errores: dict[str, str] = {}   # inquilino -> último error
+        self._parar = threading.Event()
+        self._servidor = None
+
+    async def _latir(self):
+        while True:
+            t0 = time.monotonic()
+            self.ultimo_latido = t0
+            await asyncio.sleep(self.intervalo)
+            self.lag = max(0.0, time.monotonic() - t0 - self.intervalo)
+            self.lag_max = max(self.lag_max, self.lag)
+
+    def atraso(self) -> float:
+        """Segundos desde el último latido, descontando la espera normal."""
+        return max(0.0, time.monotonic() - self.ultimo_latido - self.intervalo)
+
+    def _vigilar(self):
+        trabado_desde = None
+        while not self._parar.wait(self.intervalo):
+            atraso = self.atraso()
+            if atraso > self.umbral and trabado_desde is None:
+                trabado_desde = self.ultimo_latido
+                frame = sys._current_frames().get(self.hilo_loop)
+                pila = "".join(traceback.format_stack(frame)) if frame else "(sin frame)"
+                logger.warning(f"[WARN] Event loop bloqueado {atraso:.1f}s. Pila del loop:\n{pila}")
+            elif atraso <= self.umbral and trabado_desde is not None:
+                logger.warning(f"[WARN] Event loop recuperado tras {time.monotonic() - trabado_desde:.1f}s")
+                trabado_desde = None
+
+    @staticmethod
+    def _probar_google(inq):
+        token = INQUILINO_ACTUAL.set(inq)
+        try:
+            drive_service.files().get(fileId=carpeta_principal(), fields="id", supportsAllDrives=True).execute()
+        finally:
+            INQUILINO_ACTUAL.reset(token)
+
+    def _chequear_google(self):
+        while True:
+            futuros = {inq.nombre: inq.executor.submit(self._probar_google, inq) for inq in INQUILINOS.values()}
+            for nombre, futuro in futuros.items():
+                try:
+                    futuro.result(timeout=GOOGLE_CHEQUEO_SEG)
+                    self.google_visto[nombre] = time.monotonic()
+                    self.google_errores.pop(nombre, None)
+                except Exception as e:
+                    self.google_errores[nombre] = str(e) or type(e).__name__
+                    logger.warning(f"[WARN] Google no responde para {nombre}: {e}")
+            if self._parar.wait(GOOGLE_CHEQUEO_SEG):
+                return
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.effective_chat.id
-    if not chat_permitido(chat_id):
-        return
-    if update.message.chat.type in ['group', 'supergroup']:
-        if not mensaje_es_para_bot(update, context):
+    def estado(self) -> tuple[bool, bool, dict]:
+        atraso = self.atraso()
+        vivo = atraso < HEALTH_LAG_MAX_SEG
+        ahora = time.monotonic()
+        google = {n: ahora - t < 3 * GOOGLE_CHEQUEO_SEG for n, t in self.google_visto.items()}
+        listo = vivo and any(google.values()) and BOT_USERNAME is not None
+        detalle = {
+            "atraso_seg": round(atraso, 3),
+            "lag_seg": round(self.lag, 3),
+            "lag_max_seg": round(self.lag_max, 3),
+            "google_ok": google,
+            "google_error": self.google_errores,
+            "bot": BOT_USERNAME,
+            "carriles": PLANIFICADOR.estado(),
+            "cola_salida": COLA_SALIDA.pendientes(),
+        }
+        return vivo, listo, detalle
+
+    def iniciar(self):
+        self.hilo_loop = threading.get_ident()
+        TAREAS_FONDO.append(asyncio.create_task(self._latir()))
+        threading.Thread(target=self._vigilar, name="vigilante-loop", daemon=True).start()
+        if HEALTH_PORT:
+            threading.Thread(target=self._chequear_google, name="chequeo-google", daemon=True).start()
+            self._servidor = ThreadingHTTPServer(("0.0.0.0", HEALTH_PORT), ManejadorSalud)
+            threading.Thread(target=self._servidor.serve_forever, name="health-http", daemon=True).start()
+            logger.info(f"[DEBUG] /healthz y /readyz en el puerto {HEALTH_PORT}")
+
+    def detener(self):
+        self._parar.set()
+        if self._servidor:
+            self._servidor.shutdown()
+            self._servidor.server_close()
+            self._servidor = None
+
+
+class ManejadorSalud(BaseHTTPRequestHandler):
+    def do_GET(self):
+        vivo, listo, detalle = VIGILANTE.estado()
+        if self.path == "/healthz":
+            ok = vivo
+        elif self.path == "/readyz":
+            ok = listo
+        else:
+            self.send_error(404)
             return
+        cuerpo = json.dumps(detalle).encode()
+        self.send_response(200 if ok else 503)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def log_message(self, format, *args):
+        pass  # las sondas del orquestador llenarían el log
+
+
+VIGILANTE = VigilanteLoop(WATCHDOG_INTERVALO_SEG, WATCHDOG_UMBRAL_SEG)
+
+# -------------------- COLA DE SALIDA (límites de Telegram) --------------------
+# Telegram permite ~30 mensajes/s en total y ~20 mensajes/min por grupo. Todo lo
+# que el bot envía pasa por esta cola: respeta ambos límites, atiende primero los
+# query.answer() y las ediciones de confirmación, reintenta tras RetryAfter y
+# fusiona ediciones seguidas del mismo mensaje (solo se envía la última).
+TG_GLOBAL_POR_SEG = float(os.getenv("TG_GLOBAL_POR_SEG", "30"))
+TG_GRUPO_POR_MIN = float(os.getenv("TG_GRUPO_POR_MIN", "20"))
+TG_RAFAGA_GRUPO = float(os.getenv("TG_RAFAGA_GRUPO", "5"))
+TG_MAX_REINTENTOS = int(os.getenv("TG_MAX_REINTENTOS", "3"))
+
+PRIORIDAD_ALTA = 0    # query.answer() y ediciones de confirmación
+PRIORIDAD_NORMAL = 1  # respuestas a comandos/fotos
+PRIORIDAD_BAJA = 2    # recordatorios y difusiones
+
+
+class CubetaTokens:
+    """Token bucket: `tasa` tokens por segundo, como mucho `capacidad` acumulados."""
+
+    def __init__(self, tasa: float, capacidad: float):
+        self.tasa = tasa
+        self.capacidad = capacidad
+        self.tokens = capacidad
+        self.t = time.monotonic()
+        self.bloqueado_hasta = 0.0
+
+    def espera(self, ahora: float) -> float:
+        """Segundos que faltan para poder tomar un token (0 si ya se puede)."""
+        self.tokens = min(self.capacidad, self.tokens + (ahora - self.t) * self.tasa)
+        self.t = ahora
+        falta = (1 - self.tokens) / self.tasa if self.tokens < 1 else 0.0
+        return max(falta, self.bloqueado_hasta - ahora)
+
+    def tomar(self):
+        self.tokens -= 1
+
+    def bloquear(self, segundos: float):
+        self.bloqueado_hasta = max(self.bloqueado_hasta, time.monotonic() + segundos)
+
+
+class Envio:
+    __slots__ = ("prioridad", "seq", "chat_id", "fn", "futuros", "clave", "intentos")
+
+    def __init__(self, prioridad, seq, chat_id, fn, futuro, clave):
+        self.prioridad = prioridad
+        self.seq = seq
+        self.chat_id = chat_id  # None = no consume cupo del chat (p.ej. query.answer)
+        self.fn = fn            # callable sin argumentos que devuelve la corrutina de envío
+        self.futuros = [futuro]
+        self.clave = clave
+        self.intentos = 0
+
+    def __lt__(self, otro):
+        return (self.prioridad, self.seq) < (otro.prioridad, otro.seq)
+
+
+class ColaSalida:
+    def __init__(self, global_por_seg: float, grupo_por_min: float, rafaga_grupo: float):
+        self._heap: list[Envio] = []
+        self._seq = itertools.count()
+        self._por_clave: dict[tuple, Envio] = {}
+        self._global = CubetaTokens(global_por_seg, global_por_seg)
+        self._grupo_por_seg = grupo_por_min / 60.0
+        self._rafaga_grupo = rafaga_grupo
+        self._chats: dict[int, CubetaTokens] = {}
+        self._en_vuelo: set[int] = set()  # un envío a la vez por chat, para no desordenar
+        self._hay_trabajo = None
+        self._tarea = None
+
+    def iniciar(self):
+        self._hay_trabajo = asyncio.Event()
+        self._tarea = asyncio.create_task(self._trabajar())
+
+    async def detener(self):
+        if self._tarea:
+            self._tarea.cancel()
+            try:
+                await self._tarea
+            except asyncio.CancelledError:
+                pass
+            self._tarea = None
+
+    def pendientes(self) -> int:
+        return len(self._heap)
+
+    def _cubeta_chat(self, chat_id: int) -> CubetaTokens:
+        cubeta = self._chats.get(chat_id)
+        if cubeta is None:
+            cubeta = self._chats[chat_id] = CubetaTokens(self._grupo_por_seg, self._rafaga_grupo)
+        return cubeta
+
+    def encolar(self, chat_id, fn, prioridad: int = PRIORIDAD_NORMAL, clave=None) -> asyncio.Future:
+        """
+        Encola un envío y devuelve un future con el resultado (p.ej. el Message).
+        Si ya hay un envío pendiente con la misma `clave`, se reemplaza por este.
+        """
+        if self._tarea is None:
+            # Cola no iniciada (arranque/apagado): envío directo
+            return asyncio.ensure_future(fn())
+
+        futuro = asyncio.get_running_loop().create_future()
+        if clave is not None:
+            previo = self._por_clave.get(clave)
+            if previo is not None:
+                previo.fn = fn
+                previo.futuros.append(futuro)
+                return futuro
+
+        envio = Envio(prioridad, next(self._seq), chat_id, fn, futuro, clave)
+        heapq.heappush(self._heap, envio)
+        if clave is not None:
+            self._por_clave[clave] = envio
+        self._hay_trabajo.set()
+        return futuro
+
+    def _siguiente(self, ahora: float):
+        """Saca el envío más prioritario cuyo chat tenga cupo. Devuelve (envio, espera)."""
+        saltados = []
+        elegido = None
+        espera = None
+        while self._heap:
+            envio = heapq.heappop(self._heap)
+            if envio.chat_id is None:
+                elegido = envio
+                break
+            if envio.chat_id in self._en_vuelo:
+                saltados.append(envio)
+                continue
+            e = self._cubeta_chat(envio.chat_id).espera(ahora)
+            if e <= 0:
+                elegido = envio
+                break
+            espera = e if espera is None else min(espera, e)
+            saltados.append(envio)
+        for envio in saltados:
+            heapq.heappush(self._heap, envio)
+        return elegido, espera
+
+    async def _trabajar(self):
+        while True:
+            self._hay_trabajo.clear()
+            ahora = time.monotonic()
+            espera = self._global.espera(ahora) if self._heap else None
+
+            if espera is not None and espera <= 0:
+                envio, espera = self._siguiente(ahora)
+                if envio is not None:
+                    self._global.tomar()
+                    if envio.chat_id is not None:
+                        self._cubeta_chat(envio.chat_id).tomar()
+                        self._en_vuelo.add(envio.chat_id)
+                    if envio.clave is not None:
+                        self._por_clave.pop(envio.clave, None)
+                    asyncio.create_task(self._ejecutar(envio))
+                    continue
+
+            try:
+                await asyncio.wait_for(self._hay_trabajo.wait(), timeout=espera)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _ejecutar(self, envio: Envio):
+        try:
+            resultado = await envio.fn()
+        except RetryAfter as e:
+            ra = e.retry_after
+            segundos = ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)
+            envio.intentos += 1
+            if envio.chat_id is not None:
+                self._cubeta_chat(envio.chat_id).bloquear(segundos)
+            else:
+                self._global.bloquear(segundos)
+            logger.warning(f"[WARN] RetryAfter {segundos}s chat={envio.chat_id} (intento {envio.intentos})")
+            if envio.intentos > TG_MAX_REINTENTOS:
+                self._resolver(envio, error=e)
+            elif envio.clave is not None and envio.clave in self._por_clave:
+                # Mientras se enviaba se encoló una versión más nueva: esa reemplaza a esta
+                self._por_clave[envio.clave].futuros.extend(envio.futuros)
+            else:
+                heapq.heappush(self._heap, envio)  # conserva su seq: no pierde el turno
+                if envio.clave is not None:
+                    self._por_clave[envio.clave] = envio  # las ediciones siguientes se fusionan con esta
+        except Exception as e:
+            self._resolver(envio, error=e)
+        else:
+            self._resolver(envio, resultado=resultado)
+        finally:
+            self._en_vuelo.discard(envio.chat_id)
+            self._hay_trabajo.set()
+
+    @staticmethod
+    def _resolver(envio: Envio, resultado=None, error=None):
+        for futuro in envio.futuros:
+            if futuro.done():
+                continue
+            if error is not None:
+                futuro.set_exception(error)
+            else:
+                futuro.set_result(resultado)
 
-    await update.message.reply_text(
-        "👋 ¡Hola! Para iniciar, usa el comando /ingreso y etiquetame 💪💪."
-    )
 
-async def ingreso(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.effective_chat.id  # <-- Definir aquí
-    if not chat_permitido(chat_id):
-        return
-    if update.message.chat.type in ['group', 'supergroup']:
-        if not mensaje_es_para_bot(update, context):
-            return
+COLA_SALIDA = ColaSalida(TG_GLOBAL_POR_SEG, TG_GRUPO_POR_MIN, TG_RAFAGA_GRUPO)
 
-    chat_id = update.effective_chat.id
-    user_data[chat_id] = {"paso": 0}  # 👈 Reinicia el flujo al paso 0
+def responder(message, text: str, prioridad: int = PRIORIDAD_NORMAL, **kwargs) -> asyncio.Future:
+    """Equivalente a message.reply_text(...) pasando por la cola de salida."""
+    return COLA_SALIDA.encolar(message.chat_id, lambda: message.reply_text(text, **kwargs), prioridad)
 
-    await update.message.reply_text(
-        "✍️ Escribe el nombre de tu cuadrilla\n\n"
-        "Ejemplo:\nT1: Juan Pérez\nT2: José Flores"
+def editar(query, text: str, prioridad: int = PRIORIDAD_ALTA, **kwargs) -> asyncio.Future:
+    """Equivalente a query.edit_message_text(...); ediciones seguidas del mismo mensaje se fusionan."""
+    msg = query.message
+    return COLA_SALIDA.encolar(
+        msg.chat_id,
+        lambda: query.edit_message_text(text, **kwargs),
+        prioridad,
+        clave=("editar", msg.chat_id, msg.message_id),
     )
 
-# -------------------- NOMBRE CUADRILLA --------------------
-async def nombre_cuadrilla(update: Update, context: ContextTypes.DEFAULT_TYPE):
+def contestar(query, text: str | None = None) -> asyncio.Future:
+    """Equivalente a query.answer(...): máxima prioridad y no consume el cupo del grupo."""
+    if query.id in CALLBACKS_CONTESTADOS:  # ya lo contestó el planificador (carril lento)
+        CALLBACKS_CONTESTADOS.discard(query.id)
+        if text:
+            logger.info(f"[DEBUG] callback {query.data} ya contestado; se omite: {text}")
+        hecho = asyncio.get_running_loop().create_future()
+        hecho.set_result(None)
+        return hecho
+    return COLA_SALIDA.encolar(None, lambda: query.answer(text), PRIORIDAD_ALTA)
+
+def enviar(bot, chat_id: int, text: str, prioridad: int = PRIORIDAD_NORMAL, **kwargs) -> asyncio.Future:
+    """Equivalente a bot.send_message(chat_id=..., text=...)."""
+    return COLA_SALIDA.encolar(chat_id, lambda: bot.send_message(chat_id=chat_id, text=text, **kwargs), prioridad)
+
+def enviar_documento(bot, chat_id: int, documento, prioridad: int = PRIORIDAD_NORMAL, **kwargs) -> asyncio.Future:
+    """Equivalente a bot.send_document(...). `documento` puede ser un InputFile o un file_id ya subido."""
+    return COLA_SALIDA.encolar(chat_id, lambda: bot.send_document(chat_id=chat_id, document=documento, **kwargs), prioridad)
+
+# -------------------- CARRILES DE PRIORIDAD (procesamiento de updates) --------------------
+# Con concurrent_updates cada update corre en su propia tarea, pero antes de
+# procesarlo espera turno en un carril según lo que hace:
+#   - "rapido": texto, comandos y botones que solo responden.
+#   - "lento":  fotos, ubicaciones, y comandos y botones que escriben en Google
+#               (/breakout..., confirmar_nombre, ats_no, finalizar_salida...).
+# Los botones del carril lento se contestan (query.answer) antes de esperar turno,
+# así el cliente no queda con el reloj girando durante la ráfaga.
+# Cada carril tiene su tope de updates en curso: la ráfaga de fotos de las 7–8 AM
+# llena el carril lento y los botones de otros chats siguen pasando por el rápido.
+# Dentro de un mismo chat se conserva el orden con un lock por chat (la máquina de
+# estados no admite dos pasos a la vez). Las métricas salen en /healthz y /readyz.
+CARRIL_RAPIDO = "rapido"
+CARRIL_LENTO = "lento"
+CARRIL_RAPIDO_MAX = int(os.getenv("CARRIL_RAPIDO_MAX", "32"))
+CARRIL_LENTO_MAX = int(os.getenv("CARRIL_LENTO_MAX", str(GOOGLE_POOL_SIZE)))
+# Updates admitidos a la vez por PTB (esperando turno o en curso); el límite real lo ponen los carriles
+UPDATES_EN_VUELO_MAX = int(os.getenv("UPDATES_EN_VUELO_MAX", "1024"))
+COMANDOS_LENTOS = {"breakout", "breakin", "salida", "exportar"}
+CALLBACKS_LENTOS = {"confirmar_nombre", "tipo_ordenamiento", "tipo_etiquetado", "ats_no",
+                    "finalizar_salida", "continuar_sin_sede"}
+# id de los callback_query ya contestados por el planificador (contestar no repite)
+CALLBACKS_CONTESTADOS: set[str] = set()
+
+
+class Carril:
+    def __init__(self, nombre: str, maximo: int):
+        self.nombre = nombre
+        self.maximo = maximo
+        self._cupos = asyncio.Semaphore(maximo)
+        self.en_espera = 0
+        self.en_curso = 0
+        self.pico_espera = 0
+        self.procesados = 0
+        self.espera_max = 0.0
+        self._espera_total = 0.0
+
+    @contextlib.asynccontextmanager
+    async def turno(self, lock: asyncio.Lock | None = None):
+        """Espera el lock del chat (si se da) y luego un cupo del carril; mide la espera."""
+        t0 = time.monotonic()
+        self.en_espera += 1
+        self.pico_espera = max(self.pico_espera, self.en_espera)
+        async with contextlib.AsyncExitStack() as pila:
+            try:
+                if lock is not None:
+                    await pila.enter_async_context(lock)
+                await pila.enter_async_context(self._cupos)
+            finally:
+                self.en_espera -= 1
+            espera = time.monotonic() - t0
+            self._espera_total += espera
+            self.espera_max = max(self.espera_max, espera)
+            self.en_curso += 1
+            try:
+                yield
+            finally:
+                self.en_curso -= 1
+                self.procesados += 1
+
+    def estado(self) -> dict:
+        return {
+            "max": self.maximo,
+            "en_espera": self.en_espera,
+            "en_curso": self.en_curso,
+            "pico_espera": self.pico_espera,
+            "procesados": self.procesados,
+            "espera_media_ms": round(1000 * self._espera_total / self.procesados, 1) if self.procesados else 0.0,
+            "espera_max_ms": round(1000 * self.espera_max, 1),
+        }
+
+
+class PlanificadorUpdates:
+    def __init__(self, limites: dict[str, int]):
+        self.carriles = {nombre: Carril(nombre, maximo) for nombre, maximo in limites.items()}
+        self._locks: dict[int, asyncio.Lock] = {}
+        self._usos = collections.Counter()  # updates que usan el lock de cada chat
+
+    @staticmethod
+    def carril_de(update: object) -> str:
+        if not isinstance(update, Update):
+            return CARRIL_RAPIDO
+        if update.callback_query:
+            return CARRIL_LENTO if update.callback_query.data in CALLBACKS_LENTOS else CARRIL_RAPIDO
+        msg = update.message or update.edited_message
+        if msg is None:
+            return CARRIL_RAPIDO
+        if msg.photo or msg.location:
+            return CARRIL_LENTO
+        texto = (msg.text or "").strip()
+        if texto.startswith("/"):
+            comando = texto[1:].split(maxsplit=1)[0].split("@")[0].lower() if len(texto) > 1 else ""
+            if comando in COMANDOS_LENTOS:
+                return CARRIL_LENTO
+        return CARRIL_RAPIDO
+
+    async def procesar(self, update: object, fn):
+        """Corre fn() (el procesamiento del update) en su carril y en orden dentro de su chat."""
+        if isinstance(update, Update) and not update_permitido(update):
+            return  # chat no permitido: ni se contesta ni ocupa cupo de carril o lock de chat
+        carril = self.carriles[self.carril_de(update)]
+        chat = update.effective_chat if isinstance(update, Update) else None
+        query = update.callback_query if isinstance(update, Update) else None
+        if (query and carril.nombre == CARRIL_LENTO and chat is not None
+                and (REPLICAS is None or REPLICAS.anillo.dueno(chat.id) == REPLICAS.id)):
+            # Con réplicas contesta solo la dueña del chat (la que lo procesa)
+            CALLBACKS_CONTESTADOS.add(query.id)
+            await contestar(query)
+        if chat is None:
+            async with carril.turno():
+                return await fn()
+
+        lock = self._locks.get(chat.id)
+        if lock is None:
+            lock = self._locks[chat.id] = asyncio.Lock()
+        self._usos[chat.id] += 1
+        try:
+            async with carril.turno(lock):
+                return await fn()
+        finally:
+            if query:
+                CALLBACKS_CONTESTADOS.discard(query.id)  # p.ej. si un filtro lo descartó
+            self._usos[chat.id] -= 1
+            if not self._usos[chat.id]:
+                del self._usos[chat.id]
+                del self._locks[chat.id]
+
+    def estado(self) -> dict:
+        return {nombre: c.estado() for nombre, c in self.carriles.items()}
+
+
+PLANIFICADOR = PlanificadorUpdates({CARRIL_RAPIDO: CARRIL_RAPIDO_MAX, CARRIL_LENTO: CARRIL_LENTO_MAX})
+
+
+class AplicacionConCarriles(Application):
+    """Application que pasa cada update por PLANIFICADOR (también los reenviados entre réplicas)."""
+
+    async def process_update(self, update: object) -> None:
+        procesar = super().process_update
+        await PLANIFICADOR.procesar(update, lambda: procesar(update))
+
+# -------------------- MULTI-INQUILINO --------------------
+# Un proceso puede atender a varios contratistas. INQUILINOS_FILE asigna grupos a
+# inquilinos, cada uno con su unidad compartida, carpeta y credenciales:
+#   {"contratista_b": {"drive_id": "0A...", "carpeta": "ASISTENCIA_BOT",
+#                      "credenciales_env": "GOOGLE_CREDENTIALS_JSON_B",
+#                      "chats": [-100123], "pool": 4, "hilos": 4, "llamadas_por_min": 240}}
+# Cada inquilino tiene sus propios clientes y conexiones, su cupo de llamadas por
+# minuto y su executor: si uno satura su cuota o sus hilos, los demás no esperan.
+# El inquilino "principal" (DRIVE_ID, NOMBRE_CARPETA_DRIVE, GOOGLE_CREDENTIALS_JSON)
+# atiende a los chats que no estén asignados a otro.
+INQUILINOS_FILE = os.getenv("INQUILINOS_FILE", "inquilinos.json")
+GOOGLE_HILOS = int(os.getenv("GOOGLE_HILOS", str(GOOGLE_POOL_SIZE)))
+GOOGLE_LLAMADAS_POR_MIN = float(os.getenv("GOOGLE_LLAMADAS_POR_MIN", "300"))
+
+
+class CuotaGoogle:
+    """Token bucket thread-safe: las llamadas de un inquilino esperan su turno."""
+
+    def __init__(self, por_min: float):
+        self._cubeta = CubetaTokens(por_min / 60, max(1.0, por_min / 6))
+        self._lock = threading.Lock()
+
+    def esperar(self):
+        while True:
+            with self._lock:
+                espera = self._cubeta.espera(time.monotonic())
+                if espera <= 0:
+                    self._cubeta.tomar()
+                    return
+            time.sleep(espera)
+
+
+class Inquilino:
+    def __init__(self, nombre: str, drive_id: str, carpeta: str, credenciales_json: str,
+                 chats=(), pool: int = GOOGLE_POOL_SIZE, hilos: int = GOOGLE_HILOS,
+                 llamadas_por_min: float = GOOGLE_LLAMADAS_POR_MIN):
+        self.nombre = nombre
+        self.drive_id = drive_id
+        self.carpeta = carpeta
+        self.chats = set(chats)
+        self.cuota = CuotaGoogle(llamadas_por_min)
+        self.drive, self.sheets = get_services(credenciales_json, pool, self.cuota)
+        self.executor = ThreadPoolExecutor(max_workers=hilos, thread_name_prefix=f"google-{nombre}")
+        self._carpeta_id = None
+        self._lock = threading.Lock()
+
+    @property
+    def carpeta_id(self) -> str:
+        if self._carpeta_id is None:
+            with self._lock:
+                if self._carpeta_id is None:
+                    token = INQUILINO_ACTUAL.set(self)
+                    try:
+                        self._carpeta_id = get_or_create_main_folder(self.drive_id, self.carpeta)
+                    finally:
+                        INQUILINO_ACTUAL.reset(token)
+        return self._carpeta_id
+
+
+def cargar_inquilinos() -> dict[str, Inquilino]:
+    inquilinos = {"principal": Inquilino("principal", DRIVE_ID, NOMBRE_CARPETA_DRIVE, CREDENTIALS_JSON)}
     try:
-        logger.info("[DEBUG] Entrando en nombre_cuadrilla...")
-        if not mensaje_es_para_bot(update, context):
-            logger.info("[DEBUG] mensaje_es_para_bot devolvió False.")
-            return
+        with open(INQUILINOS_FILE, encoding="utf-8") as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        return inquilinos
+    for nombre, c in config.items():
+        credenciales = os.environ[c["credenciales_env"]] if "credenciales_env" in c else json.dumps(c["credenciales"])
+        inquilinos[nombre] = Inquilino(
+            nombre, c["drive_id"], c.get("carpeta", NOMBRE_CARPETA_DRIVE), credenciales,
+            chats=c.get("chats", ()),
+            pool=int(c.get("pool", GOOGLE_POOL_SIZE)),
+            hilos=int(c.get("hilos", GOOGLE_HILOS)),
+            llamadas_por_min=float(c.get("llamadas_por_min", GOOGLE_LLAMADAS_POR_MIN)),
+        )
+    logger.info(f"[DEBUG] Inquilinos: {sorted(inquilinos)}")
+    return inquilinos
 
-        chat_id = update.effective_chat.id
-        logger.info(f"[DEBUG] chat_id = {chat_id}")
 
-        if chat_id not in user_data:
-            user_data[chat_id] = {"paso": 0}
-            logger.info(f"[DEBUG] user_data[{chat_id}] inicializado en 0")
+INQUILINOS = cargar_inquilinos()
+INQUILINO_PRINCIPAL = INQUILINOS["principal"]
+INQUILINO_POR_CHAT = {chat: inq for inq in INQUILINOS.values() for chat in inq.chats}
+INQUILINO_ACTUAL = contextvars.ContextVar("inquilino")
 
-        if user_data[chat_id].get("paso") != 0:
-            logger.info(f"[DEBUG] Paso no es 0. Paso actual: {user_data[chat_id].get('paso')}")
-            return
+def inquilino_actual() -> Inquilino:
+    return INQUILINO_ACTUAL.get(INQUILINO_PRINCIPAL)
 
-        if not await validar_contenido(update, "texto"):
-            logger.info("[DEBUG] validar_contenido devolvió False.")
-            return
+def inquilino_de_chat(chat_id: int) -> Inquilino:
+    return INQUILINO_POR_CHAT.get(chat_id, INQUILINO_PRINCIPAL)
 
-        user_data[chat_id]["cuadrilla"] = update.message.text.strip()
-        logger.info(f"[DEBUG] Cuadrilla recibida: {user_data[chat_id]['cuadrilla']}")
+def para_cada_inquilino(fn, *args) -> dict:
+    """Corre fn(*args) una vez por inquilino, cada vez con sus clientes y carpeta."""
+    resultados = {}
+    for inq in INQUILINOS.values():
+        token = INQUILINO_ACTUAL.set(inq)
+        try:
+            resultados[inq.nombre] = fn(*args)
+        finally:
+            INQUILINO_ACTUAL.reset(token)
+    return resultados
 
-        keyboard = [
-            [InlineKeyboardButton("✅ Confirma el nombre de tu cuadrilla", callback_data="confirmar_nombre")],
-            [InlineKeyboardButton("✏️ Corregir nombre", callback_data="corregir_nombre")],
-        ]
-        await update.message.reply_text(
-            f"Has ingresado la cuadrilla:\n*{user_data[chat_id]['cuadrilla']}*\n\n¿Es correcto?",
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard),
+async def en_cada_inquilino(fn, *args) -> dict:
+    """
+    Como para_cada_inquilino, pero cada inquilino corre en su propio executor (vía
+    google_io) y sus errores se registran aparte: uno que falla no frena a los demás.
+    Devuelve los resultados de los que terminaron bien.
+    """
+    async def uno(inq: Inquilino):
+        INQUILINO_ACTUAL.set(inq)  # cada corrutina es su propia tarea: no afecta a las demás
+        return await google_io(fn, *args)
+
+    inquilinos = list(INQUILINOS.values())
+    resultados = await asyncio.gather(*(uno(inq) for inq in inquilinos), return_exceptions=True)
+    correctos = {}
+    for inq, r in zip(inquilinos, resultados):
+        if isinstance(r, Exception):
+            logger.error(f"[ERROR] {fn.__name__} ({inq.nombre}): {r}")
+        else:
+            correctos[inq.nombre] = r
+    return correctos
+
+async def asignar_inquilino(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Grupo -4: fija el inquilino del chat para todo el procesamiento del update."""
+    chat = update.effective_chat
+    INQUILINO_ACTUAL.set(inquilino_de_chat(chat.id) if chat else INQUILINO_PRINCIPAL)
+
+# -------------------- MULTI-RÉPLICA (sharding por chat) --------------------
+# Con MODO_REPLICAS=1 varias réplicas comparten el trabajo:
+#   - Una sola réplica (la líder, por lease en el KV) hace polling a Telegram.
+#   - Cada chat tiene un dueño según un anillo de hashing consistente sobre las
+#     réplicas vivas; la líder (o cualquiera) reenvía el update a la cola del dueño.
+#   - La sesión (user_data[chat_id]) vive en el KV: el dueño la carga antes de
+#     procesar y la guarda al terminar, con un lock por chat durante el proceso.
+#   - Si una réplica muere, sus colas (pendientes y en proceso) se reparten según
+#     el anillo nuevo. Un update en proceso puede reejecutarse (at-least-once).
+# Backends del KV (KV_BACKEND):
+#   - "local": un dict en memoria (AlmacenKVLocal). Solo ve las réplicas del mismo
+#     proceso, o sea una: sirve para pruebas, no para repartir carga.
+#   - "sqlite": un archivo SQLite (KV_SQLITE_DB) en un volumen que comparten los
+#     procesos de un mismo host. Sin avisos entre procesos: las colas se sondean con
+#     espera creciente. SQLite no es fiable sobre NFS/SMB, así que no sirve entre hosts;
+#     para eso hace falta un backend en red (Redis, etc.) con la misma interfaz AlmacenKV.
+MODO_REPLICAS = os.getenv("MODO_REPLICAS", "0") == "1"
+REPLICA_ID = os.getenv("REPLICA_ID") or f"{socket.gethostname()}-{os.getpid()}"
+KV_BACKEND = os.getenv("KV_BACKEND", "local")
+KV_SQLITE_DB = os.getenv("KV_SQLITE_DB", "replicas.sqlite3")
+REPLICA_LATIDO_SEG = float(os.getenv("REPLICA_LATIDO_SEG", "5"))
+REPLICA_TTL_SEG = float(os.getenv("REPLICA_TTL_SEG", "15"))      # sin latido en este tiempo = muerta
+LIDER_LEASE_SEG = float(os.getenv("LIDER_LEASE_SEG", "15"))
+LOCK_CHAT_SEG = float(os.getenv("LOCK_CHAT_SEG", "60"))          # por si una réplica muere con el lock
+REPLICA_ESPERA_COLA_SEG = float(os.getenv("REPLICA_ESPERA_COLA_SEG", "1"))  # espera bloqueante por update reenviado
+
+
+class AlmacenKV(abc.ABC):
+    """Interfaz mínima del almacén compartido (valores str, TTL en segundos)."""
+
+    @abc.abstractmethod
+    def get(self, clave: str) -> str | None: ...
+    @abc.abstractmethod
+    def set(self, clave: str, valor: str, ttl: float | None = None): ...
+    @abc.abstractmethod
+    def delete(self, clave: str): ...
+    @abc.abstractmethod
+    def set_si_no_existe(self, clave: str, valor: str, ttl: float | None = None) -> bool: ...
+    @abc.abstractmethod
+    def cas(self, clave: str, esperado: str, nuevo: str | None, ttl: float | None = None) -> bool: ...
+    @abc.abstractmethod
+    def claves(self, prefijo: str) -> list[str]: ...
+    @abc.abstractmethod
+    def push(self, lista: str, valor: str): ...
+    @abc.abstractmethod
+    def mover(self, origen: str, destino: str, espera: float = 0) -> str | None:
+        """Pasa el primero de `origen` al final de `destino`; con `espera` bloquea hasta ese tiempo (como BLMOVE)."""
+    @abc.abstractmethod
+    def quitar(self, lista: str, valor: str): ...
+    @abc.abstractmethod
+    def vaciar(self, lista: str) -> list[str]: ...
+
+
+class AlmacenKVLocal(AlmacenKV):
+    """Implementación en memoria, thread-safe. Sirve para una sola réplica o para pruebas."""
+
+    def __init__(self):
+        self._lock = threading.Condition()  # push despierta a los mover() en espera
+        self._valores: dict[str, tuple[str, float | None]] = {}
+        self._listas: dict[str, collections.deque] = {}
+
+    def _vivo(self, clave):
+        item = self._valores.get(clave)
+        if item is None:
+            return None
+        valor, vence = item
+        if vence is not None and vence <= time.monotonic():
+            del self._valores[clave]
+            return None
+        return valor
+
+    @staticmethod
+    def _vence(ttl):
+        return time.monotonic() + ttl if ttl else None
+
+    def get(self, clave):
+        with self._lock:
+            return self._vivo(clave)
+
+    def set(self, clave, valor, ttl=None):
+        with self._lock:
+            self._valores[clave] = (valor, self._vence(ttl))
+
+    def delete(self, clave):
+        with self._lock:
+            self._valores.pop(clave, None)
+
+    def set_si_no_existe(self, clave, valor, ttl=None):
+        with self._lock:
+            if self._vivo(clave) is not None:
+                return False
+            self._valores[clave] = (valor, self._vence(ttl))
+            return True
+
+    def cas(self, clave, esperado, nuevo, ttl=None):
+        with self._lock:
+            if self._vivo(clave) != esperado:
+                return False
+            if nuevo is None:
+                self._valores.pop(clave, None)
+            else:
+                self._valores[clave] = (nuevo, self._vence(ttl))
+            return True
+
+    def claves(self, prefijo):
+        with self._lock:
+            vivas = [c for c in self._valores if c.startswith(prefijo) and self._vivo(c) is not None]
+            return vivas + [c for c, l in self._listas.items() if c.startswith(prefijo) and l]
+
+    def push(self, lista, valor):
+        with self._lock:
+            self._listas.setdefault(lista, collections.deque()).append(valor)
+            self._lock.notify_all()
+
+    def mover(self, origen, destino, espera=0):
+        with self._lock:
+            if not self._lock.wait_for(lambda: self._listas.get(origen), timeout=espera):
+                return None
+            cola = self._listas[origen]
+            valor = cola.popleft()
+            self._listas.setdefault(destino, collections.deque()).append(valor)
+            return valor
+
+    def quitar(self, lista, valor):
+        with self._lock:
+            try:
+                self._listas.get(lista, collections.deque()).remove(valor)
+            except ValueError:
+                pass
+
+    def vaciar(self, lista):
+        with self._lock:
+            cola = self._listas.pop(lista, None)
+            return list(cola) if cola else []
+
+
+class AlmacenKVSQLite(AlmacenKV):
+    """
+    KV en un archivo SQLite compartido por varios procesos del mismo host. Cada
+    operación es una sentencia o una transacción IMMEDIATE; los vencimientos usan la
+    hora de pared (time.monotonic no se comparte entre procesos).
+    """
+
+    def __init__(self, ruta: str):
+        self._lock = threading.Lock()
+        self._ultima_purga = 0.0
+        self._db = sqlite3.connect(ruta, check_same_thread=False, isolation_level=None, timeout=10)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS valores (clave TEXT PRIMARY KEY, valor TEXT, vence REAL)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS listas (id INTEGER PRIMARY KEY AUTOINCREMENT, lista TEXT, valor TEXT)"
         )
-        logger.info("[DEBUG] Botones enviados correctamente.")
-    except Exception as e:
-        logger.error(f"[ERROR] nombre_cuadrilla: {e}")
-        await update.message.reply_text("❌ Error interno al procesar el nombre de cuadrilla.")
+        self._db.execute("CREATE INDEX IF NOT EXISTS listas_lista ON listas (lista, id)")
+
+    @contextlib.contextmanager
+    def _transaccion(self):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    @staticmethod
+    def _vence(ttl):
+        return time.time() + ttl if ttl else None
+
+    def get(self, clave):
+        with self._lock:
+            fila = self._db.execute(
+                "SELECT valor FROM valores WHERE clave = ? AND (vence IS NULL OR vence > ?)",
+                (clave, time.time()),
+            ).fetchone()
+        return fila[0] if fila else None
+
+    def set(self, clave, valor, ttl=None):
+        ahora = time.time()
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO valores VALUES (?, ?, ?)", (clave, valor, self._vence(ttl)))
+            if ahora - self._ultima_purga > 600:
+                self._ultima_purga = ahora
+                self._db.execute("DELETE FROM valores WHERE vence <= ?", (ahora,))
+
+    def delete(self, clave):
+        with self._lock:
+            self._db.execute("DELETE FROM valores WHERE clave = ?", (clave,))
+
+    def set_si_no_existe(self, clave, valor, ttl=None):
+        with self._lock:
+            cur = self._db.execute(
+                "INSERT INTO valores VALUES (?, ?, ?) "
+                "ON CONFLICT (clave) DO UPDATE SET valor = excluded.valor, vence = excluded.vence "
+                "WHERE valores.vence IS NOT NULL AND valores.vence <= ?",
+                (clave, valor, self._vence(ttl), time.time()),
+            )
+            return cur.rowcount == 1
 
+    def cas(self, clave, esperado, nuevo, ttl=None):
+        vivo = "clave = ? AND valor = ? AND (vence IS NULL OR vence > ?)"
+        with self._lock:
+            if nuevo is None:
+                cur = self._db.execute(f"DELETE FROM valores WHERE {vivo}", (clave, esperado, time.time()))
+            else:
+                cur = self._db.execute(
+                    f"UPDATE valores SET valor = ?, vence = ? WHERE {vivo}",
+                    (nuevo, self._vence(ttl), clave, esperado, time.time()),
+                )
+            return cur.rowcount == 1
+
+    def claves(self, prefijo):
+        n = len(prefijo)
+        with self._lock:
+            vivas = self._db.execute(
+                "SELECT clave FROM valores WHERE substr(clave, 1, ?) = ? AND (vence IS NULL OR vence > ?)",
+                (n, prefijo, time.time()),
+            ).fetchall()
+            listas = self._db.execute(
+                "SELECT DISTINCT lista FROM listas WHERE substr(lista, 1, ?) = ?", (n, prefijo)
+            ).fetchall()
+        return [c for c, in vivas] + [c for c, in listas]
+
+    def push(self, lista, valor):
+        with self._lock:
+            self._db.execute("INSERT INTO listas (lista, valor) VALUES (?, ?)", (lista, valor))
+
+    def mover(self, origen, destino, espera=0):
+        limite = time.monotonic() + espera
+        pausa = 0.05
+        while True:
+            with self._transaccion() as db:
+                fila = db.execute(
+                    "SELECT id, valor FROM listas WHERE lista = ? ORDER BY id LIMIT 1", (origen,)
+                ).fetchone()
+                if fila:
+                    db.execute("DELETE FROM listas WHERE id = ?", (fila[0],))
+                    db.execute("INSERT INTO listas (lista, valor) VALUES (?, ?)", (destino, fila[1]))
+                    return fila[1]
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                return None
+            time.sleep(min(pausa, restante))  # otro proceso no puede avisar: se sondea con espera creciente
+            pausa = min(pausa * 2, 0.5)
+
+    def quitar(self, lista, valor):
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM listas WHERE id = (SELECT id FROM listas WHERE lista = ? AND valor = ? ORDER BY id LIMIT 1)",
+                (lista, valor),
+            )
 
-# ------------------ HANDLE NOMBRE CUADRILLA ------------------ #
+    def vaciar(self, lista):
+        with self._transaccion() as db:
+            valores = db.execute("SELECT valor FROM listas WHERE lista = ? ORDER BY id", (lista,)).fetchall()
+            db.execute("DELETE FROM listas WHERE lista = ?", (lista,))
+        return [v for v, in valores]
 
-async def handle_nombre_cuadrilla(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        query = update.callback_query
-        if not query:  # No es callback
-            return
 
-        chat_id = query.message.chat.id
-        await query.answer()
+def crear_almacen_kv() -> AlmacenKV:
+    if KV_BACKEND == "local":
+        logger.warning("[WARN] KV_BACKEND=local: el KV vive en este proceso, las réplicas no se reparten entre procesos")
+        return AlmacenKVLocal()
+    if KV_BACKEND == "sqlite":
+        return AlmacenKVSQLite(KV_SQLITE_DB)
+    raise RuntimeError(f"KV_BACKEND no soportado: {KV_BACKEND}")
 
-        logger.info(f"[DEBUG] handle_nombre_cuadrilla -> data={query.data}, state={user_data.get(chat_id)}")
 
-        if query.data == "confirmar_nombre":
-            # Guardas mínimas
-            if chat_id not in user_data or "cuadrilla" not in user_data[chat_id] or not user_data[chat_id]["cuadrilla"].strip():
-                logger.warning(f"[WARN] No hay 'cuadrilla' para chat {chat_id}.")
-                await query.edit_message_text("⚠️ No encontré el nombre de la cuadrilla. Escribe de nuevo y confirma.")
-                user_data.setdefault(chat_id, {})["paso"] = 0
-                return
+class AnilloConsistente:
+    """Hashing consistente con nodos virtuales: al entrar/salir una réplica solo se mueven ~1/N chats."""
 
-            # Idempotencia: si ya existe fila creada, no vuelvas a crear otra
-            if user_data[chat_id].get("spreadsheet_id") and user_data[chat_id].get("row"):
-                logger.info(f"[DEBUG] Fila ya creada (sheet={user_data[chat_id]['spreadsheet_id']}, row={user_data[chat_id]['row']}). Saltando append.")
-            else:
-                # 1) Asegurar Sheet del grupo
-                spreadsheet_id = ensure_spreadsheet_for_group(update)
-                ensure_sheet_and_headers(spreadsheet_id)
-
-                # 2) Crear la fila base y guardar referencia
-                base = {"CUADRILLA": user_data[chat_id]["cuadrilla"], "TIPO DE TRABAJO": ""}
-                fila = append_base_row(spreadsheet_id, base)
-                user_data[chat_id]["spreadsheet_id"] = spreadsheet_id
-                user_data[chat_id]["row"] = fila
-                logger.info(f"[DEBUG] Fila creada -> sheet={spreadsheet_id}, row={fila}, cuadrilla='{base['CUADRILLA']}'")
-
-            # 3) Avanzar de estado
-            user_data[chat_id]["paso"] = "tipo_trabajo"
-            logger.info(f"[DEBUG] Paso -> 'tipo_trabajo' (chat {chat_id})")
-
-            keyboard = [
-                [InlineKeyboardButton("📌 Ordenamiento", callback_data="tipo_ordenamiento")],
-                [InlineKeyboardButton("🏷 Etiquetado", callback_data="tipo_etiquetado")],
-            ]
-            await query.edit_message_text("Selecciona el tipo de trabajo:", reply_markup=InlineKeyboardMarkup(keyboard))
-
-        elif query.data == "corregir_nombre":
-            user_data.setdefault(chat_id, {})
-            user_data[chat_id]["cuadrilla"] = ""
-            user_data[chat_id]["paso"] = 0
-            logger.info(f"[DEBUG] Corrección de cuadrilla. Estado -> {user_data[chat_id]}")
-            await query.edit_message_text(
-                "✍️ *Escribe el nombre de tu cuadrilla*\n\n"
-                "*Ejemplo:*\n"
-                "*T1: Juan Pérez*\n"
-                "*T2: José Flores*\n",
-                parse_mode="Markdown"
-            )
+    def __init__(self, nodos, virtuales: int = 64):
+        self.nodos = tuple(sorted(nodos))
+        puntos = sorted(
+            (self._hash(f"{nodo}#{i}"), nodo) for nodo in self.nodos for i in range(virtuales)
+        )
+        self._hashes = [h for h, _ in puntos]
+        self._nodos = [n for _, n in puntos]
+
+    @staticmethod
+    def _hash(texto: str) -> int:
+        return int.from_bytes(hashlib.md5(texto.encode()).digest()[:8], "big")
+
+    def dueno(self, chat_id: int) -> str | None:
+        if not self._hashes:
+            return None
+        i = bisect.bisect(self._hashes, self._hash(str(chat_id))) % len(self._hashes)
+        return self._nodos[i]
+
+
+class Replicas:
+    def __init__(self, kv: AlmacenKV, replica_id: str):
+        self.kv = kv
+        self.id = replica_id
+        self.anillo = AnilloConsistente([replica_id])
+        self.es_lider = False
+        self._tareas = []
+
+    # --- claves en el KV ---
+    @staticmethod
+    def _cola(replica: str) -> str:
+        return f"cola:{replica}"
+
+    @staticmethod
+    def _procesando(replica: str) -> str:
+        return f"procesando:{replica}"
+
+    # --- membresía y liderazgo ---
+    def _latir(self):
+        self.kv.set(f"replica:{self.id}", str(time.time()), ttl=REPLICA_TTL_SEG)
+        vivas = {c.split(":", 1)[1] for c in self.kv.claves("replica:")}
+        if tuple(sorted(vivas)) != self.anillo.nodos:
+            logger.info(f"[DEBUG] Réplicas vivas: {sorted(vivas)}")
+            self.anillo = AnilloConsistente(vivas)
+        return vivas
+
+    def _renovar_lease(self) -> bool:
+        if self.kv.cas("lider", self.id, self.id, ttl=LIDER_LEASE_SEG):
+            return True
+        return self.kv.set_si_no_existe("lider", self.id, ttl=LIDER_LEASE_SEG)
+
+    def _reasignar_huerfanas(self, vivas: set):
+        """La líder reparte las colas de réplicas muertas según el anillo actual."""
+        for clave in self.kv.claves("cola:") + self.kv.claves("procesando:"):
+            replica = clave.split(":", 1)[1]
+            if replica in vivas:
+                continue
+            items = self.kv.vaciar(clave)
+            for item in items:
+                self.kv.push(self._cola(self.anillo.dueno(json.loads(item)["chat_id"])), item)
+            if items:
+                logger.warning(f"[WARN] Réplica {replica} caída: {len(items)} updates reasignados")
+
+    async def _coordinar(self, app):
+        while True:
+            try:
+                vivas = self._latir()
+                lider = self._renovar_lease()
+                if lider and not self.es_lider:
+                    logger.info(f"[DEBUG] {self.id} es líder: inicia polling")
+                    await app.updater.start_polling()
+                elif not lider and self.es_lider:
+                    logger.warning(f"[WARN] {self.id} perdió el liderazgo: detiene polling")
+                    await app.updater.stop()
+                self.es_lider = lider
+                if lider:
+                    self._reasignar_huerfanas(vivas)
+            except Exception as e:
+                logger.error(f"[ERROR] Coordinación de réplicas: {e}")
+            await asyncio.sleep(REPLICA_LATIDO_SEG)
+
+    # --- consumo de la cola propia ---
+    async def _consumir(self, app):
+        """
+        Cada update reenviado se procesa en su propia tarea, como los del polling: con
+        el mismo tope de updates en vuelo y luego los carriles de process_update.
+        """
+        cola, procesando = self._cola(self.id), self._procesando(self.id)
+        loop = asyncio.get_running_loop()
+        cupo = asyncio.Semaphore(UPDATES_EN_VUELO_MAX)
+        while True:
+            await cupo.acquire()
+            try:
+                # Pop bloqueante en un hilo: sin sondear el KV mientras la cola está vacía
+                item = await loop.run_in_executor(None, self.kv.mover, cola, procesando, REPLICA_ESPERA_COLA_SEG)
+            except BaseException:
+                cupo.release()
+                raise
+            if item is None:
+                cupo.release()
+                continue
+            app.create_task(self._procesar_reenviado(app, item, procesando, cupo))
+
+    async def _procesar_reenviado(self, app, item: str, procesando: str, cupo: asyncio.Semaphore):
+        try:
+            update = Update.de_json(json.loads(item)["update"], app.bot)
+            await app.process_update(update)
+        except Exception as e:
+            logger.error(f"[ERROR] Update reenviado falló: {e}")
+        finally:
+            self.kv.quitar(procesando, item)  # ack
+            cupo.release()
+
+    def reenviar(self, update: Update, replica: str):
+        item = json.dumps({"chat_id": update.effective_chat.id, "update": update.to_dict()})
+        self.kv.push(self._cola(replica), item)
+
+    # --- sesiones ---
+    def cargar_sesion(self, chat_id: int):
+        raw = self.kv.get(f"sesion:{chat_id}")
+        if raw is None:
+            user_data.pop(chat_id, None)
+        else:
+            user_data[chat_id] = json.loads(raw)
 
-    except Exception as e:
-        logger.error(f"[ERROR] handle_nombre_cuadrilla: {e}")
-        # Evita crashear si query no existe por algún motivo
+    def guardar_sesion(self, chat_id: int):
+        ud = user_data.get(chat_id)
+        if ud is None:
+            self.kv.delete(f"sesion:{chat_id}")
+        else:
+            self.kv.set(f"sesion:{chat_id}", json.dumps(ud, ensure_ascii=False))
+
+    def tomar_chat(self, chat_id: int) -> bool:
+        return self.kv.set_si_no_existe(f"lock:{chat_id}", self.id, ttl=LOCK_CHAT_SEG)
+
+    def soltar_chat(self, chat_id: int):
+        self.kv.cas(f"lock:{chat_id}", self.id, None)
+
+    async def actualizar_sesion(self, chat_id: int, fn, intentos: int = 20) -> bool:
+        """
+        Lee-modifica-escribe la sesión compartida con el lock del chat tomado (el mismo
+        de enrutar_replica), así no se pisa con la réplica que la está procesando.
+        fn(ud) devuelve True si la cambió. Si el chat sigue ocupado, no se toca.
+        """
+        for _ in range(intentos):
+            if self.tomar_chat(chat_id):
+                break
+            await asyncio.sleep(0.1)
+        else:
+            logger.info(f"[DEBUG] Sesión {chat_id} ocupada: no se actualizó")
+            return False
         try:
-            await update.callback_query.message.reply_text("❌ Error interno en la confirmación de cuadrilla.")
-        except Exception:
-            pass
+            raw = self.kv.get(f"sesion:{chat_id}")
+            ud = json.loads(raw) if raw else None
+            if ud is None or not fn(ud):
+                return False
+            self.kv.set(f"sesion:{chat_id}", json.dumps(ud, ensure_ascii=False))
+            return True
+        finally:
+            self.soltar_chat(chat_id)
+
+    # --- ciclo de vida ---
+    def iniciar(self, app):
+        # Lo que quedó "en proceso" de una ejecución anterior con el mismo REPLICA_ID
+        for item in self.kv.vaciar(self._procesando(self.id)):
+            self.kv.push(self._cola(self.id), item)
+        self._latir()
+        self._tareas = [
+            asyncio.create_task(self._coordinar(app)),
+            asyncio.create_task(self._consumir(app)),
+        ]
 
+    async def detener(self, app):
+        for t in self._tareas:
+            t.cancel()
+        await asyncio.gather(*self._tareas, return_exceptions=True)
+        if self.es_lider and app.updater.running:
+            await app.updater.stop()
+        self.kv.cas("lider", self.id, None)
+        self.kv.delete(f"replica:{self.id}")
+        self.es_lider = False
 
-# ------------------ HANDLE TIPO TRABAJO ------------------ #
 
-async def handle_tipo_trabajo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+REPLICAS = Replicas(crear_almacen_kv(), REPLICA_ID) if MODO_REPLICAS else None
+
+async def enrutar_replica(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Grupo -2 (solo MODO_REPLICAS): si el chat es de otra réplica lo reenvía a su cola;
+    si es nuestro, toma el lock del chat y carga la sesión compartida.
+    """
+    chat_id = update.effective_chat.id
+    dueno = REPLICAS.anillo.dueno(chat_id)
+    if dueno != REPLICAS.id:
+        REPLICAS.reenviar(update, dueno)
+        raise ApplicationHandlerStop
+
+    for _ in range(20):
+        if REPLICAS.tomar_chat(chat_id):
+            break
+        await asyncio.sleep(0.1)
+    else:
+        # Otra réplica aún procesa este chat (traspaso en curso): reintentar luego
+        REPLICAS.reenviar(update, REPLICAS.id)
+        raise ApplicationHandlerStop
+
+    REPLICAS.cargar_sesion(chat_id)
+    context.chat_data["replica_lock"] = True
+
+async def guardar_sesion_replica(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Último grupo (solo MODO_REPLICAS): guarda la sesión y suelta el lock del chat."""
+    chat_id = update.effective_chat.id
+    if context.chat_data.pop("replica_lock", False):
+        REPLICAS.guardar_sesion(chat_id)
+        REPLICAS.soltar_chat(chat_id)
+
+async def correr_con_replicas(app):
+    """Reemplaza a run_polling en MODO_REPLICAS: el polling lo arranca solo la líder."""
+    parar = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, parar.set)
+
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    REPLICAS.iniciar(app)
+    logger.info(f"[DEBUG] Réplica {REPLICAS.id} en ejecución (backend KV: {KV_BACKEND})")
     try:
-        query = update.callback_query
-        if not query:
+        await parar.wait()
+    finally:
+        await REPLICAS.detener(app)
+        await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+# -------------------- IDEMPOTENCIA --------------------
+# Tabla persistente de "ya procesado" para no repetir escrituras en Google:
+#   - u:<update_id>    updates que Telegram reentrega tras un reinicio
+#   - cq:<callback_id> callbacks ya atendidos
+#   - e:<chat>:<jornada>:<paso>  eventos lógicos (fila base, break, ATS...); sin la
+#     fecha, una jornada que cruza la medianoche conserva sus claves
+# Las claves caducan tras IDEMPOTENCIA_RETENCION_HORAS. En MODO_REPLICAS la tabla
+# vive en el KV compartido; si no, en un SQLite local.
+IDEMPOTENCIA_DB = os.getenv("IDEMPOTENCIA_DB", "idempotencia.sqlite3")
+IDEMPOTENCIA_RETENCION_SEG = float(os.getenv("IDEMPOTENCIA_RETENCION_HORAS", "48")) * 3600
+
+
+class IdempotenciaSQLite:
+    def __init__(self, ruta: str, retencion: float):
+        self._retencion = retencion
+        self._lock = threading.Lock()
+        self._ultima_purga = 0.0
+        self._db = sqlite3.connect(ruta, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS vistos (clave TEXT PRIMARY KEY, valor TEXT, creado REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS vistos_creado ON vistos (creado)")
+
+    def registrar(self, clave: str, valor: str = "1") -> bool:
+        """Marca `clave` como procesada. False si ya estaba (dentro de la retención)."""
+        ahora = time.time()
+        with self._lock:
+            self._purgar(ahora)
+            cur = self._db.execute(
+                "INSERT INTO vistos VALUES (?, ?, ?) "
+                "ON CONFLICT (clave) DO UPDATE SET valor = excluded.valor, creado = excluded.creado "
+                "WHERE vistos.creado < ?",
+                (clave, valor, ahora, ahora - self._retencion),
+            )
+            return cur.rowcount == 1
+
+    def ver(self, clave: str) -> str | None:
+        """Valor guardado para `clave`, o None si no se procesó (o ya caducó)."""
+        with self._lock:
+            fila = self._db.execute(
+                "SELECT valor FROM vistos WHERE clave = ? AND creado >= ?",
+                (clave, time.time() - self._retencion),
+            ).fetchone()
+        return fila[0] if fila else None
+
+    def _purgar(self, ahora: float):
+        if ahora - self._ultima_purga < 600:
             return
-        await query.answer()
+        self._ultima_purga = ahora
+        self._db.execute("DELETE FROM vistos WHERE creado < ?", (ahora - self._retencion,))
 
-        chat_id = query.message.chat.id
-        data = query.data
-        if data not in ("tipo_ordenamiento", "tipo_etiquetado"):
-            logger.warning(f"[DEBUG] handle_tipo_trabajo: callback inesperado: {data}")
-            return
 
-        # 1) Determinar el tipo
-        tipo = "Ordenamiento" if data == "tipo_ordenamiento" else "Etiquetado"
-        user_data.setdefault(chat_id, {})
-        user_data[chat_id]["tipo"] = tipo
+class IdempotenciaKV:
+    def __init__(self, kv: AlmacenKV, retencion: float):
+        self._kv = kv
+        self._retencion = retencion
 
-        # 2) Asegurar que ya tenemos spreadsheet + fila
-        spreadsheet_id = user_data[chat_id].get("spreadsheet_id")
-        row = user_data[chat_id].get("row")
-
-        if not spreadsheet_id or not row:
-            # Guardas de seguridad: si por alguna razón no existe, lo creamos aquí
-            spreadsheet_id = ensure_spreadsheet_for_group(update)
-            ensure_sheet_and_headers(spreadsheet_id)
-            base = {
-                "CUADRILLA": user_data[chat_id].get("cuadrilla", ""),
-                "TIPO DE TRABAJO": ""  # lo seteamos abajo
-            }
-            row = append_base_row(spreadsheet_id, base)
-            user_data[chat_id]["spreadsheet_id"] = spreadsheet_id
-            user_data[chat_id]["row"] = row
-            logger.info(f"[DEBUG] (fallback) creada fila base -> sheet={spreadsheet_id}, row={row}")
+    def registrar(self, clave: str, valor: str = "1") -> bool:
+        return self._kv.set_si_no_existe(f"dedup:{clave}", valor, ttl=self._retencion)
 
-        # 3) Actualizar SOLO la celda "TIPO DE TRABAJO" en esa fila
-        gs_set_cell(spreadsheet_id, row, "TIPO DE TRABAJO", tipo)
+    def ver(self, clave: str) -> str | None:
+        return self._kv.get(f"dedup:{clave}")
 
-        # 4) Avanzar de estado
-        user_data[chat_id]["paso"] = 1
-        logger.info(f"[DEBUG] Tipo de trabajo: {tipo}, row={row}, state={user_data[chat_id]}")
 
-        # 5) Pedir selfie de ingreso
-        await query.edit_message_text(
-            f"Tipo de trabajo seleccionado: *{tipo}*\n\n📸 Ahora envía tu selfie de inicio.",
-            parse_mode="Markdown"
-        )
+IDEMPOTENCIA = (
+    IdempotenciaKV(REPLICAS.kv, IDEMPOTENCIA_RETENCION_SEG) if MODO_REPLICAS
+    else IdempotenciaSQLite(IDEMPOTENCIA_DB, IDEMPOTENCIA_RETENCION_SEG)
+)
 
-    except Exception as e:
-        logger.error(f"[ERROR] handle_tipo_trabajo: {e}")
-        try:
-            await update.callback_query.message.reply_text("❌ Error interno al seleccionar el tipo de trabajo.")
-        except Exception:
-            pass
+def nueva_jornada() -> str:
+    """Id corto de jornada; separa los eventos lógicos de dos /ingreso del mismo día."""
+    return uuid.uuid4().hex[:8]
 
-async def foto_ingreso(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.effective_chat.id
-    if not mensaje_es_para_bot(update, context):
-        return
-    if chat_id not in user_data or user_data[chat_id].get("paso") != 1:
-        return
-    if not await validar_contenido(update, "foto"):
-        return
+def clave_evento(chat_id: int, paso: str, ud: dict) -> str:
+    """
+    Clave del evento lógico `paso` en la jornada de `ud`. Una sesión sin jornada
+    (p.ej. recreada tras perder la sesión) recibe aquí su propio id, así no comparte
+    claves con otras sesiones sin jornada.
+    """
+    jornada = ud.setdefault("jornada", nueva_jornada())
+    return f"e:{chat_id}:{jornada}:{paso}"
+
+def _claves_update(update: Update) -> list[str]:
+    claves = [f"u:{update.update_id}"]
+    if update.callback_query:
+        claves.append(f"cq:{update.callback_query.id}")
+    return claves
+
+async def consultar_idempotencia(clave: str) -> str | None:
+    """IDEMPOTENCIA.ver fuera del event loop: SQLite (o el KV) no bloquea los carriles."""
+    return await asyncio.to_thread(IDEMPOTENCIA.ver, clave)
+
+async def registrar_idempotencia(clave: str, valor: str = "1") -> bool:
+    """IDEMPOTENCIA.registrar fuera del event loop (cada commit hace fsync)."""
+    return await asyncio.to_thread(IDEMPOTENCIA.registrar, clave, valor)
+
+async def deduplicar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Grupo -1: descarta updates/callbacks ya procesados antes de cualquier handler."""
+    claves = _claves_update(update)
+    vistas = await asyncio.to_thread(lambda: [c for c in claves if IDEMPOTENCIA.ver(c) is not None])
+    if vistas:
+        logger.info(f"[DEBUG] Duplicado descartado: {vistas[0]}")
+        if update.callback_query:
+            try:
+                await contestar(update.callback_query)
+            except Exception:
+                pass
+        if MODO_REPLICAS:
+            await guardar_sesion_replica(update, context)  # suelta el lock del chat
+        raise ApplicationHandlerStop
+
+async def marcar_procesado(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Grupo 99: se marca al terminar (no al empezar) para que un update que se cortó
+    a la mitad por un reinicio sí se vuelva a procesar cuando Telegram lo reentregue.
+    """
+    claves = _claves_update(update)
+    await asyncio.to_thread(lambda: [IDEMPOTENCIA.registrar(c) for c in claves])  # un solo salto al hilo
+
+# -------------------- AGREGADOS DE ASISTENCIA EN MEMORIA --------------------
+# Cada evento de asistencia actualiza contadores del día (Lima): jornadas abiertas,
+# en break y cerradas, por grupo y en total, y cumplimiento de ATS/PETAR.
+# /resumen responde solo desde aquí, sin llamar a Google. Al arrancar se
+# reconstruyen con una lectura por spreadsheet de la pestaña del mes.
+ESTADOS_JORNADA = ("abierta", "en_break", "cerrada")
+_EVENTO_A_ESTADO = {"ingreso": "abierta", "breakout": "en_break", "breakin": "abierta", "salida": "cerrada"}
+
+
+class AgregadosAsistencia:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reiniciar(datetime.now(LIMA_TZ).strftime("%Y-%m-%d"))
+
+    def _reiniciar(self, fecha: str):
+        self.fecha = fecha
+        self.jornadas: dict[str, dict] = {}  # clave de fila -> {"grupo", "estado", "ats"}
+        self.total = collections.Counter()    # "abierta"/"en_break"/"cerrada"/"ats_Sí"/"ats_No"
+        self.por_grupo: dict[str, collections.Counter] = collections.defaultdict(collections.Counter)
+
+    def _al_dia(self):
+        hoy = datetime.now(LIMA_TZ).strftime("%Y-%m-%d")
+        if hoy != self.fecha:
+            self._reiniciar(hoy)
+
+    def _mover(self, grupo: str, antes: str | None, despues: str | None):
+        if antes == despues:
+            return
+        if antes:
+            self.total[antes] -= 1
+            self.por_grupo[grupo][antes] -= 1
+        if despues:
+            self.total[despues] += 1
+            self.por_grupo[grupo][despues] += 1
+
+    def aplicar(self, grupo: str, clave: str, evento: str):
+        """Aplica un evento ("ingreso", "breakout", "breakin", "salida", "ats_Sí", "ats_No")."""
+        with self._lock:
+            self._al_dia()
+            j = self.jornadas.setdefault(clave, {"grupo": grupo, "estado": None, "ats": None})
+            if evento.startswith("ats_"):
+                self._mover(grupo, j["ats"], evento)
+                j["ats"] = evento
+            else:
+                nuevo = _EVENTO_A_ESTADO[evento]
+                if j["estado"] == "cerrada" and nuevo != "cerrada":
+                    return  # eventos tardíos no reabren una jornada cerrada
+                self._mover(grupo, j["estado"], nuevo)
+                j["estado"] = nuevo
+
+    def cargar_filas(self, grupo: str, prefijo: str, filas: list[list[str]], primera_fila: int = 2,
+                     claves: dict[int, str] | None = None):
+        """
+        Reconstruye desde filas A:I leídas de la hoja (solo las de hoy). `claves`
+        da la clave de las filas ancladas (las demás usan '<prefijo>:<fila>').
+        """
+        claves = claves or {}
+        for n, fila in enumerate(filas, start=primera_fila):
+            fila = fila + [""] * (len(HEADERS) - len(fila))
+            dato = dict(zip(HEADERS, fila))
+            if dato["FECHA"] != self.fecha:
+                continue
+            clave = claves.get(n, f"{prefijo}:{n}")
+            if dato["HORA INGRESO"]:
+                self.aplicar(grupo, clave, "ingreso")
+            if dato["HORA BREAK OUT"]:
+                self.aplicar(grupo, clave, "breakout")
+            if dato["HORA BREAK IN"]:
+                self.aplicar(grupo, clave, "breakin")
+            if dato["HORA SALIDA"]:
+                self.aplicar(grupo, clave, "salida")
+            if dato["ATS/PETAR"] in ("Sí", "No"):
+                self.aplicar(grupo, clave, f"ats_{dato['ATS/PETAR']}")
+
+    def renumerar(self, prefijo: str, nueva_fila):
+        """Cambia las claves '<prefijo>:<fila>' tras borrar filas de esa pestaña."""
+        with self._lock:
+            # En un dict nuevo: renombrar en el sitio pisaría p:4 al mover p:5 -> p:4
+            jornadas = {}
+            for clave, j in self.jornadas.items():
+                base, _, fila = clave.rpartition(":")
+                jornadas[f"{prefijo}:{nueva_fila(int(fila))}" if base == prefijo else clave] = j
+            self.jornadas = jornadas
+
+    def resumen(self) -> str:
+        with self._lock:
+            self._al_dia()
+            t = self.total
+            ats_total = t["ats_Sí"] + t["ats_No"]
+            pct = f" ({round(100 * t['ats_Sí'] / ats_total)}%)" if ats_total else ""
+            lineas = [
+                f"📊 Resumen {self.fecha} ({datetime.now(LIMA_TZ).strftime('%H:%M')})",
+                f"🟢 En jornada: {t['abierta']}  ☕ En break: {t['en_break']}  🏁 Cerradas: {t['cerrada']}",
+                f"📝 ATS/PETAR Sí: {t['ats_Sí']}/{ats_total}{pct}",
+            ]
+            if self.por_grupo:
+                lineas.append("")
+            for grupo in sorted(self.por_grupo):
+                c = self.por_grupo[grupo]
+                lineas.append(
+                    f"• {grupo}: 🟢 {c['abierta']} ☕ {c['en_break']} 🏁 {c['cerrada']} | ATS {c['ats_Sí']}/{c['ats_Sí'] + c['ats_No']}"
+                )
+            return "\n".join(lineas)
 
-    # Verifica que tengamos hoja y fila
-    spreadsheet_id = user_data.get(chat_id, {}).get("spreadsheet_id")
-    row = user_data.get(chat_id, {}).get("row")
-    if not spreadsheet_id or not row:
-        logger.error(f"[ERROR] foto_ingreso: faltan spreadsheet_id/row en user_data[{chat_id}] = {user_data.get(chat_id)}")
-        await update.message.reply_text("❌ No hay registro activo. Usa /ingreso para iniciar.")
-        return
 
-    hora_ingreso = datetime.now(LIMA_TZ).strftime("%H:%M")
-    user_data[chat_id]["hora_ingreso"] = hora_ingreso
+AGREGADOS = AgregadosAsistencia()
 
-    # Actualizamos SOLO la celda de HORA INGRESO en esa fila
-    loop = asyncio.get_running_loop()
+def clave_fila(ud: dict) -> str:
+    if ud.get("ancla"):
+        return f"{ud['spreadsheet_id']}:{ud['ancla']}"  # estable aunque la fila se mueva
+    return f"{ud['spreadsheet_id']}:{ud.get('sheet_title', SHEET_TITLE)}:{ud['row']}"
+
+def registrar_asistencia(update: Update, ud: dict, evento: str):
+    """Actualiza los agregados tras una escritura exitosa. Nunca interrumpe el flujo."""
     try:
-        await loop.run_in_executor(
-            None,
-            update_single_cell,
-            spreadsheet_id,
-            SHEET_TITLE,
-            COL["HORA INGRESO"],  # F normalmente
-            row,
-            hora_ingreso
-        )
+        AGREGADOS.aplicar(nombre_archivo_grupo(update), clave_fila(ud), evento)
     except Exception as e:
-        logger.error(f"[ERROR] foto_ingreso: {e}")
-        await update.message.reply_text("❌ No se pudo guardar la hora de ingreso.")
+        logger.error(f"[ERROR] registrar_asistencia ({evento}): {e}")
+
+def listar_spreadsheets_grupos(con_archivos: bool = False) -> list[dict]:
+    """
+    Spreadsheets de grupo en la carpeta principal, en un solo files.list. Los archivos
+    anuales ("<grupo> - Archivo 2026") solo con `con_archivos`.
+    """
+    resp = drive_service.files().list(
+        q=f"'{carpeta_principal()}' in parents and mimeType='{SHEET_MIME}' and trashed=false",
+        fields="files(id, name)",
+        pageSize=1000,
+        supportsAllDrives=True,
+        includeItemsFromAllDrives=True
+    ).execute()
+    return [f for f in resp.get("files", [])
+            if f["name"] != HALLAZGOS_SPREADSHEET and (con_archivos or " - Archivo " not in f["name"])]
+
+def leer_pestana_con_anclas(spreadsheet_id: str, sheet_title: str) -> tuple[list[list[str]], dict[int, str]]:
+    """
+    Valores A2:I de la pestaña y {fila: ancla} en una sola llamada: spreadsheets.get
+    con includeGridData trae, junto a cada fila, su developer metadata.
+    """
+    resp = sheets_service.spreadsheets().get(
+        spreadsheetId=spreadsheet_id,
+        ranges=[rango(sheet_title, "A2:I")],
+        includeGridData=True,
+        fields="sheets.data(startRow,rowData.values.formattedValue,rowMetadata.developerMetadata(metadataKey,metadataValue))"
+    ).execute()
+    datos = (resp.get("sheets") or [{}])[0].get("data") or [{}]
+    primera = datos[0].get("startRow", 0) + 1
+    filas = [[c.get("formattedValue", "") for c in f.get("values", [])] for f in datos[0].get("rowData", [])]
+    anclas = {}
+    for i, meta in enumerate(datos[0].get("rowMetadata", [])):
+        for md in meta.get("developerMetadata", []):
+            if md.get("metadataKey") == CLAVE_ANCLA:
+                anclas[primera + i] = md["metadataValue"]
+    return filas, anclas
+
+def reconstruir_agregados():
+    """Una lectura por spreadsheet de grupo (pestaña del mes, A2:I, con sus anclas) para recuperar el día."""
+    sheet_title = titulo_hoja()
+    grupos = 0
+    for archivo in listar_spreadsheets_grupos():
+        try:
+            filas, anclas = leer_pestana_con_anclas(archivo["id"], sheet_title)
+        except HttpError as e:
+            if e.resp.status == 400:  # la pestaña del mes aún no existe
+                logger.info(f"[DEBUG] reconstruir_agregados: sin '{sheet_title}' en {archivo['name']}")
+            else:
+                logger.error(f"[ERROR] reconstruir_agregados ({archivo['name']}): {e}")
+            continue
+        except Exception as e:
+            logger.error(f"[ERROR] reconstruir_agregados ({archivo['name']}): {e}")
+            continue
+        claves = {row: f"{archivo['id']}:{ancla}" for row, ancla in anclas.items()}
+        AGREGADOS.cargar_filas(archivo["name"], f"{archivo['id']}:{sheet_title}", filas, claves=claves)
+        grupos += 1
+    logger.info(f"[DEBUG] Agregados reconstruidos desde {grupos} grupos")
+
+async def resumen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/resumen (solo ADMIN_IDS): estado actual de todas las cuadrillas, sin tocar Google."""
+    if not es_admin(update):
         return
+    if update.message.chat.type in ['group', 'supergroup']:
+        if not mensaje_es_para_bot(update, context):
+            return
+    await responder(update.message, AGREGADOS.resumen())
+
+# -------------------- EXPORTACIÓN DEL SPREADSHEET DEL GRUPO --------------------
+# /exportar [xlsx|csv] (solo ADMIN_IDS) manda el spreadsheet del grupo como documento.
+# Drive files.export arma el archivo del lado de Google y se baja por partes
+# (MediaIoBaseDownload) a un archivo temporal en disco. PTB 20.3 arma el multipart
+# con el archivo entero en memoria (InputFile lo lee completo), así que esa lectura
+# se hace en el executor y no en el event loop. El file_id de Telegram del documento
+# enviado queda guardado por (spreadsheet, formato) junto con el modifiedTime del
+# archivo: si la hoja no cambió desde la última vez, se reenvía ese file_id sin
+# exportar ni subir nada.
+# Por privado: /exportar [xlsx|csv] [inquilino] <nombre exacto del grupo>. Sin
+# inquilino se busca el nombre en las carpetas de todos. El CSV trae solo la primera pestaña.
+EXPORT_CHUNK_BYTES = int(os.getenv("EXPORT_CHUNK_BYTES", str(1024 * 1024)))
+FORMATOS_EXPORTACION = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "csv": "text/csv",
+}
+_EXPORTACIONES = {}  # (spreadsheet_id, formato) -> (modifiedTime, file_id de Telegram)
 
-    keyboard = [
-        [InlineKeyboardButton("🔄 Repetir Selfie", callback_data="repetir_foto_inicio")],
-        [InlineKeyboardButton("📝📋 Continuar con ATS/PETAR", callback_data="continuar_ats")],
-    ]
-    await update.message.reply_text("¿Es correcto el selfie de inicio?", reply_markup=InlineKeyboardMarkup(keyboard))
+def modificado_en(spreadsheet_id: str) -> str:
+    return drive_service.files().get(
+        fileId=spreadsheet_id,
+        fields="modifiedTime",
+        supportsAllDrives=True
+    ).execute()["modifiedTime"]
+
+def exportar_spreadsheet(spreadsheet_id: str, mime: str, ruta: str):
+    """files.export del spreadsheet, descargado por partes a `ruta`."""
+    with open(ruta, "wb") as destino:
+        descarga = MediaIoBaseDownload(
+            destino,
+            drive_service.files().export_media(fileId=spreadsheet_id, mimeType=mime),
+            chunksize=EXPORT_CHUNK_BYTES,
+        )
+        terminado = False
+        while not terminado:
+            _, terminado = descarga.next_chunk()
+
+def documento_de(ruta: str, nombre: str) -> InputFile:
+    """InputFile desde disco (lo lee entero: llamar fuera del event loop)."""
+    with open(ruta, "rb") as f:
+        return InputFile(f, filename=nombre)
+
+async def buscar_grupo_exportable(nombre: str, inquilino: str | None) -> tuple[Inquilino, dict] | None:
+    """(inquilino, archivo) del spreadsheet `nombre`: en el inquilino indicado o, si no, en todos."""
+    if inquilino:
+        INQUILINO_ACTUAL.set(INQUILINOS[inquilino])
+        archivo = await google_io(buscar_archivo_en_drive, nombre, SHEET_MIME)
+        return (INQUILINOS[inquilino], archivo) if archivo else None
+    encontrados = await en_cada_inquilino(buscar_archivo_en_drive, nombre, SHEET_MIME)
+    for nombre_inq, archivo in encontrados.items():
+        if archivo:
+            INQUILINO_ACTUAL.set(INQUILINOS[nombre_inq])
+            return INQUILINOS[nombre_inq], archivo
+    return None
+
+async def exportar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/exportar [xlsx|csv] (solo ADMIN_IDS): el spreadsheet del grupo como documento."""
+    if not es_admin(update):
+        return
+    en_grupo = update.message.chat.type in ['group', 'supergroup']
+    if en_grupo and not mensaje_es_para_bot(update, context):
+        return
 
+    args = list(context.args or [])
+    formato = args.pop(0).lower() if args and args[0].lower() in FORMATOS_EXPORTACION else "xlsx"
+    inquilino = args.pop(0) if not en_grupo and len(args) > 1 and args[0] in INQUILINOS else None
+    nombre = nombre_archivo_grupo(update) if en_grupo else " ".join(args).strip()
+    if not nombre:
+        await responder(update.message, "Uso por privado: /exportar [xlsx|csv] [inquilino] <nombre exacto del grupo>")
+        return
 
-# -------------------- MANEJAR REPETICIÓN DE FOTOS --------------------
-async def manejar_repeticion_fotos(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    directorio = None
     try:
-        query = update.callback_query
-        if not query:
-            logger.warning("[DEBUG] manejar_repeticion_fotos llamado sin callback_query.")
+        if en_grupo:  # el inquilino ya lo fijó asignar_inquilino
+            archivo = await google_io(buscar_archivo_en_drive, nombre, SHEET_MIME)
+        else:  # por privado el chat no dice el inquilino: sale del nombre (o del argumento)
+            encontrado = await buscar_grupo_exportable(nombre, inquilino)
+            archivo = encontrado[1] if encontrado else None
+        if not archivo:
+            await responder(update.message, f"❌ No encontré el spreadsheet «{nombre}».")
+            return
+        spreadsheet_id = archivo["id"]
+        modificado = await google_io(modificado_en, spreadsheet_id)
+        nombre_doc = f"{_sanitize_name(nombre)} {datetime.now(LIMA_TZ).strftime('%Y-%m-%d %H%M')}.{formato}"
+
+        previo = _EXPORTACIONES.get((spreadsheet_id, formato))
+        if previo and previo[0] == modificado:
+            logger.info(f"[DEBUG] exportar: sin cambios desde {modificado}, se reenvía el documento")
+            await enviar_documento(context.bot, chat_id, previo[1], caption=f"📄 {nombre} (sin cambios)")
             return
 
-        chat_id = query.message.chat.id
-        await query.answer()
-        logger.info(f"[DEBUG] manejar_repeticion_fotos: chat_id={chat_id}, data={query.data}")
-
-        # Teclado genérico para ATS
-        ats_keyboard = InlineKeyboardMarkup([
-            [InlineKeyboardButton("✅ ATS/PETAR Sí", callback_data="ats_si")],
-            [InlineKeyboardButton("❌ ATS/PETAR No", callback_data="ats_no")],
-        ])
-
-        # --- SELFIE INICIO ---
-        if query.data == "repetir_foto_inicio":
-            user_data.setdefault(chat_id, {})["paso"] = 1
-            logger.info(f"[DEBUG] Paso cambiado a 1 (selfie inicio) para chat {chat_id}")
-            await query.edit_message_text(
-                "📸 Envía nuevamente tu *selfie de inicio*.", parse_mode="Markdown"
-            )
+        directorio = tempfile.mkdtemp(prefix="exportar-")
+        ruta = os.path.join(directorio, nombre_doc)
+        await google_io(exportar_spreadsheet, spreadsheet_id, FORMATOS_EXPORTACION[formato], ruta)
+        documento = await asyncio.get_running_loop().run_in_executor(None, documento_de, ruta, nombre_doc)
+        mensaje = await enviar_documento(context.bot, chat_id, documento, caption=f"📄 {nombre}")
+        _EXPORTACIONES[(spreadsheet_id, formato)] = (modificado, mensaje.document.file_id)
+        logger.info(f"[DEBUG] exportar: {nombre} ({formato}) enviado, modifiedTime={modificado}")
+    except Exception as e:
+        logger.error(f"[ERROR] exportar ({nombre}): {e}")
+        await responder(update.message, "❌ No se pudo exportar el spreadsheet. Intenta de nuevo.")
+    finally:
+        if directorio:
+            shutil.rmtree(directorio, ignore_errors=True)
+
+# -------------------- COMPACTACIÓN DE FILAS FRAGMENTADAS --------------------
+# Cuando falta la sesión, breakout/breakin/salida/ATS crean una fila base nueva y la
+# jornada queda partida en varias filas. Cada noche, por spreadsheet: una lectura
+# (values.batchGet de las pestañas de registros), se fusionan los fragmentos de
+# fechas ya cerradas por (FECHA, CUADRILLA), se normaliza MES y se aplica todo con
+# un solo batchUpdate (updateCells + deleteDimension de abajo hacia arriba).
+# Después se corrigen los números de fila de las sesiones activas; las pestañas con
+# sesiones que aún escriben por número de fila (sin ancla) se dejan para otra noche,
+# así ninguna escritura cae en otra fila mientras se borra. La misma tarea
+# archiva los meses cerrados (ver ROLLOVER DE PESTAÑAS).
+COMPACTAR_HORA = os.getenv("COMPACTAR_HORA", "03:30")  # hora de Lima; vacío = desactivado
+EPOCA_SHEETS = datetime(1899, 12, 30)  # día 0 de los números de serie de Sheets
+
+def _indice_col(letra: str) -> int:
+    n = 0
+    for c in letra.upper():
+        n = n * 26 + ord(c) - 64
+    return n - 1
+
+def _letra_col(indice: int) -> str:
+    """Inversa de _indice_col: 0 -> 'A', 26 -> 'AA'."""
+    letra = ""
+    indice += 1
+    while indice:
+        indice, r = divmod(indice - 1, 26)
+        letra = chr(65 + r) + letra
+    return letra
+
+def _dia_de_celda(valor) -> str:
+    """FECHA leída sin formato (número de serie o texto) -> 'YYYY-MM-DD' ('' si no lo es)."""
+    if isinstance(valor, (int, float)) and not isinstance(valor, bool):
+        return (EPOCA_SHEETS + timedelta(days=int(valor))).strftime("%Y-%m-%d")
+    texto = str(valor or "").strip()
+    return texto if re.fullmatch(r"\d{4}-\d{2}-\d{2}", texto) else ""
+
+def _celda_vacia(valor) -> bool:
+    return valor is None or valor == ""
+
+def _fusionables(a: list, b: list, columnas: list[int]) -> bool:
+    """Dos filas son fragmentos de la misma jornada si no se contradicen en ninguna columna."""
+    return all(_celda_vacia(a[c]) or _celda_vacia(b[c]) or a[c] == b[c] for c in columnas)
+
+def planear_compactacion(filas: list[list], hoy: str, columnas: list[int]) -> tuple[dict[int, list], dict[int, int]]:
+    """
+    `filas` son los valores de la pestaña desde la fila 2 (índice 0 = fila 2).
+    Devuelve ({índice: fila final} a reescribir, {índice borrado: índice que lo absorbe}).
+    Un fragmento se fusiona solo si hay exactamente una fila compatible ese día
+    (prefiriendo las de la misma CUADRILLA); si hay ambigüedad se deja como está.
+    """
+    i_mes, i_fecha, i_cuadrilla = HEADERS.index("MES"), HEADERS.index("FECHA"), HEADERS.index("CUADRILLA")
+    comparables = [c for c in columnas if c not in (i_mes, i_fecha)]
+    ancho = max(columnas) + 1
+    filas = [list(f) + [""] * (ancho - len(f)) for f in filas]
+    cambios, absorbidas = {}, {}
+    vigentes = collections.defaultdict(list)  # día -> índices que se conservan
+
+    for i, fila in enumerate(filas):
+        dia = _dia_de_celda(fila[i_fecha])
+        if not dia or dia >= hoy:
+            continue  # solo fechas cerradas: las de hoy pueden tener sesiones en curso
+        compatibles = [k for k in vigentes[dia] if _fusionables(cambios.get(k, filas[k]), fila, comparables)]
+        misma_cuadrilla = [k for k in compatibles
+                           if not _celda_vacia(fila[i_cuadrilla]) and cambios.get(k, filas[k])[i_cuadrilla] == fila[i_cuadrilla]]
+        if misma_cuadrilla:
+            compatibles = misma_cuadrilla
+        if len(compatibles) != 1:
+            vigentes[dia].append(i)
+            continue
+        k = compatibles[0]
+        base = cambios.setdefault(k, list(filas[k]))
+        for c in comparables:
+            if _celda_vacia(base[c]):
+                base[c] = fila[c]
+        absorbidas[i] = k
+
+    for dia, indices in vigentes.items():
+        mes = MESES[int(dia[5:7]) - 1]
+        for k in indices:
+            if cambios.get(k, filas[k])[i_mes] != mes:
+                cambios.setdefault(k, list(filas[k]))[i_mes] = mes
+    return cambios, absorbidas
+
+def _valor_celda(valor) -> dict:
+    """Valor leído con valueRenderOption=FORMULA -> userEnteredValue (conserva el tipo)."""
+    if isinstance(valor, bool):
+        return {"boolValue": valor}
+    if isinstance(valor, (int, float)):
+        return {"numberValue": valor}
+    if isinstance(valor, str) and valor.startswith("="):
+        return {"formulaValue": valor}
+    return {"stringValue": str(valor)}
+
+def _tramos(indices: list[int]) -> list[tuple[int, int]]:
+    """[3, 4, 5, 9] -> [(3, 6), (9, 10)] (rangos semiabiertos)."""
+    tramos = []
+    for i in sorted(indices):
+        if tramos and tramos[-1][1] == i:
+            tramos[-1] = (tramos[-1][0], i + 1)
+        else:
+            tramos.append((i, i + 1))
+    return tramos
 
-        elif query.data == "continuar_ats":
-            await query.edit_message_text("¿Realizaste ATS/PETAR?", reply_markup=ats_keyboard)
+def compactar_spreadsheet(spreadsheet_id: str, omitir: set = frozenset(),
+                          activas: set = frozenset()) -> dict[str, tuple[list[int], dict[int, int]]]:
+    """
+    Compacta las pestañas de registros de un spreadsheet (salvo las (ssid, pestaña)
+    de `omitir`) y, en el mismo batchUpdate, borra las anclas de filas de días
+    cerrados que no estén en `activas`. Devuelve, por pestaña, (filas borradas
+    ordenadas, {fila borrada: fila que la absorbió}) en números de fila.
+    """
+    meta = sheets_service.spreadsheets().get(
+        spreadsheetId=spreadsheet_id,
+        fields="sheets.properties(sheetId,title)"
+    ).execute()
+    pestanas = [s["properties"] for s in meta.get("sheets", [])
+                if s["properties"]["title"] == SHEET_TITLE or periodo_de_hoja(s["properties"]["title"]) is not None]
+    for p in [p for p in pestanas if (spreadsheet_id, p["title"]) in omitir]:
+        logger.info(f"[DEBUG] Compactación: '{p['title']}' ({spreadsheet_id}) tiene sesiones sin ancla, se omite")
+        pestanas.remove(p)
+    if not pestanas:
+        return {}
+
+    resp = sheets_service.spreadsheets().values().batchGet(
+        spreadsheetId=spreadsheet_id,
+        ranges=[rango(p["title"], "A2:ZZ") for p in pestanas],
+        valueRenderOption="FORMULA"
+    ).execute()
 
-        # --- ATS/PETAR ---
-        elif query.data == "repetir_foto_ats":
-            user_data.setdefault(chat_id, {})["paso"] = 2
-            logger.info(f"[DEBUG] Paso cambiado a 2 (repetir foto ATS) para chat {chat_id}")
-            await query.edit_message_text(
-                "📸 Envía nuevamente la *foto del ATS/PETAR*.", parse_mode="Markdown"
+    columnas = list(range(len(HEADERS)))
+    if GEOCERCA_ACTIVA:
+        columnas += [_indice_col(GEO_COL_SEDE), _indice_col(GEO_COL_DISTANCIA)]
+    # Las derivadas no cuentan para fusionar, pero se recalculan en las filas que cambian
+    derivadas = list(range(_indice_col(DERIVADAS_COL), _indice_col(DERIVADAS_COL) + len(DERIVADAS_HEADERS)))
+    escritas = columnas + derivadas if COLUMNAS_DERIVADAS else columnas
+    hoy = datetime.now(LIMA_TZ).strftime("%Y-%m-%d")
+    i_fecha = HEADERS.index("FECHA")
+    anclas = collections.defaultdict(dict)  # sheetId -> {fila: ancla}
+    for ancla, (sid, row) in mapa_anclas(spreadsheet_id).items():
+        anclas[sid][row] = ancla
+
+    requests, resultado, limpieza = [], {}, []
+    for props, vr in zip(pestanas, resp.get("valueRanges", [])):
+        for i, fila in enumerate(vr.get("values", [])):
+            ancla = anclas[props["sheetId"]].get(i + 2)
+            dia = _dia_de_celda(fila[i_fecha]) if len(fila) > i_fecha else ""
+            if ancla and ancla not in activas and dia and dia < hoy:
+                limpieza.append({"deleteDeveloperMetadata": {"dataFilter": {"developerMetadataLookup": {
+                    "metadataKey": CLAVE_ANCLA, "metadataValue": ancla,
+                }}}})
+        cambios, absorbidas = planear_compactacion(vr.get("values", []), hoy, columnas)
+        for i, fila in sorted(cambios.items()):
+            if COLUMNAS_DERIVADAS:
+                fila += [""] * (derivadas[-1] + 1 - len(fila))
+                fila[derivadas[0]:derivadas[-1] + 1] = calcular_derivadas(dict(zip(HEADERS, fila)))
+            for inicio, fin in _tramos(escritas):
+                requests.append({"updateCells": {
+                    "start": {"sheetId": props["sheetId"], "rowIndex": i + 1, "columnIndex": inicio},
+                    "rows": [{"values": [
+                        {} if _celda_vacia(v) else {"userEnteredValue": _valor_celda(v)}
+                        for v in fila[inicio:fin]
+                    ]}],
+                    "fields": "userEnteredValue",
+                }})
+        for inicio, fin in reversed(_tramos(list(absorbidas))):
+            requests.append({"deleteDimension": {"range": {
+                "sheetId": props["sheetId"], "dimension": "ROWS", "startIndex": inicio + 1, "endIndex": fin + 1,
+            }}})
+        if absorbidas:
+            resultado[props["title"]] = (
+                sorted(i + 2 for i in absorbidas),
+                {i + 2: k + 2 for i, k in absorbidas.items()},
             )
+            logger.info(f"[DEBUG] Compactación: {len(absorbidas)} fragmentos fusionados en '{props['title']}' ({spreadsheet_id})")
 
-        elif query.data == "reenviar_ats":
-            # Opción cuando eligieron "No" pero quieren enviar foto igual
-            user_data.setdefault(chat_id, {})["paso"] = 2
-            logger.info(f"[DEBUG] Paso cambiado a 2 (reenviar ATS) para chat {chat_id}")
-            await query.edit_message_text(
-                "Ok. 📸 Envía la *foto del ATS/PETAR* de todas formas.", parse_mode="Markdown"
-            )
+    if limpieza:
+        logger.info(f"[DEBUG] Compactación: {len(limpieza)} anclas de días cerrados borradas ({spreadsheet_id})")
+    if requests or limpieza:
+        sheets_service.spreadsheets().batchUpdate(
+            spreadsheetId=spreadsheet_id,
+            body={"requests": limpieza + requests}  # las anclas se borran por valor, antes de mover filas
+        ).execute()
+    return resultado
 
-        elif query.data == "continuar_post_ats":
-            user_data.setdefault(chat_id, {})["paso"] = "selfie_salida"
-            logger.info(f"[DEBUG] Paso cambiado a 'selfie_salida' para chat {chat_id}")
+def archivar_meses_cerrados(archivo: dict):
+    """Rollover: mueve las pestañas mensuales ya cerradas del grupo a su archivo anual."""
+    meta = sheets_service.spreadsheets().get(
+        spreadsheetId=archivo["id"],
+        fields="sheets.properties(sheetId,title)"
+    ).execute()
+    _archivar_periodos_cerrados(archivo["id"], archivo["name"], [s["properties"] for s in meta.get("sheets", [])])
 
-            # 1) Edita el mensaje anterior para cerrar el hilo
-            await query.edit_message_text("✅ ¡Registro completado!")
+def compactar_registros(omitir: set = frozenset(), activas: set = frozenset()) -> tuple[dict, dict[str, dict]]:
+    """
+    Devuelve ({(ssid, pestaña): plan}, {ssid: mapa_anclas}) de los spreadsheets que
+    cambiaron: el mapa de anclas se relee una vez tras el borrado. Después de
+    compactar se archivan los meses cerrados (ROLLOVER_REGISTROS=mensual).
+    """
+    cambios, anclas = {}, {}
+    for archivo in listar_spreadsheets_grupos():
+        try:
+            planes = compactar_spreadsheet(archivo["id"], omitir, activas)
+            for sheet_title, plan in planes.items():
+                cambios[(archivo["id"], sheet_title)] = plan
+            if planes:
+                anclas[archivo["id"]] = mapa_anclas(archivo["id"])
+        except Exception as e:
+            logger.error(f"[ERROR] Compactación de {archivo['name']}: {e}")
+        if ROLLOVER_REGISTROS == "mensual":
+            try:
+                archivar_meses_cerrados(archivo)
+            except Exception as e:
+                logger.error(f"[ERROR] Rollover: no se pudo archivar {archivo['name']}: {e}")
+    return cambios, anclas
+
+def fila_tras_compactar(row: int, borradas: list[int], destino: dict[int, int]) -> int:
+    row = destino.get(row, row)
+    return row - bisect.bisect_left(borradas, row)
+
+def sesiones_activas() -> list[dict]:
+    """Sesiones en memoria y, con réplicas, las del KV (solo lectura)."""
+    sesiones = list(user_data.values())
+    if REPLICAS is not None:
+        for clave in REPLICAS.kv.claves("sesion:"):
+            raw = REPLICAS.kv.get(clave)
+            if raw:
+                sesiones.append(json.loads(raw))
+    return sesiones
+
+def pestanas_con_sesiones_sin_ancla(sesiones: list[dict]) -> set[tuple[str, str]]:
+    """
+    (ssid, pestaña) con sesiones que escriben por número de fila. No se compactan:
+    sus escrituras caerían en otra fila entre el borrado y la renumeración.
+    """
+    return {(ud["spreadsheet_id"], ud.get("sheet_title", SHEET_TITLE)) for ud in sesiones
+            if ud.get("spreadsheet_id") and ud.get("row") and not ud.get("ancla")}
 
-            # 2) Envía el motivador y guarda su message_id para ignorar replies
-            mensaje = await context.bot.send_message(
-                chat_id=chat_id,
-                text="¡Excelente! 🎉 Ya estás listo para comenzar.\n\n💪 *Puedes iniciar tu jornada.* 💪",
-                parse_mode="Markdown"
-            )
-            user_data[chat_id]["msg_id_motivador"] = mensaje.message_id
-
-        # --- SELFIE SALIDA ---
-        elif query.data == "repetir_foto_salida":
-            user_data.setdefault(chat_id, {})
-            user_data[chat_id].pop("selfie_salida", None)
-            user_data[chat_id]["paso"] = "selfie_salida"
-            logger.info(f"[DEBUG] Repetir selfie salida, paso='selfie_salida' para chat {chat_id}")
-            await query.edit_message_text(
-                "📸 Por favor, envía nuevamente tu *selfie de salida*.",
-                parse_mode="Markdown"
+def _renumerar_sesion(chat_id: int, ud: dict, cambios: dict, anclas: dict[str, dict]) -> bool:
+    plan = cambios.get((ud.get("spreadsheet_id"), ud.get("sheet_title", SHEET_TITLE)))
+    if not plan or not ud.get("row"):
+        return False
+    mapa = anclas.get(ud["spreadsheet_id"], {})
+    if ud.get("ancla") in mapa:
+        ud["row"] = mapa[ud["ancla"]][1]
+    else:
+        ud.pop("ancla", None)  # su fila fue absorbida: se sigue por número de fila
+        ud["row"] = fila_tras_compactar(ud["row"], *plan)
+    if ud.get("valores_jornada"):  # sigue siendo la misma jornada para anotar_derivadas
+        ud["valores_jornada"]["_fila"] = ud.get("ancla") or ud["row"]
+    if ud.get("jornada"):
+        IDEMPOTENCIA.registrar(clave_evento(chat_id, "fila_base", ud), json.dumps({
+            "spreadsheet_id": ud["spreadsheet_id"], "sheet_title": ud.get("sheet_title", SHEET_TITLE),
+            "row": ud["row"], "ancla": ud.get("ancla"),
+        }))
+    return True
+
+def renumerar_derivadas(cambios: dict, anclas: dict[str, dict]):
+    """Filas derivadas pendientes: mismo ajuste que las sesiones, y su clave sigue a la fila."""
+    with _DERIVADAS_LOCK:
+        for nombre, refs in DERIVADAS_PENDIENTES.items():
+            nuevas = {}
+            for clave, ref in refs.items():
+                plan = cambios.get((ref["spreadsheet_id"], ref["sheet_title"]))
+                if plan:
+                    mapa = anclas.get(ref["spreadsheet_id"], {})
+                    if ref["ancla"] in mapa:
+                        ref["row"] = mapa[ref["ancla"]][1]
+                    else:
+                        ref["ancla"] = None
+                        ref["row"] = fila_tras_compactar(ref["row"], *plan)
+                    clave = clave_fila(ref)
+                nuevas[clave] = ref
+            DERIVADAS_PENDIENTES[nombre] = nuevas
+
+async def renumerar_sesiones(cambios: dict, anclas: dict[str, dict]):
+    """Ajusta `row` de las sesiones, los agregados y las derivadas pendientes a las filas que quedaron tras compactar."""
+    for chat_id, ud in user_data.items():
+        _renumerar_sesion(chat_id, ud, cambios, anclas)
+    if REPLICAS is not None:
+        for clave in REPLICAS.kv.claves("sesion:"):
+            chat_id = int(clave.split(":", 1)[1])
+            await REPLICAS.actualizar_sesion(chat_id, lambda ud, c=chat_id: _renumerar_sesion(c, ud, cambios, anclas))
+    for (ssid, sheet_title), plan in cambios.items():
+        AGREGADOS.renumerar(f"{ssid}:{sheet_title}", lambda row: fila_tras_compactar(row, *plan))
+    renumerar_derivadas(cambios, anclas)
+
+def segundos_hasta(hhmm: str) -> float:
+    """Segundos hasta la próxima vez que sean las `hhmm` en Lima."""
+    ahora = datetime.now(LIMA_TZ)
+    h, m = (int(x) for x in hhmm.split(":"))
+    objetivo = ahora.replace(hour=h, minute=m, second=0, microsecond=0)
+    if objetivo <= ahora:
+        objetivo += timedelta(days=1)
+    return (objetivo - ahora).total_seconds()
+
+async def compactacion_diaria():
+    while True:
+        await asyncio.sleep(segundos_hasta(COMPACTAR_HORA))
+        if REPLICAS is not None and not REPLICAS.es_lider:
+            continue  # la corre solo la líder
+        try:
+            async with _VOLCADO_DERIVADAS:  # un volcado en medio escribiría en filas ya movidas
+                sesiones = sesiones_activas()
+                activas = {ud["ancla"] for ud in sesiones if ud.get("ancla")}
+                with _DERIVADAS_LOCK:  # las filas derivadas pendientes también escriben por ancla
+                    activas |= {ref["ancla"] for refs in DERIVADAS_PENDIENTES.values()
+                                for ref in refs.values() if ref.get("ancla")}
+                por_inquilino = await en_cada_inquilino(compactar_registros, pestanas_con_sesiones_sin_ancla(sesiones), activas)
+                cambios, anclas = {}, {}
+                for c, a in por_inquilino.values():
+                    cambios.update(c)
+                    anclas.update(a)
+                await renumerar_sesiones(cambios, anclas)
+        except Exception as e:
+            logger.error(f"[ERROR] compactacion_diaria: {e}")
+
+# -------------------- ANÁLISIS NOCTURNO DE ANOMALÍAS --------------------
+# Después de la compactación se leen las pestañas de registros de todos los grupos
+# y de sus archivos anuales, se juntan en un solo DataFrame y se buscan, con
+# operaciones vectorizadas:
+#   - ingresos después de ANALISIS_INGRESO_TARDE
+#   - jornadas cerradas sin break, breaks sin regreso y breaks de más de ANALISIS_BREAK_MAX_MIN
+#   - las mismas horas (ingreso, breaks y salida) en cuadrillas distintas el mismo día
+#   - ANALISIS_RACHA_ATS_NO o más jornadas seguidas de una cuadrilla con ATS/PETAR "No"
+#   - HORA SALIDA anterior a HORA INGRESO
+# Costo de lectura: un files.list y dos llamadas por spreadsheet (spreadsheets.get
+# solo con los títulos de las pestañas, y un values.batchGet sin formato de las que
+# caen en el periodo). Los títulos no se pueden adivinar: un rango de una pestaña
+# que no existe hace fallar el batchGet entero.
+# Solo se miran fechas cerradas (hasta ayer) de los últimos ANALISIS_DIAS. Los
+# hallazgos reemplazan la pestaña HALLAZGOS_PESTANA del spreadsheet
+# HALLAZGOS_SPREADSHEET (en la carpeta principal) con un solo batchUpdate.
+ANALISIS_HORA = os.getenv("ANALISIS_HORA", "04:30")  # hora de Lima; vacío = desactivado
+ANALISIS_DIAS = int(os.getenv("ANALISIS_DIAS", "366"))
+ANALISIS_INGRESO_TARDE = os.getenv("ANALISIS_INGRESO_TARDE", "08:15")
+ANALISIS_BREAK_MAX_MIN = float(os.getenv("ANALISIS_BREAK_MAX_MIN", "75"))
+ANALISIS_RACHA_ATS_NO = int(os.getenv("ANALISIS_RACHA_ATS_NO", "3"))
+HALLAZGOS_SPREADSHEET = os.getenv("HALLAZGOS_SPREADSHEET", "Hallazgos de asistencia")
+HALLAZGOS_PESTANA = "Hallazgos"
+HALLAZGOS_HEADERS = ["FECHA", "GRUPO", "CUADRILLA", "HALLAZGO", "DETALLE", "PESTAÑA", "FILA"]
+
+def leer_registros_spreadsheet(spreadsheet_id: str, grupo: str, desde: datetime) -> pd.DataFrame | None:
+    """
+    Pestañas de registros con datos desde `desde`: un spreadsheets.get (títulos) y un
+    values.batchGet de las pestañas del periodo. Una fila por fila de la hoja.
+    """
+    meta = sheets_service.spreadsheets().get(
+        spreadsheetId=spreadsheet_id,
+        fields="sheets.properties.title"
+    ).execute()
+    periodo_desde = desde.year * 12 + desde.month - 1
+    pestanas = [s["properties"]["title"] for s in meta.get("sheets", [])
+                if s["properties"]["title"] == SHEET_TITLE
+                or (periodo_de_hoja(s["properties"]["title"]) or -1) >= periodo_desde]
+    if not pestanas:
+        return None
+
+    resp = sheets_service.spreadsheets().values().batchGet(
+        spreadsheetId=spreadsheet_id,
+        ranges=[rango(t, "A2:I") for t in pestanas],
+        valueRenderOption="UNFORMATTED_VALUE",
+        dateTimeRenderOption="SERIAL_NUMBER"
+    ).execute()
+    marcos = []
+    for sheet_title, vr in zip(pestanas, resp.get("valueRanges", [])):
+        valores = vr.get("values", [])
+        if not valores:
+            continue
+        df = pd.DataFrame(valores).reindex(columns=range(len(HEADERS)))
+        df.columns = HEADERS
+        df["GRUPO"] = grupo
+        df["PESTAÑA"] = sheet_title
+        df["FILA"] = np.arange(2, len(df) + 2)
+        marcos.append(df)
+    return pd.concat(marcos, ignore_index=True) if marcos else None
+
+def cargar_registros(desde: datetime) -> pd.DataFrame:
+    """Registros de todos los grupos del inquilino actual (incluidos sus archivos anuales)."""
+    marcos = []
+    for archivo in listar_spreadsheets_grupos(con_archivos=True):
+        grupo = re.sub(r" - Archivo \d{4}$", "", archivo["name"])
+        try:
+            df = leer_registros_spreadsheet(archivo["id"], grupo, desde)
+        except Exception as e:
+            logger.error(f"[ERROR] Análisis: no se pudo leer {archivo['name']}: {e}")
+            continue
+        if df is not None:
+            marcos.append(df)
+    if not marcos:
+        return pd.DataFrame(columns=HEADERS + ["GRUPO", "PESTAÑA", "FILA"])
+    return pd.concat(marcos, ignore_index=True)
+
+def _serie_fechas(s: pd.Series) -> pd.Series:
+    """FECHA sin formato (número de serie o texto 'YYYY-MM-DD') -> Timestamp (NaT si no lo es)."""
+    num = pd.to_numeric(s, errors="coerce")
+    fechas = pd.Timestamp(EPOCA_SHEETS) + pd.to_timedelta(np.floor(num), unit="D")
+    texto = s[num.isna() & s.notna()]  # filas antiguas o importadas como texto: solo esas se parsean
+    if len(texto):
+        fechas.loc[texto.index] = pd.to_datetime(texto.astype(str), format="%Y-%m-%d", errors="coerce")
+    return fechas
+
+def _serie_minutos(s: pd.Series) -> pd.Series:
+    """HORA sin formato (fracción de día o texto 'HH:MM') -> minutos desde las 00:00 (NaN si vacía)."""
+    num = pd.to_numeric(s, errors="coerce")
+    minutos = (num % 1 * 1440).round()
+    texto = s[num.isna() & s.notna()]
+    if len(texto):
+        partes = texto.astype(str).str.extract(r"^\s*(\d{1,2}):(\d{2})")
+        minutos.loc[texto.index] = pd.to_numeric(partes[0]) * 60 + pd.to_numeric(partes[1])
+    return minutos
+
+def _hhmm(minutos: pd.Series) -> pd.Series:
+    m = minutos.fillna(0).round().astype(int)
+    return (m // 60).astype(str).str.zfill(2) + ":" + (m % 60).astype(str).str.zfill(2)
+
+def detectar_anomalias(df: pd.DataFrame, hoy: datetime) -> pd.DataFrame:
+    """Un hallazgo (HALLAZGOS_HEADERS) por fila y tipo, sin recorrer las filas en Python."""
+    hoy = pd.Timestamp(hoy.strftime("%Y-%m-%d"))
+    fecha = _serie_fechas(df["FECHA"])
+    en_ventana = fecha.notna() & (fecha < hoy) & (fecha >= hoy - pd.Timedelta(days=ANALISIS_DIAS))
+    df = df.loc[en_ventana].assign(_fecha=fecha[en_ventana])
+
+    ingreso = _serie_minutos(df["HORA INGRESO"])
+    break_out = _serie_minutos(df["HORA BREAK OUT"])
+    break_in = _serie_minutos(df["HORA BREAK IN"])
+    salida = _serie_minutos(df["HORA SALIDA"])
+    cuadrilla = df["CUADRILLA"].astype("string").str.strip().fillna("")
+    ats = df["ATS/PETAR"].astype("string").str.strip()
+    cerrada = ingreso.notna() & salida.notna()
+
+    # Mismas horas en cuadrillas distintas el mismo día (en cualquier grupo)
+    horas = pd.DataFrame({
+        "f": df["_fecha"], "i": ingreso, "o": break_out.fillna(-1),
+        "n": break_in.fillna(-1), "s": salida, "c": cuadrilla,
+    })[cerrada]
+    iguales = horas.groupby(["f", "i", "o", "n", "s"])["c"].transform("nunique").reindex(df.index, fill_value=0)
+
+    # Rachas de ATS/PETAR "No" por cuadrilla, en orden de fecha (solo jornadas que respondieron)
+    respondio = ats.isin(["Sí", "No"]).fillna(False) & cuadrilla.ne("")
+    orden = pd.DataFrame({"g": df["GRUPO"], "c": cuadrilla, "f": df["_fecha"], "p": df["PESTAÑA"],
+                          "r": df["FILA"], "no": ats.eq("No").fillna(False).to_numpy(bool)})[respondio]
+    orden = orden.sort_values(["g", "c", "f", "p", "r"])
+    nueva_racha = orden["no"].ne(orden.groupby(["g", "c"])["no"].shift())
+    racha = orden["no"].astype(int).groupby(nueva_racha.cumsum()).cumsum().reindex(df.index, fill_value=0)
+
+    duracion = break_in - break_out
+    tarde = sum(int(x) * f for x, f in zip(ANALISIS_INGRESO_TARDE.split(":"), (60, 1)))
+    # (máscara, hallazgo, detalle): el detalle se arma solo para las filas marcadas
+    reglas = [
+        (ingreso > tarde, "Ingreso tarde", lambda m: "ingreso " + _hhmm(ingreso[m])),
+        (cerrada & break_out.isna() & break_in.isna(), "Sin break",
+         lambda m: "jornada cerrada sin salida ni regreso de break"),
+        (break_out.notna() & break_in.isna(), "Break sin regreso", lambda m: "salida a break " + _hhmm(break_out[m])),
+        (duracion > ANALISIS_BREAK_MAX_MIN, "Break largo",
+         lambda m: duracion[m].round().astype(int).astype(str) + " min ("
+                   + _hhmm(break_out[m]) + "–" + _hhmm(break_in[m]) + ")"),
+        (iguales > 1, "Horas idénticas a otra cuadrilla",
+         lambda m: iguales[m].astype(str) + " cuadrillas con ingreso " + _hhmm(ingreso[m]) + " y salida " + _hhmm(salida[m])),
+        (racha >= ANALISIS_RACHA_ATS_NO, "Racha de ATS/PETAR No",
+         lambda m: racha[m].astype(str) + " jornadas seguidas con ATS/PETAR No"),
+        (cerrada & (salida < ingreso), "Salida antes del ingreso",
+         lambda m: "ingreso " + _hhmm(ingreso[m]) + ", salida " + _hhmm(salida[m])),
+    ]
+
+    partes = []
+    for mascara, hallazgo, detalle in reglas:
+        mascara = mascara.fillna(False).to_numpy(bool)
+        if not mascara.any():
+            continue
+        partes.append(pd.DataFrame({
+            "FECHA": df.loc[mascara, "_fecha"].dt.strftime("%Y-%m-%d"),
+            "GRUPO": df.loc[mascara, "GRUPO"],
+            "CUADRILLA": cuadrilla[mascara],
+            "HALLAZGO": hallazgo,
+            "DETALLE": detalle(mascara),
+            "PESTAÑA": df.loc[mascara, "PESTAÑA"],
+            "FILA": df.loc[mascara, "FILA"],
+        }))
+    if not partes:
+        return pd.DataFrame(columns=HALLAZGOS_HEADERS)
+    hallazgos = pd.concat(partes, ignore_index=True)
+    return hallazgos.sort_values(["FECHA", "GRUPO", "CUADRILLA"], ascending=[False, True, True], ignore_index=True)
+
+def escribir_hallazgos(hallazgos: pd.DataFrame):
+    """Reemplaza la pestaña de hallazgos (la crea si falta) en un solo batchUpdate."""
+    spreadsheet_id = buscar_o_crear_spreadsheet(HALLAZGOS_SPREADSHEET)
+    meta = sheets_service.spreadsheets().get(
+        spreadsheetId=spreadsheet_id,
+        fields="sheets.properties(sheetId,title)"
+    ).execute()
+    props = [s["properties"] for s in meta.get("sheets", [])]
+    sheet_id = next((p["sheetId"] for p in props if p["title"] == HALLAZGOS_PESTANA), None)
+
+    requests = []
+    if sheet_id is None:
+        sheet_id = max((p["sheetId"] for p in props), default=0) + 1
+        requests.append({"addSheet": {"properties": {
+            "sheetId": sheet_id, "title": HALLAZGOS_PESTANA, "gridProperties": {"frozenRowCount": 1},
+        }}})
+    filas = [HALLAZGOS_HEADERS] + hallazgos[HALLAZGOS_HEADERS].astype({"FILA": int}).to_dict("split")["data"]
+    requests += [
+        # Ajustar el tamaño de la grilla borra las filas sobrantes de la corrida anterior
+        {"updateSheetProperties": {
+            "properties": {"sheetId": sheet_id, "gridProperties": {
+                "rowCount": len(filas) + 1, "columnCount": len(HALLAZGOS_HEADERS),
+            }},
+            "fields": "gridProperties(rowCount,columnCount)",
+        }},
+        {"updateCells": {
+            "range": {"sheetId": sheet_id},
+            "rows": [{"values": [{"userEnteredValue": _valor_celda(v)} for v in fila]} for fila in filas],
+            "fields": "userEnteredValue",
+        }},
+    ]
+    sheets_service.spreadsheets().batchUpdate(
+        spreadsheetId=spreadsheet_id,
+        body={"requests": requests}
+    ).execute()
+    logger.info(f"[DEBUG] Análisis: {len(hallazgos)} hallazgos escritos en '{HALLAZGOS_SPREADSHEET}'")
+
+def analizar_asistencia() -> int:
+    """Análisis completo del inquilino actual. Devuelve el número de hallazgos."""
+    hoy = datetime.now(LIMA_TZ)
+    t0 = time.monotonic()
+    registros = cargar_registros(hoy - timedelta(days=ANALISIS_DIAS))
+    t1 = time.monotonic()
+    hallazgos = detectar_anomalias(registros, hoy)
+    logger.info(
+        f"[DEBUG] Análisis: {len(registros)} filas leídas en {t1 - t0:.1f}s, "
+        f"{len(hallazgos)} hallazgos en {time.monotonic() - t1:.2f}s"
+    )
+    escribir_hallazgos(hallazgos)
+    return len(hallazgos)
+
+async def analisis_nocturno():
+    while True:
+        await asyncio.sleep(segundos_hasta(ANALISIS_HORA))
+        if REPLICAS is not None and not REPLICAS.es_lider:
+            continue  # lo corre solo la líder
+        await en_cada_inquilino(analizar_asistencia)
+
+# -------------------- RECORDATORIOS --------------------
+# Un solo job del JobQueue recorre todas las sesiones cada RECORDATORIO_INTERVALO_SEG
+# (sin un timer por sesión) y encola con PRIORIDAD_BAJA, vía la cola de salida, los
+# avisos de pasos vencidos: break más largo que RECORDATORIO_BREAK_MIN y jornada sin
+# salida pasada RECORDATORIO_SALIDA_HORA (hora de Lima). Cada aviso se envía una vez.
+RECORDATORIO_INTERVALO_SEG = float(os.getenv("RECORDATORIO_INTERVALO_SEG", "300"))
+RECORDATORIO_BREAK_MIN = float(os.getenv("RECORDATORIO_BREAK_MIN", "60"))
+RECORDATORIO_SALIDA_HORA = os.getenv("RECORDATORIO_SALIDA_HORA", "18:30")  # vacío = sin aviso de salida
+
+def recordatorios_pendientes(ud: dict, ahora: datetime) -> list[str]:
+    """Avisos vencidos de una sesión; marca en `ud` los que devuelve para no repetirlos."""
+    avisos = []
+    inicio_break = ud.get("breakout_ts")
+    if inicio_break and not ud.get("hora_salida") and ud.get("recordatorio_break") != inicio_break:
+        minutos = (ahora.timestamp() - inicio_break) / 60
+        if minutos >= RECORDATORIO_BREAK_MIN:
+            ud["recordatorio_break"] = inicio_break
+            avisos.append(
+                f"⏰ Llevan {int(minutos)} min en break. No olviden registrar el regreso con /breakin."
             )
 
-        else:
-            logger.info(f"[DEBUG] Callback no reconocido en manejar_repeticion_fotos: {query.data}")
+    hoy = ahora.strftime("%Y-%m-%d")
+    if (RECORDATORIO_SALIDA_HORA and ud.get("hora_ingreso") and not ud.get("hora_salida")
+            and ud.get("fecha_ingreso") == hoy and ud.get("recordatorio_salida") != hoy
+            and ahora.strftime("%H:%M") >= RECORDATORIO_SALIDA_HORA):
+        ud["recordatorio_salida"] = hoy
+        avisos.append(
+            "⏰ Aún no se registra la salida de hoy. Usen /salida y envíen el selfie de salida para cerrar la jornada."
+        )
+    return avisos
 
+async def revisar_recordatorios(context: ContextTypes.DEFAULT_TYPE):
+    """Job periódico: una pasada por todas las sesiones, avisos en lote."""
+    ahora = datetime.now(LIMA_TZ)
+    futuros = []
+    if REPLICAS is None:
+        for chat_id, ud in list(user_data.items()):
+            for texto in recordatorios_pendientes(ud, ahora):
+                futuros.append(enviar(context.bot, chat_id, texto, PRIORIDAD_BAJA))
+    elif REPLICAS.es_lider:
+        # Con réplicas las sesiones viven en el KV: la líder las recorre y guarda las
+        # marcas con el lock del chat (un chat ocupado se revisa en la próxima pasada)
+        for clave in REPLICAS.kv.claves("sesion:"):
+            chat_id = int(clave.split(":", 1)[1])
+            avisos = []
+
+            def marcar(ud, avisos=avisos):
+                avisos.extend(recordatorios_pendientes(ud, ahora))
+                return bool(avisos)
+
+            if await REPLICAS.actualizar_sesion(chat_id, marcar, intentos=1):
+                futuros.extend(enviar(context.bot, chat_id, texto, PRIORIDAD_BAJA) for texto in avisos)
+    if futuros:
+        logger.info(f"[DEBUG] Recordatorios: {len(futuros)} avisos encolados")
+        resultados = await asyncio.gather(*futuros, return_exceptions=True)
+        fallidos = [r for r in resultados if isinstance(r, Exception)]
+        if fallidos:
+            logger.error(f"[ERROR] Recordatorios: {len(fallidos)} avisos fallaron ({fallidos[0]})")
+
+# -------------------- SERVIDOR LOCAL DE LA BOT API Y ARCHIVO DE FOTOS --------------------
+# Con TG_API_LOCAL el bot habla con un telegram-bot-api propio en modo --local: sin
+# el límite de 20 MB de descarga y, si comparte disco con el bot, get_file devuelve
+# la ruta del archivo en ese disco y la foto se copia sin pasar por HTTP. En modo
+# --local el servidor no sirve archivos por HTTP: si no comparte disco con el bot
+# las fotos no se pueden archivar (se registra el error; hay que montar el mismo
+# volumen en los dos).
+# El servidor local se prueba solo al arrancar: si entonces no responde, el proceso
+# entero usa la API pública; si se cae después, las llamadas fallan hasta que vuelva
+# (no se cambia de API en caliente, ver abajo) o se reinicie el bot.
+# Ojo: antes de pasar el bot a un servidor local hay que llamar a logOut en la API
+# pública (y a close en el local para volver); ver la documentación de la Bot API.
+# Con FOTOS_DIR cada selfie/foto de ATS se guarda en FOTOS_DIR/<grupo>/<fecha>/ en
+# segundo plano (no demora la respuesta; el apagado espera a las pendientes).
+TG_API_LOCAL = os.getenv("TG_API_LOCAL", "").rstrip("/")  # p.ej. "http://telegram-bot-api:8081"; vacío = API pública
+TG_API_LOCAL_TIMEOUT_SEG = float(os.getenv("TG_API_LOCAL_TIMEOUT_SEG", "3"))
+FOTOS_DIR = os.getenv("FOTOS_DIR", "")  # vacío = no se archivan fotos
+
+def servidor_local_disponible() -> bool:
+    """True si el servidor local de la Bot API responde getMe con este token."""
+    try:
+        with urllib.request.urlopen(f"{TG_API_LOCAL}/bot{BOT_TOKEN}/getMe", timeout=TG_API_LOCAL_TIMEOUT_SEG) as resp:
+            return json.load(resp).get("ok", False)
     except Exception as e:
-        logger.error(f"[ERROR] manejar_repeticion_fotos: {e}")
-        if update.callback_query:
-            await update.callback_query.message.reply_text("❌ Error interno al manejar repetición de fotos.")
+        logger.warning(f"[WARN] Servidor local de la Bot API no disponible ({TG_API_LOCAL}): {e}")
+        return False
 
-# -------------------- FOTO ATS/PETAR --------------------
+def configurar_api_telegram(builder):
+    """Apunta el ApplicationBuilder al servidor local si está configurado y responde."""
+    if not TG_API_LOCAL:
+        return builder
+    if not servidor_local_disponible():
+        logger.warning("[WARN] Se usa la API pública de Telegram")
+        return builder
+    logger.info(f"[DEBUG] Bot API local en {TG_API_LOCAL} (local_mode)")
+    return (
+        builder
+        .base_url(f"{TG_API_LOCAL}/bot")
+        .base_file_url(f"{TG_API_LOCAL}/file/bot")
+        .local_mode(True)
+    )
 
-async def foto_ats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+def archivar_foto(update: Update, context: ContextTypes.DEFAULT_TYPE, ud: dict, tipo: str):
+    """Programa la descarga de la foto del mensaje (la de mayor resolución) a FOTOS_DIR."""
+    if not FOTOS_DIR or not update.message or not update.message.photo:
+        return
+    foto = update.message.photo[-1]
+    destino = os.path.join(
+        FOTOS_DIR,
+        _sanitize_name(nombre_archivo_grupo(update)),
+        datetime.now(LIMA_TZ).strftime("%Y-%m-%d"),
+        f"{ud.get('jornada', '-')}_{tipo}_{foto.file_unique_id}.jpg",
+    )
+    tarea = asyncio.create_task(descargar_foto(context.bot, foto.file_id, destino))
+    ESCRITURAS_PENDIENTES.add(tarea)
+    tarea.add_done_callback(ESCRITURAS_PENDIENTES.discard)
+
+async def descargar_foto(bot, file_id: str, destino: str):
+    loop = asyncio.get_running_loop()
     try:
+        archivo = await bot.get_file(file_id)
+        await loop.run_in_executor(None, lambda: os.makedirs(os.path.dirname(destino), exist_ok=True))
+        if bot.local_mode:
+            # El servidor --local devuelve una ruta de su disco y no la sirve por HTTP
+            if not os.path.isfile(archivo.file_path):
+                logger.error(f"[ERROR] Foto {file_id} no archivada: {archivo.file_path} no está en este disco "
+                             f"(el servidor local de la Bot API debe compartir el volumen con el bot)")
+                return
+            await loop.run_in_executor(None, shutil.copyfile, archivo.file_path, destino)
+        else:
+            await archivo.download_to_drive(destino)
+        logger.info(f"[DEBUG] Foto archivada en {destino}")
+    except Exception as e:
+        logger.error(f"[ERROR] No se pudo archivar la foto {file_id}: {e}")
+
+# -------------------- MÁQUINA DE ESTADOS DEL FLUJO --------------------
+# Valores de user_data[chat_id]["paso"]. Se mantienen los valores históricos
+# (0, 1, 2, "tipo_trabajo", "selfie_salida", None) para no romper sesiones vivas.
+PASO_NOMBRE = 0                  # esperando el nombre de la cuadrilla
+PASO_TIPO = "tipo_trabajo"       # esperando el tipo de trabajo
+PASO_SELFIE_INICIO = 1           # esperando/confirmando selfie de inicio
+PASO_UBICACION = "ubicacion"     # esperando ubicación (solo con GEOCERCA_ACTIVA)
+PASO_ATS_PREGUNTA = "ats_pregunta"  # preguntando si se hizo ATS/PETAR
+PASO_ATS = 2                     # esperando/confirmando foto del ATS/PETAR
+PASO_SALIDA = "selfie_salida"    # jornada en curso, esperando selfie de salida
+PASO_FIN = None                  # jornada finalizada
+
+# Eventos que no son callback_data de un botón
+EVENTO_TEXTO = "texto"
+EVENTO_FOTO = "foto"
+EVENTO_UBICACION = "ubicacion"
+
+# callback_data de todos los botones que el bot puede mostrar (se llena con boton())
+EVENTOS_EMITIDOS = set()
+
+def boton(texto: str, evento: str) -> InlineKeyboardButton:
+    """Crea un botón inline y registra su callback_data como evento del flujo."""
+    EVENTOS_EMITIDOS.add(evento)
+    return InlineKeyboardButton(texto, callback_data=evento)
+
+
+# Teclados del flujo (se crean una sola vez; así sus eventos quedan registrados al importar)
+TECLADO_CONFIRMAR_NOMBRE = InlineKeyboardMarkup([
+    [boton("✅ Confirma el nombre de tu cuadrilla", "confirmar_nombre")],
+    [boton("✏️ Corregir nombre", "corregir_nombre")],
+])
+TECLADO_TIPO_TRABAJO = InlineKeyboardMarkup([
+    [boton("📌 Ordenamiento", "tipo_ordenamiento")],
+    [boton("🏷 Etiquetado", "tipo_etiquetado")],
+])
+TECLADO_SELFIE_INICIO = InlineKeyboardMarkup([
+    [boton("🔄 Repetir Selfie", "repetir_foto_inicio")],
+    [boton("📝📋 Continuar con ATS/PETAR", "continuar_ats")],
+])
+TECLADO_ATS = InlineKeyboardMarkup([
+    [boton("✅ ATS/PETAR Sí", "ats_si")],
+    [boton("❌ ATS/PETAR No", "ats_no")],
+])
+TECLADO_FOTO_ATS = InlineKeyboardMarkup([
+    [boton("🔄 Repetir Foto ATS/PETAR", "repetir_foto_ats")],
+    [boton("➡️ Continuar a jornada", "continuar_post_ats")],
+])
+TECLADO_ATS_NO = InlineKeyboardMarkup([
+    [boton("📸 Enviar foto de ATS/PETAR de todas formas", "reenviar_ats")]
+])
+TECLADO_SELFIE_SALIDA = InlineKeyboardMarkup([
+    [boton("🔄 Repetir Selfie de Salida", "repetir_foto_salida")],
+    [boton("✅ Finalizar Jornada", "finalizar_salida")],
+])
+
+
+class Transicion:
+    __slots__ = ("accion", "siguiente")
+
+    def __init__(self, accion, siguiente):
+        self.accion = accion
+        self.siguiente = siguiente
+
+
+class MaquinaEstados:
+    """
+    Tabla de transiciones (estado, evento) -> (acción, siguiente estado).
+    La acción es una corrutina (update, context, ud); si devuelve False la
+    transición se cancela y el estado no cambia.
+    """
+
+    def __init__(self, inicial, finales=(), entradas=()):
+        self.inicial = inicial
+        self.finales = set(finales)
+        # Estados a los que se entra desde fuera de la tabla (p.ej. /ingreso, /salida)
+        self.entradas = set(entradas)
+        self.tabla: dict[tuple, Transicion] = {}
+
+    def agregar(self, estado, evento, accion, siguiente):
+        clave = (estado, evento)
+        if clave in self.tabla:
+            raise ValueError(f"Transición duplicada: {clave}")
+        self.tabla[clave] = Transicion(accion, siguiente)
+
+    def buscar(self, estado, evento) -> Transicion | None:
+        return self.tabla.get((estado, evento))
+
+    def estados(self) -> set:
+        todos = {self.inicial} | self.finales | self.entradas
+        for (estado, _), t in self.tabla.items():
+            todos.add(estado)
+            todos.add(t.siguiente)
+        return todos
+
+    def validar(self, eventos_emitidos=()) -> list[str]:
+        """Devuelve la lista de problemas del grafo (vacía si está completo)."""
+        errores = []
+        salientes = {}
+        for (estado, evento), t in self.tabla.items():
+            salientes.setdefault(estado, set()).add(evento)
+            if not asyncio.iscoroutinefunction(t.accion):
+                errores.append(f"{estado!r} --{evento}--> acción no es async: {t.accion!r}")
+
+        # 1) Todo estado no final debe tener alguna salida
+        for estado in self.estados():
+            if estado not in self.finales and not salientes.get(estado):
+                errores.append(f"Estado sin salida: {estado!r}")
+
+        # 2) Todo estado debe ser alcanzable desde el inicial o una entrada externa
+        alcanzables = set()
+        pendientes = [self.inicial, *self.entradas]
+        while pendientes:
+            estado = pendientes.pop()
+            if estado in alcanzables:
+                continue
+            alcanzables.add(estado)
+            pendientes.extend(
+                t.siguiente for (e, _), t in self.tabla.items() if e == estado
+            )
+        for estado in self.estados() - alcanzables:
+            errores.append(f"Estado inalcanzable: {estado!r}")
+
+        # 3) Todo botón que el bot muestra debe tener al menos una transición
+        eventos_tabla = {evento for (_, evento) in self.tabla}
+        for evento in sorted(set(eventos_emitidos) - eventos_tabla):
+            errores.append(f"Botón sin transición: {evento!r}")
+
+        return errores
+
+    def diagrama(self) -> str:
+        """Exporta el grafo en formato Graphviz DOT."""
+        lineas = ["digraph flujo {", "  rankdir=LR;"]
+        lineas.append(f'  "{self.inicial}" [shape=doublecircle];')
+        for estado in self.finales:
+            lineas.append(f'  "{estado}" [shape=box];')
+        for (estado, evento), t in self.tabla.items():
+            lineas.append(
+                f'  "{estado}" -> "{t.siguiente}" [label="{evento}\\n{t.accion.__name__}"];'
+            )
+        lineas.append("}")
+        return "\n".join(lineas)
+
+    async def despachar(self, chat_id: int, evento: str, update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+        """
+        Ejecuta la transición (estado actual, evento). Devuelve False si no existe
+        transición para ese par. Un chat sin sesión está en el estado inicial.
+        """
+        ud = user_data.get(chat_id)
+        estado = ud.get("paso") if ud is not None else self.inicial
+        t = self.tabla.get((estado, evento))
+        if t is None:
+            logger.info(f"[DEBUG] Sin transición para ({estado!r}, {evento!r}) chat_id={chat_id}")
+            return False
+
+        if ud is None:
+            ud = user_data.setdefault(chat_id, {"paso": self.inicial})
+        resultado = await t.accion(update, context, ud)
+        if resultado is False:
+            logger.info(f"[DEBUG] Transición cancelada por {t.accion.__name__} (paso={estado!r})")
+            return True
+
+        if ud.get("paso") != t.siguiente:
+            ud["paso"] = t.siguiente
+            logger.info(f"[DEBUG] Paso {estado!r} --{evento}--> {t.siguiente!r} (chat {chat_id})")
+        return True
+
+# -------------------- VALIDACIÓN DE CONTENIDO --------------------
+
+async def validar_contenido(update: Update, tipo: str):
+    if tipo == "texto" and not update.message.text:
+        await responder(update.message, "⚠️ Debes enviar el *nombre de tu cuadrilla* en texto. ✍️📝")
+        return False
+    if tipo == "foto" and not update.message.photo:
+        await responder(update.message, "⚠️ Debes enviar una *foto*, no texto.🤳📸")
+        return False
+    return True
+
+# -------------------- COMANDOS DEL BOT --------------------
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.chat.type in ['group', 'supergroup']:
         if not mensaje_es_para_bot(update, context):
             return
 
-        chat_id = update.effective_chat.id
-        ud = user_data.get(chat_id) or {}
+    await responder(update.message,
+        "👋 ¡Hola! Para iniciar, usa el comando /ingreso y etiquetame 💪💪."
+    )
 
-        # Debe venir de "ats_si" (paso 2)
-        if ud.get("paso") != 2:
-            return
-        if not await validar_contenido(update, "foto"):
+async def ingreso(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.chat.type in ['group', 'supergroup']:
+        if not mensaje_es_para_bot(update, context):
             return
 
-        # Asegurar Spreadsheet + Hoja + Fila activa
-        spreadsheet_id = ud.get("spreadsheet_id")
-        row = ud.get("row")
-
-        if not spreadsheet_id or not row:
-            # Fallback: si por alguna razón no existe, lo creamos
-            spreadsheet_id = ensure_spreadsheet_for_group(update)
-            ensure_sheet_and_headers(spreadsheet_id)
-            base = {
-                "CUADRILLA": ud.get("cuadrilla", ""),
-                "TIPO DE TRABAJO": ud.get("tipo", "")
-            }
-            row = append_base_row(spreadsheet_id, base)
-            ud["spreadsheet_id"] = spreadsheet_id
-            ud["row"] = row
+    chat_id = update.effective_chat.id
+    user_data[chat_id] = {"paso": PASO_NOMBRE, "jornada": nueva_jornada()}  # 👈 Reinicia el flujo al paso 0
 
-        # Marcar ATS/PETAR = "Sí" (solo esa celda) SIN cambiar el paso (se cambia con continuar_post_ats)
-        loop = asyncio.get_running_loop()
-        await loop.run_in_executor(
-            None,
-            update_single_cell,
-            spreadsheet_id,
-            SHEET_TITLE,
-            COL["ATS/PETAR"],   # normalmente "E"
-            row,
-            "Sí"
+    await responder(update.message,
+        "✍️ Escribe el nombre de tu cuadrilla\n\n"
+        "Ejemplo:\nT1: Juan Pérez\nT2: José Flores"
+    )
+
+# -------------------- NOMBRE CUADRILLA --------------------
+async def nombre_cuadrilla(update: Update, context: ContextTypes.DEFAULT_TYPE, ud: dict):
+    try:
+        logger.info("[DEBUG] Entrando en nombre_cuadrilla...")
+        if not mensaje_es_para_bot(update, context):
+            logger.info("[DEBUG] mensaje_es_para_bot devolvió False.")
+            return False
+
+        if not await validar_contenido(update, "texto"):
+            logger.info("[DEBUG] validar_contenido devolvió False.")
+            return False
+
+        ud["cuadrilla"] = update.message.text.strip()
+        logger.info(f"[DEBUG] Cuadrilla recibida: {ud['cuadrilla']}")
+
+        await responder(update.message,
+            f"Has ingresado la cuadrilla:\n*{ud['cuadrilla']}*\n\n¿Es correcto?",
+            parse_mode="Markdown",
+            reply_markup=TECLADO_CONFIRMAR_NOMBRE,
         )
+        logger.info("[DEBUG] Botones enviados correctamente.")
+    except Exception as e:
+        logger.error(f"[ERROR] nombre_cuadrilla: {e}")
+        await responder(update.message, "❌ Error interno al procesar el nombre de cuadrilla.")
+        return False
+
+
+# ------------------ HANDLE NOMBRE CUADRILLA ------------------ #
+
+async def confirmar_nombre(update: Update, context: ContextTypes.DEFAULT_TYPE, ud: dict):
+    query = update.callback_query
+    chat_id = query.message.chat.id
+    try:
+        # Guardas mínimas
+        if not ud.get("cuadrilla", "").strip():
+            logger.warning(f"[WARN] No hay 'cuadrilla' para chat {chat_id}.")
+            await editar(query, "⚠️ No encontré el nombre de la cuadrilla. Escribe de nuevo y confirma.")
+            return False
+
+        # Idempotencia: si ya existe fila creada, no vuelvas a crear otra
+        if ud.get("spreadsheet_id") and ud.get("row"):
+            logger.info(f"[DEBUG] Fila ya creada (sheet={ud['spreadsheet_id']}, row={ud['row']}). Saltando append.")
+        else:
+            # Asegurar Sheet del grupo, crear la fila base y guardar referencia
+            spreadsheet_id, sheet_title, fila = await google_io(asegurar_fila, update, ud)
+            logger.info(f"[DEBUG] Fila creada -> sheet={spreadsheet_id}, row={fila}, cuadrilla='{ud['cuadrilla']}'")
+
+        await editar(query, "Selecciona el tipo de trabajo:", reply_markup=TECLADO_TIPO_TRABAJO)
+
+    except Exception as e:
+        logger.error(f"[ERROR] confirmar_nombre: {e}")
+        await responder(query.message, "❌ Error interno en la confirmación de cuadrilla.")
+        return False
+
+
+async def corregir_nombre(update: Update, context: ContextTypes.DEFAULT_TYPE, ud: dict):
+    ud["cuadrilla"] = ""
+    logger.info(f"[DEBUG] Corrección de cuadrilla. Estado -> {ud}")
+    await editar(update.callback_query,
+        "✍️ *Escribe el nombre de tu cuadrilla*\n\n"
+        "*Ejemplo:*\n"
+        "*T1: Juan Pérez*\n"
+        "*T2: José Flores*\n",
+        parse_mode="Markdown"
+    )
+
+
+# ------------------ HANDLE TIPO TRABAJO ------------------ #
+
+async def handle_tipo_trabajo(update: Update, context: ContextTypes.DEFAULT_TYPE, ud: dict):
+    query = update.callback_query
+    try:
+        # 1) Determinar el tipo
+        tipo = "Ordenamiento" if query.data == "tipo_ordenamiento" else "Etiquetado"
+        ud["tipo"] = tipo
+
+        # 2) Asegurar que ya tenemos spreadsheet + fila
+        spreadsheet_id, sheet_title, row = await google_io(asegurar_fila, update, ud)
+
+        # 3) Actualizar SOLO la celda "TIPO DE TRABAJO" en esa fila
+        await google_io(escribir_en_jornada, ud, {"TIPO DE TRABAJO": tipo})
+        logger.info(f"[DEBUG] Tipo de trabajo: {tipo}, row={row}, state={ud}")
+
+        # 4) Pedir selfie de ingreso
+        await editar(query,
+            f"Tipo de trabajo seleccionado: *{tipo}*\n\n📸 Ahora envía tu selfie de inicio.",
+            parse_mode="Markdown"
+        )
+
+    except Exception as e:
+        logger.error(f"[ERROR] handle_tipo_trabajo: {e}")
+        await responder(query.message, "❌ Error interno al seleccionar el tipo de trabajo.")
+        return False
+
+# -------------------- FOTO INGRESO --------------------
+
+async def foto_ingreso(update: Update, context: ContextTypes.DEFAULT_TYPE, ud: dict):
+    chat_id = update.effective_chat.id
+    if not mensaje_es_para_bot(update, context):
+        return False
+    if not await validar_contenido(update, "foto"):
+        return False
+
+    # Verifica que tengamos hoja y fila
+    spreadsheet_id = ud.get("spreadsheet_id")
+    row = ud.get("row")
+    if not spreadsheet_id or not row:
+        logger.error(f"[ERROR] foto_ingreso: faltan spreadsheet_id/row en user_data[{chat_id}] = {ud}")
+        await responder(update.message, "❌ No hay registro activo. Usa /ingreso para iniciar.")
+        return False
+
+    ahora = datetime.now(LIMA_TZ)
+    hora_ingreso = ahora.strftime("%H:%M")
+    ud["hora_ingreso"] = hora_ingreso
+    ud["fecha_ingreso"] = ahora.strftime("%Y-%m-%d")
+
+    # Actualizamos SOLO la celda de HORA INGRESO en esa fila
+    try:
+        await google_io(escribir_en_jornada, ud, {"HORA INGRESO": hora_ingreso})
+    except Exception as e:
+        logger.error(f"[ERROR] foto_ingreso: {e}")
+        await responder(update.message, "❌ No se pudo guardar la hora de ingreso.")
+        return False
+    registrar_asistencia(update, ud, "ingreso")
+    archivar_foto(update, context, ud, "ingreso")
+
+    await responder(update.message, "¿Es correcto el selfie de inicio?", reply_markup=TECLADO_SELFIE_INICIO)
+
+
+# -------------------- REPETICIÓN DE FOTOS / BOTONERAS --------------------
+
+async def repetir_foto_inicio(update: Update, context: ContextTypes.DEFAULT_TYPE, ud: dict):
+    await editar(update.callback_query,
+        "📸 Envía nuevamente tu *selfie de inicio*.", parse_mode="Markdown"
+    )
+
+async def continuar_ats(update: Update, context: ContextTypes.DEFAULT_TYPE, ud: dict):
+    await editar(update.callback_query, "¿Realizaste ATS/PETAR?", reply_markup=TECLADO_ATS)
+
+async def repetir_foto_ats(update: Update, context: ContextTypes.DEFAULT_TYPE, ud: dict):
+    await editar(update.callback_query,
+        "📸 Envía nuevamente la *foto del ATS/PETAR*.", parse_mode="Markdown"
+    )
+
+async def reenviar_ats(update: Update, context: ContextTypes.DEFAULT_TYPE, ud: dict):
+    # Opción cuando eligieron "No" pero quieren enviar foto igual
+    await editar(update.callback_query,
+        "Ok. 📸 Envía la *foto del ATS/PETAR* de todas formas.", parse_mode="Markdown"
+    )
+
+async def continuar_post_ats(update: Update, context: ContextTypes.DEFAULT_TYPE, ud: dict):
+    query = update.callback_query
+    chat_id = query.message.chat.id
+
+    # 1) Edita el mensaje anterior para cerrar el hilo
+    await editar(query, "✅ ¡Registro completado!")
+
+    # 2) Envía el motivador y guarda su message_id para ignorar replies
+    mensaje = await enviar(
+        context.bot,
+        chat_id,
+        "¡Excelente! 🎉 Ya estás listo para comenzar.\n\n💪 *Puedes iniciar tu jornada.* 💪",
+        parse_mode="Markdown"
+    )
+    ud["msg_id_motivador"] = mensaje.message_id
+
+# -------------------- FOTO ATS/PETAR --------------------
+
+async def foto_ats(update: Update, context: ContextTypes.DEFAULT_TYPE, ud: dict):
+    try:
+        if not mensaje_es_para_bot(update, context):
+            return False
+
+        if not await validar_contenido(update, "foto"):
+            return False
+
+        # Marcar ATS/PETAR = "Sí" (solo esa celda) SIN cambiar el paso (se cambia con continuar_post_ats).
+        # Si es una foto repetida y ya se escribió "Sí" en esta jornada, no se vuelve a escribir.
+        clave = clave_evento(update.effective_chat.id, "ats_si", ud)
+        if await consultar_idempotencia(clave) is None:
+            # Asegurar Spreadsheet + Hoja + Fila activa
+            spreadsheet_id, sheet_title, row = await google_io(asegurar_fila, update, ud)
+            await google_io(escribir_en_jornada, ud, {"ATS/PETAR": "Sí"})
+            await registrar_idempotencia(clave)
+            registrar_asistencia(update, ud, "ats_Sí")
 
         ud["ats_foto"] = "OK"
-        user_data[chat_id] = ud
-        logger.info(f"[DEBUG] ATS/PETAR='Sí' escrito en fila={row}, sheet={spreadsheet_id}")
+        archivar_foto(update, context, ud, "ats")
+        logger.info(f"[DEBUG] ATS/PETAR='Sí' en fila={ud.get('row')}, sheet={ud.get('spreadsheet_id')}")
 
         # Botonera para confirmar o repetir
-        keyboard = [
-            [InlineKeyboardButton("🔄 Repetir Foto ATS/PETAR", callback_data="repetir_foto_ats")],
-            [InlineKeyboardButton("➡️ Continuar a jornada", callback_data="continuar_post_ats")],
-        ]
-        await update.message.reply_text(
+        await responder(update.message,
             "¿Es correcta la foto del ATS/PETAR?",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=TECLADO_FOTO_ATS
         )
 
     except Exception as e:
         logger.error(f"[ERROR] foto_ats: {e}")
-        await update.message.reply_text("❌ Error al registrar la foto del ATS/PETAR. Intenta de nuevo.")
+        await responder(update.message, "❌ Error al registrar la foto del ATS/PETAR. Intenta de nuevo.")
+        return False
 
 # -------------------- HANDLE ATS/PETAR --------------------
-async def handle_ats_petar(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        query = update.callback_query
-        if not query:
-            logger.warning("[DEBUG] handle_ats_petar llamado sin callback_query.")
-            return
 
-        chat_id = query.message.chat.id
-        await query.answer()
-        data = query.data
-        logger.info(f"[DEBUG] handle_ats_petar: chat_id={chat_id}, data={data}")
-
-        # Traer ids guardados al confirmar nombre (o crear fallback si faltan)
-        spreadsheet_id = user_data.get(chat_id, {}).get("spreadsheet_id")
-        row = user_data.get(chat_id, {}).get("row")
-
-        # --- ATS: Sí -> pedimos foto y paso=2
-        if data == "ats_si":
-            user_data.setdefault(chat_id, {})["paso"] = 2
-            logger.info(f"[DEBUG] Paso cambiado a 2 (espera foto ATS/PETAR) para chat {chat_id}")
-            await query.edit_message_text(
-                "📸 *Por favor, envía la foto del ATS/PETAR para continuar.*",
-                parse_mode="Markdown"
-            )
-            return
+async def ats_si(update: Update, context: ContextTypes.DEFAULT_TYPE, ud: dict):
+    # ATS: Sí -> pedimos foto (paso=2)
+    await editar(update.callback_query,
+        "📸 *Por favor, envía la foto del ATS/PETAR para continuar.*",
+        parse_mode="Markdown"
+    )
 
-        # --- ATS: No -> escribir 'No' en la fila y pasar a selfie_salida
-        if data == "ats_no":
+async def ats_no(update: Update, context: ContextTypes.DEFAULT_TYPE, ud: dict):
+    # ATS: No -> escribir 'No' en la fila y pasar a selfie_salida
+    query = update.callback_query
+    try:
+        clave = clave_evento(query.message.chat.id, "ats_no", ud)
+        if await consultar_idempotencia(clave) is None:
             # Fallback por si falta spreadsheet o fila (no debería, pero por seguridad)
-            if not spreadsheet_id:
-                spreadsheet_id = ensure_spreadsheet_for_group(update)
-                ensure_sheet_and_headers(spreadsheet_id)
-                user_data.setdefault(chat_id, {})["spreadsheet_id"] = spreadsheet_id
-
-            if not row:
-                base = {
-                    "CUADRILLA": user_data.get(chat_id, {}).get("cuadrilla", ""),
-                    "TIPO DE TRABAJO": user_data.get(chat_id, {}).get("tipo", ""),
-                }
-                row = append_base_row(spreadsheet_id, base)
-                user_data[chat_id]["row"] = row
-                logger.info(f"[DEBUG] Fallback: creada fila base {row} para chat {chat_id}")
+            spreadsheet_id, sheet_title, row = await google_io(asegurar_fila, update, ud)
 
             # Actualizar solo la celda ATS/PETAR de esa fila
-            set_cell_value(spreadsheet_id, SHEET_TITLE, f"{COL['ATS/PETAR']}{row}", "No")
+            await google_io(escribir_en_jornada, ud, {"ATS/PETAR": "No"})
+            await registrar_idempotencia(clave)
+            registrar_asistencia(update, ud, "ats_No")
             logger.info(f"[DEBUG] ATS/PETAR='No' escrito en fila {row}")
 
-            user_data[chat_id]["paso"] = "selfie_salida"
-
-            # Botón por si igual desean enviar foto del ATS
-            keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton("📸 Enviar foto de ATS/PETAR de todas formas", callback_data="reenviar_ats")]
-            ])
-
-            await query.edit_message_text(
-                "⚠️ *Recuerda siempre realizar ATS/PETAR antes de iniciar la jornada.* ⚠️\n\n"
-                "✅ Previenes accidentes.\n"
-                "✅ Proteges tu vida y la de tu equipo.\n\n"
-                "¡La seguridad empieza contigo! 💪",
-                parse_mode="Markdown",
-                reply_markup=keyboard
-            )
-            return
-
-        # --- Reabrir la botonera ATS si llegan desde 'reenviar_ats'
-        if data == "reenviar_ats":
-            ats_keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton("✅ ATS/PETAR Sí", callback_data="ats_si")],
-                [InlineKeyboardButton("❌ ATS/PETAR No", callback_data="ats_no")],
-            ])
-            await query.edit_message_text("¿Realizaste ATS/PETAR?", reply_markup=ats_keyboard)
-            return
-
-        logger.warning(f"[DEBUG] handle_ats_petar: callback no manejado -> {data}")
+        # Botón por si igual desean enviar foto del ATS (TECLADO_ATS_NO)
+        await editar(query,
+            "⚠️ *Recuerda siempre realizar ATS/PETAR antes de iniciar la jornada.* ⚠️\n\n"
+            "✅ Previenes accidentes.\n"
+            "✅ Proteges tu vida y la de tu equipo.\n\n"
+            "¡La seguridad empieza contigo! 💪",
+            parse_mode="Markdown",
+            reply_markup=TECLADO_ATS_NO
+        )
 
     except Exception as e:
-        logger.error(f"[ERROR] handle_ats_petar: {e}")
-        try:
-            await update.callback_query.message.reply_text("❌ Error interno en ATS/PETAR.")
-        except Exception:
-            pass
+        logger.error(f"[ERROR] ats_no: {e}")
+        await responder(query.message, "❌ Error interno en ATS/PETAR.")
+        return False
 
 
 # -------------------- BREAK OUT --------------------
@@ -911,35 +3868,29 @@ async def breakout(update: Update, context: ContextTypes.DEFAULT_TYPE):
         chat_id = update.effective_chat.id
         hora = datetime.now(LIMA_TZ).strftime("%H:%M")
 
-        # Traer el spreadsheet y la fila de la jornada actual
-        spreadsheet_id = user_data.get(chat_id, {}).get("spreadsheet_id")
-        row = user_data.get(chat_id, {}).get("row")
-
-        # Fallbacks por si algo faltara (no debería, pero mejor seguros)
-        if not spreadsheet_id:
-            spreadsheet_id = ensure_spreadsheet_for_group(update)
-            ensure_sheet_and_headers(spreadsheet_id)
-            user_data.setdefault(chat_id, {})["spreadsheet_id"] = spreadsheet_id
-            logger.info(f"[DEBUG] breakout: creado/asegurado spreadsheet_id={spreadsheet_id}")
-
-        if not row:
-            base = {
-                "CUADRILLA": user_data.get(chat_id, {}).get("cuadrilla", ""),
-                "TIPO DE TRABAJO": user_data.get(chat_id, {}).get("tipo", ""),
-            }
-            row = append_base_row(spreadsheet_id, base)
-            user_data[chat_id]["row"] = row
-            logger.info(f"[DEBUG] breakout: creada fila base row={row}")
+        # Evento lógico ya registrado en esta jornada: no repetir la escritura
+        ud = user_data.setdefault(chat_id, {})
+        clave = clave_evento(chat_id, "breakout", ud)
+        previa = await consultar_idempotencia(clave)
+        if previa:
+            await responder(update.message, f"⚠️ La salida a break ya estaba registrada a las {previa}.")
+            return
+
+        # Traer el spreadsheet y la fila de la jornada actual (o crearla si faltara)
+        spreadsheet_id, sheet_title, row = await google_io(asegurar_fila, update, ud)
 
         # Escribir solo la celda de HORA BREAK OUT en la fila actual
-        set_cell_value(spreadsheet_id, SHEET_TITLE, f"{COL['HORA BREAK OUT']}{row}", hora)
-        logger.info(f"[DEBUG] breakout: set {COL['HORA BREAK OUT']}{row} = {hora}")
+        await google_io(escribir_en_jornada, ud, {"HORA BREAK OUT": hora})
+        logger.info(f"[DEBUG] breakout: set {COL['HORA BREAK OUT']}{ud['row']} = {hora}")
+        await registrar_idempotencia(clave, hora)
+        registrar_asistencia(update, ud, "breakout")
+        ud["breakout_ts"] = time.time()  # para el recordatorio de break largo
 
-        await update.message.reply_text(f"🍽️😋 Salida a Break 😋🍽️, registrado a las {hora}.💪💪")
+        await responder(update.message, f"🍽️😋 Salida a Break 😋🍽️, registrado a las {hora}.💪💪")
 
     except Exception as e:
         logger.error(f"[ERROR] breakout: {e}")
-        await update.message.reply_text("❌ Error registrando Break Out. Intenta de nuevo.")
+        await responder(update.message, "❌ Error registrando Break Out. Intenta de nuevo.")
 
 
 # -------------------- BREAK IN --------------------
@@ -952,39 +3903,32 @@ async def breakin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         chat_id = update.effective_chat.id
         hora = datetime.now(LIMA_TZ).strftime("%H:%M")
 
-        # Recuperar contexto de la jornada actual
-        spreadsheet_id = user_data.get(chat_id, {}).get("spreadsheet_id")
-        row = user_data.get(chat_id, {}).get("row")
-
-        # Fallback: asegurar spreadsheet y headers
-        if not spreadsheet_id:
-            spreadsheet_id = ensure_spreadsheet_for_group(update)
-            ensure_sheet_and_headers(spreadsheet_id)
-            user_data.setdefault(chat_id, {})["spreadsheet_id"] = spreadsheet_id
-            logger.info(f"[DEBUG] breakin: creado/asegurado spreadsheet_id={spreadsheet_id}")
-
-        # Fallback: si no hay fila activa, crear base
-        if not row:
-            base = {
-                "CUADRILLA": user_data.get(chat_id, {}).get("cuadrilla", ""),
-                "TIPO DE TRABAJO": user_data.get(chat_id, {}).get("tipo", ""),
-            }
-            row = append_base_row(spreadsheet_id, base)
-            user_data[chat_id]["row"] = row
-            logger.info(f"[DEBUG] breakin: creada fila base row={row}")
+        # Evento lógico ya registrado en esta jornada: no repetir la escritura
+        ud = user_data.setdefault(chat_id, {})
+        clave = clave_evento(chat_id, "breakin", ud)
+        previa = await consultar_idempotencia(clave)
+        if previa:
+            await responder(update.message, f"⚠️ El regreso de break ya estaba registrado a las {previa}.")
+            return
+
+        # Recuperar contexto de la jornada actual (o crearla si faltara)
+        spreadsheet_id, sheet_title, row = await google_io(asegurar_fila, update, ud)
 
         # Escribir solo la celda de HORA BREAK IN
-        set_cell_value(spreadsheet_id, SHEET_TITLE, f"{COL['HORA BREAK IN']}{row}", hora)
-        logger.info(f"[DEBUG] breakin: set {COL['HORA BREAK IN']}{row} = {hora}")
+        await google_io(escribir_en_jornada, ud, {"HORA BREAK IN": hora})
+        logger.info(f"[DEBUG] breakin: set {COL['HORA BREAK IN']}{ud['row']} = {hora}")
+        await registrar_idempotencia(clave, hora)
+        registrar_asistencia(update, ud, "breakin")
+        ud.pop("breakout_ts", None)
 
-        await update.message.reply_text(
+        await responder(update.message,
             f"🚶🚀 Regreso de Break 🚀🚶, registrado a las {hora}👀👀.\n\n"
             " 💪 *Puedes continuar tu jornada.* 💪 "
         )
 
     except Exception as e:
         logger.error(f"[ERROR] breakin: {e}")
-        await update.message.reply_text("❌ Error registrando Break In. Intenta de nuevo.")
+        await responder(update.message, "❌ Error registrando Break In. Intenta de nuevo.")
 
 
 # -------------------- SALIDA --------------------
@@ -996,141 +3940,297 @@ async def salida(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         chat_id = update.effective_chat.id
 
-        # Recuperar lo que ya tenemos guardado
+        # Recuperar lo que ya tenemos guardado; si por algún motivo no hay fila activa, creamos una base
         ud = user_data.setdefault(chat_id, {})
-        spreadsheet_id = ud.get("spreadsheet_id")
-        row = ud.get("row")
-
-        # Asegurar que existe el spreadsheet del grupo y la hoja con headers
-        if not spreadsheet_id:
-            spreadsheet_id = ensure_spreadsheet_for_group(update)
-            ensure_sheet_and_headers(spreadsheet_id)
-            ud["spreadsheet_id"] = spreadsheet_id
-            logger.info(f"[DEBUG] salida: asegurado spreadsheet_id={spreadsheet_id}")
-
-        # Si por algún motivo no hay fila activa, creamos una base
-        if not row:
-            base = {
-                "CUADRILLA": ud.get("cuadrilla", ""),
-                "TIPO DE TRABAJO": ud.get("tipo", ""),
-            }
-            row = append_base_row(spreadsheet_id, base)
-            ud["row"] = row
-            logger.info(f"[DEBUG] salida: creada fila base row={row}")
+        spreadsheet_id, sheet_title, row = await google_io(asegurar_fila, update, ud)
 
         # Solo cambiamos el paso, sin resetear user_data del chat
-        ud["paso"] = "selfie_salida"
+        ud["paso"] = PASO_SALIDA
         logger.info(f"[DEBUG] salida: paso='selfie_salida' chat_id={chat_id}, row={row}")
 
-        await update.message.reply_text("📸 Envía tu selfie de salida para finalizar la jornada.")
+        await responder(update.message, "📸 Envía tu selfie de salida para finalizar la jornada.")
     except Exception as e:
         logger.error(f"[ERROR] salida: {e}")
-        await update.message.reply_text("❌ Error preparando la salida. Intenta de nuevo.")
+        await responder(update.message, "❌ Error preparando la salida. Intenta de nuevo.")
 
 
 # -------------------- CALLBACK SALIDA --------------------
-async def manejar_salida_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        query = update.callback_query
-        if not query:  # Aseguramos que es callback
-            logger.warning("[DEBUG] manejar_salida_callback llamado sin callback_query.")
-            return
 
-        chat_id = query.message.chat.id
-        await query.answer()
-        logger.info(f"[DEBUG] manejar_salida_callback: chat_id={chat_id}, data={query.data}, user_data={user_data.get(chat_id)}")
-
-        if query.data == "repetir_foto_salida":
-            user_data[chat_id]["paso"] = "selfie_salida"
-            logger.info(f"[DEBUG] Paso cambiado a 'selfie_salida' para chat {chat_id}")
-            await query.edit_message_text(
-                "🔄 Por favor, envía nuevamente tu *selfie de salida*.",
-                parse_mode="Markdown"
-            )
-
-        elif query.data == "finalizar_salida":
-            user_data[chat_id]["paso"] = None
-            logger.info(f"[DEBUG] Jornada finalizada para chat {chat_id}")
-            await query.edit_message_text(
-                "💪 *¡Buen trabajo! Jornada finalizada.*\n\n"
-                "👏 *Gracias por tu apoyo hoy.*\n\n"
-                "🫡 ¡Cambio y fuera! 🫡",
-                parse_mode="Markdown"
-            )
+async def repetir_foto_salida(update: Update, context: ContextTypes.DEFAULT_TYPE, ud: dict):
+    await editar(update.callback_query,
+        "🔄 Por favor, envía nuevamente tu *selfie de salida*.",
+        parse_mode="Markdown"
+    )
 
-    except Exception as e:
-        logger.error(f"[ERROR] manejar_salida_callback: {e}")
-        if update.callback_query:
-            await update.callback_query.message.reply_text("❌ Error interno en la salida.")
+async def finalizar_salida(update: Update, context: ContextTypes.DEFAULT_TYPE, ud: dict):
+    logger.info(f"[DEBUG] Jornada finalizada para chat {update.callback_query.message.chat.id}")
+    await editar(update.callback_query,
+        "💪 *¡Buen trabajo! Jornada finalizada.*\n\n"
+        "👏 *Gracias por tu apoyo hoy.*\n\n"
+        "🫡 ¡Cambio y fuera! 🫡",
+        parse_mode="Markdown"
+    )
 
 # -------------------- SELFIE SALIDA --------------------
 
-async def selfie_salida(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def selfie_salida(update: Update, context: ContextTypes.DEFAULT_TYPE, ud: dict):
     try:
         # ⚠️ No valides mensaje_es_para_bot aquí: la foto puede venir sin mención
-        chat_id = update.effective_chat.id
-        ud = user_data.get(chat_id) or {}
-
-        # Solo procede si estamos pidiendo selfie de salida
-        if ud.get("paso") != "selfie_salida":
-            logger.info(f"[DEBUG] selfie_salida ignorado, paso actual: {ud}")
-            return
-
         if not await validar_contenido(update, "foto"):
-            return
+            return False
 
         # Asegurar Spreadsheet + Hoja + Fila activa
-        spreadsheet_id = ud.get("spreadsheet_id")
-        if not spreadsheet_id:
-            spreadsheet_id = ensure_spreadsheet_for_group(update)
-            ensure_sheet_and_headers(spreadsheet_id)
-            ud["spreadsheet_id"] = spreadsheet_id
-        else:
-            ensure_sheet_and_headers(spreadsheet_id)  # idempotente
-
-        row = ud.get("row")
-        if not row:
-            base = {
-                "CUADRILLA": ud.get("cuadrilla", ""),
-                "TIPO DE TRABAJO": ud.get("tipo", "")
-            }
-            row = append_base_row(spreadsheet_id, base)
-            ud["row"] = row
+        spreadsheet_id, sheet_title, row = await google_io(asegurar_fila, update, ud)
 
         # Escribir HORA SALIDA en la celda de la fila activa
         hora_salida = datetime.now(LIMA_TZ).strftime("%H:%M")
-        loop = asyncio.get_running_loop()
-        await loop.run_in_executor(
-            None,
-            update_single_cell,
-            spreadsheet_id,
-            SHEET_TITLE,
-            COL["HORA SALIDA"],  # p.ej. "I"
-            row,
-            hora_salida
-        )
+        await google_io(escribir_en_jornada, ud, {"HORA SALIDA": hora_salida})
         ud["hora_salida"] = hora_salida
-        user_data[chat_id] = ud
+        registrar_asistencia(update, ud, "salida")
+        archivar_foto(update, context, ud, "salida")
         logger.info(f"[DEBUG] HORA SALIDA '{hora_salida}' escrita en {COL['HORA SALIDA']}{row} (sheet={spreadsheet_id})")
 
         # Teclado de confirmación
-        keyboard = [
-            [InlineKeyboardButton("🔄 Repetir Selfie de Salida", callback_data="repetir_foto_salida")],
-            [InlineKeyboardButton("✅ Finalizar Jornada", callback_data="finalizar_salida")],
-        ]
-        await update.message.reply_text(
+        await responder(update.message,
             f"🚪 Hora de salida registrada a las *{hora_salida}*.\n\n¿Está correcta la selfie?",
             parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=TECLADO_SELFIE_SALIDA
         )
-        # No cambiamos el paso aquí; se cierra en manejar_salida_callback -> "finalizar_salida"
+        # No cambiamos el paso aquí; se cierra con el botón "finalizar_salida"
 
     except Exception as e:
         logger.error(f"[ERROR] selfie_salida: {e}")
-        await update.message.reply_text("❌ Error interno al registrar la selfie de salida.")
+        await responder(update.message, "❌ Error interno al registrar la selfie de salida.")
+        return False
 
 
-# -------------------- MANEJAR FOTOS --------------------
+# -------------------- GEOCERCAS (ubicación de ingreso) --------------------
+# Con GEOCERCA_ACTIVA=1, tras el selfie de inicio se pide la ubicación (compartida o
+# en tiempo real) y se valida contra el catálogo GEOCERCAS_FILE:
+#   [{"nombre": "Almacén Callao", "lat": -12.05, "lon": -77.12, "radio_m": 150}, ...]
+# La sede y la distancia se escriben en las columnas GEO_COL_SEDE / GEO_COL_DISTANCIA
+# (por defecto T y U, lejos de las fórmulas en J+).
+GEOCERCA_ACTIVA = os.getenv("GEOCERCA_ACTIVA", "0") == "1"
+GEOCERCAS_FILE = os.getenv("GEOCERCAS_FILE", "geocercas.json")
+GEO_CELDA_GRADOS = float(os.getenv("GEO_CELDA_GRADOS", "0.01"))  # ~1.1 km por celda
+GEO_COL_SEDE = os.getenv("GEO_COL_SEDE", "T")
+GEO_COL_DISTANCIA = os.getenv("GEO_COL_DISTANCIA", "U")
+SEDE_FUERA = "FUERA DE GEOCERCA"
+
+RADIO_TIERRA_M = 6371000.0
+METROS_POR_GRADO = 111320.0
+
+def distancia_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Distancia haversine en metros."""
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp, dl = p2 - p1, math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * RADIO_TIERRA_M * math.asin(math.sqrt(a))
+
+
+class IndiceGeocercas:
+    """
+    Índice espacial en grilla: cada sede se registra en todas las celdas que toca su
+    radio, así una consulta solo mira las sedes de su celda (y vecinas para la más cercana),
+    sin recorrer el catálogo completo.
+    """
+
+    def __init__(self, sedes: list[dict], celda_grados: float):
+        self._celda = celda_grados
+        self._grilla: dict[tuple[int, int], list[dict]] = collections.defaultdict(list)
+        self.total = len(sedes)
+        for sede in sedes:
+            dlat = sede["radio_m"] / METROS_POR_GRADO
+            dlon = dlat / max(math.cos(math.radians(sede["lat"])), 1e-6)
+            i0, j0 = self._clave(sede["lat"] - dlat, sede["lon"] - dlon)
+            i1, j1 = self._clave(sede["lat"] + dlat, sede["lon"] + dlon)
+            for i in range(i0, i1 + 1):
+                for j in range(j0, j1 + 1):
+                    self._grilla[(i, j)].append(sede)
+
+    def _clave(self, lat: float, lon: float) -> tuple[int, int]:
+        return math.floor(lat / self._celda), math.floor(lon / self._celda)
+
+    def buscar(self, lat: float, lon: float) -> tuple[dict | None, float | None, bool]:
+        """Devuelve (sede, distancia_m, dentro). Si no está dentro de ninguna, la más cercana alrededor."""
+        i, j = self._clave(lat, lon)
+        mejor, mejor_d = None, None
+        for sede in self._grilla.get((i, j), ()):
+            d = distancia_m(lat, lon, sede["lat"], sede["lon"])
+            if d <= sede["radio_m"] and (mejor_d is None or d < mejor_d):
+                mejor, mejor_d = sede, d
+        if mejor is not None:
+            return mejor, mejor_d, True
+
+        vistas = set()
+        for di in (-1, 0, 1):
+            for dj in (-1, 0, 1):
+                for sede in self._grilla.get((i + di, j + dj), ()):
+                    if id(sede) in vistas:
+                        continue
+                    vistas.add(id(sede))
+                    d = distancia_m(lat, lon, sede["lat"], sede["lon"])
+                    if mejor_d is None or d < mejor_d:
+                        mejor, mejor_d = sede, d
+        return mejor, mejor_d, False
+
+
+def cargar_geocercas() -> IndiceGeocercas:
+    with open(GEOCERCAS_FILE, encoding="utf-8") as f:
+        sedes = [
+            {"nombre": str(s["nombre"]), "lat": float(s["lat"]), "lon": float(s["lon"]),
+             "radio_m": float(s.get("radio_m", 150))}
+            for s in json.load(f)
+        ]
+    indice = IndiceGeocercas(sedes, GEO_CELDA_GRADOS)
+    logger.info(f"[DEBUG] Geocercas cargadas: {indice.total} sedes desde {GEOCERCAS_FILE}")
+    return indice
+
+GEOCERCAS = cargar_geocercas() if GEOCERCA_ACTIVA else None
+
+# Última posición por chat: las actualizaciones de ubicación en tiempo real solo
+# tocan esta memoria; a la hoja se escribe una vez, al validar la sede.
+ULTIMA_UBICACION: dict[int, tuple[float, float, float]] = {}
+
+if GEOCERCA_ACTIVA:
+    COL["SEDE"] = GEO_COL_SEDE
+    COL["DISTANCIA SEDE (m)"] = GEO_COL_DISTANCIA
+    TECLADO_FUERA_DE_SEDE = InlineKeyboardMarkup([
+        [boton("➡️ Continuar sin validar ubicación", "continuar_sin_sede")],
+    ])
+
+async def pedir_ubicacion(update: Update, context: ContextTypes.DEFAULT_TYPE, ud: dict):
+    await editar(update.callback_query,
+        "📍 Comparte tu *ubicación* (📎 → Ubicación) para validar la sede de trabajo.",
+        parse_mode="Markdown"
+    )
+
+async def _escribir_sede(update: Update, ud: dict, nombre: str, distancia: float | None):
+    await google_io(asegurar_fila, update, ud)
+    valores = {"SEDE": nombre, "DISTANCIA SEDE (m)": round(distancia) if distancia is not None else ""}
+    await google_io(escribir_en_jornada, ud, valores)
+    ud["sede"] = nombre
+    logger.info(f"[DEBUG] Sede '{nombre}' ({distancia} m) escrita en fila {ud['row']}")
+
+async def registrar_ubicacion(update: Update, context: ContextTypes.DEFAULT_TYPE, ud: dict):
+    msg = update.effective_message
+    chat_id = update.effective_chat.id
+    lat, lon, _ = ULTIMA_UBICACION[chat_id]
+    sede, distancia, dentro = GEOCERCAS.buscar(lat, lon)
+    ud["ubicacion"] = [lat, lon]
+
+    if not dentro:
+        # Ticks de ubicación en tiempo real (mensajes editados): sin respuesta, para no inundar el chat
+        if update.edited_message is None:
+            cerca = f"\nSede más cercana: *{sede['nombre']}* a {round(distancia)} m." if sede else ""
+            await responder(msg,
+                f"⚠️ No estás dentro de ninguna sede registrada.{cerca}\n\n"
+                "Acércate y vuelve a compartir tu ubicación.",
+                parse_mode="Markdown",
+                reply_markup=TECLADO_FUERA_DE_SEDE
+            )
+        ud["sede_cercana"] = [sede["nombre"], distancia] if sede else None
+        return False
+
+    try:
+        await _escribir_sede(update, ud, sede["nombre"], distancia)
+    except Exception as e:
+        logger.error(f"[ERROR] registrar_ubicacion: {e}")
+        await responder(msg, "❌ No se pudo guardar la ubicación. Intenta de nuevo.")
+        return False
+
+    await responder(msg,
+        f"📍 Ubicación validada: *{sede['nombre']}* ({round(distancia)} m).\n\n¿Realizaste ATS/PETAR?",
+        parse_mode="Markdown",
+        reply_markup=TECLADO_ATS
+    )
+
+async def continuar_sin_sede(update: Update, context: ContextTypes.DEFAULT_TYPE, ud: dict):
+    query = update.callback_query
+    cercana = ud.get("sede_cercana")
+    try:
+        await _escribir_sede(update, ud, SEDE_FUERA, cercana[1] if cercana else None)
+    except Exception as e:
+        logger.error(f"[ERROR] continuar_sin_sede: {e}")
+        await responder(query.message, "❌ No se pudo guardar la ubicación. Intenta de nuevo.")
+        return False
+    await editar(query, "¿Realizaste ATS/PETAR?", reply_markup=TECLADO_ATS)
+
+async def manejar_ubicacion(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Ubicación compartida o tick de ubicación en tiempo real (llega como mensaje editado)."""
+    try:
+        chat_id = update.effective_chat.id
+        loc = update.effective_message.location
+        ULTIMA_UBICACION[chat_id] = (loc.latitude, loc.longitude, time.time())
+        await FLUJO.despachar(chat_id, EVENTO_UBICACION, update, context)
+    except Exception as e:
+        logger.error(f"[ERROR] manejar_ubicacion: {e}")
+
+
+# -------------------- TABLA DE TRANSICIONES --------------------
+
+FLUJO = MaquinaEstados(
+    inicial=PASO_NOMBRE,
+    finales=[PASO_FIN],
+    entradas=[PASO_SALIDA],  # /salida entra directo a selfie_salida
+)
+for _estado, _evento, _accion, _siguiente in [
+    (PASO_NOMBRE,        EVENTO_TEXTO,          nombre_cuadrilla,     PASO_NOMBRE),
+    (PASO_NOMBRE,        "confirmar_nombre",    confirmar_nombre,     PASO_TIPO),
+    (PASO_NOMBRE,        "corregir_nombre",     corregir_nombre,      PASO_NOMBRE),
+    (PASO_TIPO,          "tipo_ordenamiento",   handle_tipo_trabajo,  PASO_SELFIE_INICIO),
+    (PASO_TIPO,          "tipo_etiquetado",     handle_tipo_trabajo,  PASO_SELFIE_INICIO),
+    (PASO_SELFIE_INICIO, EVENTO_FOTO,           foto_ingreso,         PASO_SELFIE_INICIO),
+    (PASO_SELFIE_INICIO, "repetir_foto_inicio", repetir_foto_inicio,  PASO_SELFIE_INICIO),
+    (PASO_SELFIE_INICIO, "continuar_ats",       continuar_ats,        PASO_ATS_PREGUNTA),  # sin geocerca
+    (PASO_ATS_PREGUNTA,  "ats_si",              ats_si,               PASO_ATS),
+    (PASO_ATS_PREGUNTA,  "ats_no",              ats_no,               PASO_SALIDA),
+    (PASO_ATS,           EVENTO_FOTO,           foto_ats,             PASO_ATS),
+    (PASO_ATS,           "repetir_foto_ats",    repetir_foto_ats,     PASO_ATS),
+    (PASO_ATS,           "continuar_post_ats",  continuar_post_ats,   PASO_SALIDA),
+    (PASO_SALIDA,        "reenviar_ats",        reenviar_ats,         PASO_ATS),
+    (PASO_SALIDA,        EVENTO_FOTO,           selfie_salida,        PASO_SALIDA),
+    (PASO_SALIDA,        "repetir_foto_salida", repetir_foto_salida,  PASO_SALIDA),
+    (PASO_SALIDA,        "finalizar_salida",    finalizar_salida,     PASO_FIN),
+]:
+    if GEOCERCA_ACTIVA and (_estado, _evento) == (PASO_SELFIE_INICIO, "continuar_ats"):
+        continue
+    FLUJO.agregar(_estado, _evento, _accion, _siguiente)
+
+if GEOCERCA_ACTIVA:
+    for _estado, _evento, _accion, _siguiente in [
+        (PASO_SELFIE_INICIO, "continuar_ats",      pedir_ubicacion,     PASO_UBICACION),
+        (PASO_UBICACION,     EVENTO_UBICACION,     registrar_ubicacion, PASO_ATS_PREGUNTA),
+        (PASO_UBICACION,     "continuar_sin_sede", continuar_sin_sede,  PASO_ATS_PREGUNTA),
+    ]:
+        FLUJO.agregar(_estado, _evento, _accion, _siguiente)
+
+# -------------------- DESPACHO (texto, fotos, callbacks) --------------------
+
+async def despachar_texto(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await FLUJO.despachar(update.effective_chat.id, EVENTO_TEXTO, update, context)
+
+async def despachar_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    try:
+        chat_id = query.message.chat.id
+        logger.info(f"[DEBUG] callback -> data={query.data}, state={user_data.get(chat_id)}")
+
+        ud = user_data.get(chat_id)
+        estado = ud.get("paso") if ud is not None else FLUJO.inicial
+        if FLUJO.buscar(estado, query.data) is None:
+            # Botón viejo o fuera de orden (p.ej. doble toque): no hacemos nada
+            await contestar(query, "⚠️ Esta opción ya no está disponible.")
+            return
+
+        await contestar(query)
+        await FLUJO.despachar(chat_id, query.data, update, context)
+    except Exception as e:
+        logger.error(f"[ERROR] despachar_callback ({query.data}): {e}")
+        try:
+            await responder(query.message, "❌ Error interno. Intenta de nuevo.")
+        except Exception:
+            pass
 
 async def manejar_fotos(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
@@ -1143,26 +4243,282 @@ async def manejar_fotos(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return
 
         # 📸 En fotos NO verifiques mensaje_es_para_bot (no hay /comando ni mención)
-        paso = user_data.get(chat_id, {}).get("paso")
-        logger.info(f"[DEBUG] manejar_fotos paso={paso} chat_id={chat_id}")
-
-        if paso == 1:
-            await foto_ingreso(update, context)
-        elif paso == 2:
-            await foto_ats(update, context)
-        elif paso == "selfie_salida":
-            await selfie_salida(update, context)
-        else:
-            await update.message.reply_text(
+        if not await FLUJO.despachar(chat_id, EVENTO_FOTO, update, context):
+            await responder(update.message,
                 "⚠️ No es momento de enviar fotos.\n\nUsa /ingreso @TuBot para comenzar."
             )
     except Exception as e:
         logger.error(f"[ERROR] manejar_fotos: {e}")
 
+# -------------------- IMPORTACIÓN DE XLSX HISTÓRICOS --------------------
+# python main.py importar [--grupo NOMBRE] archivo1.xlsx archivo2.xlsx ...
+# Lee cada libro en modo streaming (openpyxl read_only), mapea sus columnas a HEADERS
+# y escribe por lotes grandes con values.append en el spreadsheet del grupo: los meses
+# vivos van a su pestaña mensual y los cerrados directo al "<grupo> - Archivo <año>".
+# Tras cada lote se guarda un checkpoint; si se corta, al relanzar sigue desde ahí
+# (como mucho se reenvía el último lote).
+IMPORT_CHECKPOINT = os.getenv("IMPORT_CHECKPOINT", "importacion_checkpoint.json")
+IMPORT_LOTE_FILAS = int(os.getenv("IMPORT_LOTE_FILAS", "5000"))
+IMPORT_ESCRITURAS_POR_MIN = float(os.getenv("IMPORT_ESCRITURAS_POR_MIN", "50"))  # cuota Sheets: 60/min por usuario
+IMPORT_MAX_REINTENTOS = int(os.getenv("IMPORT_MAX_REINTENTOS", "6"))
+
+def _normalizar_encabezado(texto) -> str:
+    """'Hora de Ingreso ' -> 'HORA INGRESO', 'ATS/PETAR' -> 'ATS PETAR'."""
+    texto = unicodedata.normalize("NFKD", str(texto or ""))
+    texto = "".join(c for c in texto if not unicodedata.combining(c)).upper()
+    palabras = re.sub(r"[^A-Z0-9]+", " ", texto).split()
+    return " ".join(p for p in palabras if p != "DE")
+
+# Encabezado normalizado -> columna de HEADERS ("GRUPO" indica el grupo de cada fila)
+ALIAS_IMPORTACION = {_normalizar_encabezado(h): h for h in HEADERS}
+ALIAS_IMPORTACION.update({
+    "DIA": "FECHA",
+    "TIPO": "TIPO DE TRABAJO",
+    "ATS": "ATS/PETAR",
+    "PETAR": "ATS/PETAR",
+    "INGRESO": "HORA INGRESO",
+    "BREAK OUT": "HORA BREAK OUT",
+    "SALIDA BREAK": "HORA BREAK OUT",
+    "BREAK IN": "HORA BREAK IN",
+    "REGRESO BREAK": "HORA BREAK IN",
+    "SALIDA": "HORA SALIDA",
+    "GRUPO": "GRUPO",
+})
+
+def _fecha_importada(valor) -> datetime | None:
+    if isinstance(valor, datetime):
+        return valor
+    if hasattr(valor, "toordinal"):  # datetime.date
+        return datetime(valor.year, valor.month, valor.day)
+    texto = str(valor or "").strip()
+    for formato in ("%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y", "%d/%m/%y"):
+        try:
+            return datetime.strptime(texto, formato)
+        except ValueError:
+            pass
+    return None
+
+def _texto_importado(header: str, valor) -> str:
+    if valor is None:
+        return ""
+    if header.startswith("HORA"):
+        if hasattr(valor, "strftime"):  # datetime.time / datetime
+            return valor.strftime("%H:%M")
+    if header == "ATS/PETAR":
+        v = _normalizar_encabezado(valor)
+        return {"SI": "Sí", "NO": "No"}.get(v, str(valor).strip())
+    return str(valor).strip()
+
+def fila_importada(indices: dict[str, int], valores: tuple) -> tuple[datetime, dict] | None:
+    """Fila del xlsx -> (fecha, {header: texto}). None si no tiene una FECHA válida."""
+    def celda(h):
+        i = indices.get(h)
+        return valores[i] if i is not None and i < len(valores) else None
+
+    fecha = _fecha_importada(celda("FECHA"))
+    if fecha is None:
+        return None
+    datos = {h: _texto_importado(h, celda(h)) for h in HEADERS}
+    datos["FECHA"] = fecha.strftime("%Y-%m-%d")
+    datos["MES"] = MESES[fecha.month - 1]
+    grupo = celda("GRUPO")
+    if grupo:
+        datos["GRUPO"] = str(grupo).strip()
+    return fecha, datos
+
+
+class ImportadorXlsx:
+    def __init__(self, checkpoint_path: str = IMPORT_CHECKPOINT):
+        self.checkpoint_path = checkpoint_path
+        try:
+            with open(checkpoint_path, encoding="utf-8") as f:
+                self.checkpoint = json.load(f)
+        except FileNotFoundError:
+            self.checkpoint = {}
+        self.cubeta = CubetaTokens(IMPORT_ESCRITURAS_POR_MIN / 60, IMPORT_ESCRITURAS_POR_MIN / 6)
+        self.destinos: dict[tuple[str, str], tuple[str, str]] = {}  # (grupo, pestaña) -> (ssid, pestaña)
+        self.buffer: dict[tuple[str, str], list[list[str]]] = collections.defaultdict(list)
+        self.en_buffer = 0
+        self.escritas = 0
+
+    def _guardar_checkpoint(self):
+        tmp = self.checkpoint_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.checkpoint, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, self.checkpoint_path)
+
+    def _ejecutar(self, request):
+        """execute() respetando la cuota de escrituras, con backoff ante 429/5xx."""
+        for intento in range(IMPORT_MAX_REINTENTOS):
+            while (espera := self.cubeta.espera(time.monotonic())) > 0:
+                time.sleep(espera)
+            self.cubeta.tomar()
+            try:
+                return request.execute()
+            except HttpError as e:
+                if e.resp.status not in (429, 500, 502, 503) or intento == IMPORT_MAX_REINTENTOS - 1:
+                    raise
+                logger.warning(f"[WARN] importar: HTTP {e.resp.status}, reintento {intento + 1}")
+                self.cubeta.bloquear(min(64, 2 ** intento))
+
+    def _asegurar_pestana_archivo(self, spreadsheet_id: str, sheet_title: str):
+        """En el archivo anual basta una pestaña simple con HEADERS (sin rollover)."""
+        meta = sheets_service.spreadsheets().get(
+            spreadsheetId=spreadsheet_id,
+            fields="sheets.properties.title"
+        ).execute()
+        if any(s["properties"]["title"] == sheet_title for s in meta.get("sheets", [])):
+            return
+        self._ejecutar(sheets_service.spreadsheets().batchUpdate(
+            spreadsheetId=spreadsheet_id,
+            body={"requests": [{"addSheet": {"properties": {
+                "title": sheet_title, "gridProperties": {"frozenRowCount": 1}
+            }}}]}
+        ))
+        self._ejecutar(sheets_service.spreadsheets().values().update(
+            spreadsheetId=spreadsheet_id,
+            range=rango(sheet_title, "A1:I1"),
+            valueInputOption="RAW",
+            body={"values": [HEADERS]}
+        ))
+
+    def destino(self, grupo: str, fecha: datetime) -> tuple[str, str]:
+        sheet_title = titulo_hoja(fecha)
+        clave = (grupo, sheet_title)
+        if clave not in self.destinos:
+            periodo = fecha.year * 12 + fecha.month - 1
+            if ROLLOVER_REGISTROS == "mensual" and periodo <= periodo_limite_vivo():
+                ssid = buscar_o_crear_spreadsheet(f"{grupo} - Archivo {fecha.year}")
+                self._asegurar_pestana_archivo(ssid, sheet_title)
+            else:
+                ssid = buscar_o_crear_spreadsheet(grupo)
+                ensure_sheet_and_headers(ssid, sheet_title)
+            self.destinos[clave] = (ssid, sheet_title)
+        return self.destinos[clave]
+
+    def _vaciar(self):
+        """Un values.append por destino con todo lo acumulado."""
+        for (ssid, sheet_title), filas in self.buffer.items():
+            self._ejecutar(sheets_service.spreadsheets().values().append(
+                spreadsheetId=ssid,
+                range=rango(sheet_title, "A:A"),
+                valueInputOption="USER_ENTERED",
+                insertDataOption="INSERT_ROWS",
+                body={"values": filas}
+            ))
+            self.escritas += len(filas)
+        self.buffer.clear()
+        self.en_buffer = 0
+
+    def importar_archivo(self, ruta: str, grupo: str):
+        clave = os.path.abspath(ruta)
+        estado = self.checkpoint.get(clave, {})
+        if estado.get("completo"):
+            logger.info(f"[DEBUG] importar: {ruta} ya importado, se omite")
+            return
+
+        wb = openpyxl.load_workbook(ruta, read_only=True, data_only=True)
+        try:
+            hojas = wb.sheetnames
+            desde = hojas.index(estado["hoja"]) if estado.get("hoja") in hojas else 0
+            for nombre_hoja in hojas[desde:]:
+                ws = wb[nombre_hoja]
+                encabezados = next(ws.iter_rows(min_row=1, max_row=1, values_only=True), ())
+                indices = {}
+                for i, h in enumerate(encabezados):
+                    destino_col = ALIAS_IMPORTACION.get(_normalizar_encabezado(h))
+                    if destino_col:
+                        indices.setdefault(destino_col, i)
+                if "FECHA" not in indices:
+                    logger.warning(f"[WARN] importar: '{nombre_hoja}' de {ruta} no tiene columna FECHA, se omite")
+                    continue
+
+                inicio = estado["fila"] + 1 if estado.get("hoja") == nombre_hoja else 2
+                n = inicio - 1
+                for n, valores in enumerate(ws.iter_rows(min_row=inicio, values_only=True), start=inicio):
+                    leida = fila_importada(indices, valores)
+                    if leida is None:
+                        continue
+                    fecha, datos = leida
+                    destino = self.destino(datos.get("GRUPO") or grupo, fecha)
+                    self.buffer[destino].append([datos[h] for h in HEADERS])
+                    self.en_buffer += 1
+                    if self.en_buffer >= IMPORT_LOTE_FILAS:
+                        self._vaciar()
+                        self.checkpoint[clave] = {"hoja": nombre_hoja, "fila": n}
+                        self._guardar_checkpoint()
+                        logger.info(f"[DEBUG] importar: {ruta} '{nombre_hoja}' fila {n} ({self.escritas} escritas)")
+                self._vaciar()
+                self.checkpoint[clave] = {"hoja": nombre_hoja, "fila": n}
+                self._guardar_checkpoint()
+        finally:
+            wb.close()
+
+        self.checkpoint[clave] = {"completo": True}
+        self._guardar_checkpoint()
+        logger.info(f"[DEBUG] importar: {ruta} completo ({self.escritas} filas escritas en total)")
+
+def importar_xlsx(argv: list[str]):
+    parser = argparse.ArgumentParser(prog="main.py importar", description="Importa xlsx históricos de asistencia.")
+    parser.add_argument("archivos", nargs="+")
+    parser.add_argument("--grupo", help="spreadsheet destino si el xlsx no tiene columna GRUPO (por defecto, el nombre del archivo)")
+    parser.add_argument("--checkpoint", default=IMPORT_CHECKPOINT)
+    parser.add_argument("--inquilino", default="principal", choices=sorted(INQUILINOS))
+    args = parser.parse_args(argv)
+    INQUILINO_ACTUAL.set(INQUILINOS[args.inquilino])
+
+    importador = ImportadorXlsx(args.checkpoint)
+    inicio = time.monotonic()
+    for ruta in args.archivos:
+        grupo = args.grupo or os.path.splitext(os.path.basename(ruta))[0]
+        importador.importar_archivo(ruta, grupo)
+    logger.info(f"[DEBUG] importar: {importador.escritas} filas en {time.monotonic() - inicio:.0f}s")
+
+
 # -------------------- MAIN --------------------
 def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
-    app.post_init = init_bot_info  # ok si es async, PTB lo maneja internamente
+    if len(sys.argv) > 1 and sys.argv[1] == "diagrama":
+        print(FLUJO.diagrama())  # python main.py diagrama | dot -Tpng > flujo.png
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "importar":
+        importar_xlsx(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "analizar":
+        para_cada_inquilino(analizar_asistencia)  # corrida manual del análisis nocturno
+        return
+
+    errores = FLUJO.validar(EVENTOS_EMITIDOS)
+    if errores:
+        raise RuntimeError("Flujo incompleto:\n" + "\n".join(errores))
+
+    recargar_chats_permitidos(forzar=True)
+    for inq in INQUILINOS.values():
+        logger.info(f"[DEBUG] Inquilino {inq.nombre}: carpeta {inq.carpeta_id}")  # falla temprano si no hay acceso
+    if not MODO_REPLICAS:
+        cargar_snapshot_sesiones()
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .application_class(AplicacionConCarriles)
+        .concurrent_updates(UPDATES_EN_VUELO_MAX)
+    )
+    app = configurar_api_telegram(builder).build()
+    app.post_init = al_iniciar  # ok si es async, PTB lo maneja internamente
+    app.post_stop = al_detener  # también lo llama correr_con_replicas
+    app.post_shutdown = al_apagar
+
+    # --------- INQUILINO DEL CHAT (grupo -4) Y FILTRO DE CHATS (grupo -3) ---------
+    app.add_handler(TypeHandler(Update, asignar_inquilino), group=-4)
+    app.add_handler(TypeHandler(Update, filtrar_chats), group=-3)
+
+    # --------- MULTI-RÉPLICA: enrutar por dueño del chat y compartir sesión ---------
+    if MODO_REPLICAS:
+        app.add_handler(TypeHandler(Update, enrutar_replica), group=-2)
+        app.add_handler(TypeHandler(Update, guardar_sesion_replica), group=100)
+
+    # --------- IDEMPOTENCIA: descartar reentregas antes de tocar Google ---------
+    app.add_handler(TypeHandler(Update, deduplicar), group=-1)
+    app.add_handler(TypeHandler(Update, marcar_procesado), group=99)
 
     # --------- COMANDOS PRINCIPALES ---------
     app.add_handler(CommandHandler("start", start))
@@ -1170,27 +4526,37 @@ def main():
     app.add_handler(CommandHandler("breakout", breakout))
     app.add_handler(CommandHandler("breakin", breakin))
     app.add_handler(CommandHandler("salida", salida))
+    app.add_handler(CommandHandler("resumen", resumen))
+    app.add_handler(CommandHandler("exportar", exportar))
 
     # --------- MENSAJES ---------
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, nombre_cuadrilla))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, despachar_texto))
     app.add_handler(MessageHandler(filters.PHOTO, manejar_fotos))
-
-    # --------- CALLBACKS CUADRILLA ---------
-    app.add_handler(CallbackQueryHandler(handle_nombre_cuadrilla, pattern="^(confirmar_nombre|corregir_nombre)$"))
-    app.add_handler(CallbackQueryHandler(handle_tipo_trabajo, pattern="^tipo_"))
-
-    # --------- CALLBACKS ATS/PETAR ---------
-    app.add_handler(CallbackQueryHandler(handle_ats_petar, pattern="^ats_(si|no)$"))
-    app.add_handler(CallbackQueryHandler(manejar_repeticion_fotos, pattern="^(continuar_ats|repetir_foto_inicio|repetir_foto_ats|continuar_post_ats|reenviar_ats)$"))
-
-    # --------- CALLBACKS SALIDA ---------
-    app.add_handler(CallbackQueryHandler(manejar_salida_callback, pattern="^(repetir_foto_salida|finalizar_salida)$"))
+    if GEOCERCA_ACTIVA:
+        app.add_handler(MessageHandler(filters.LOCATION, manejar_ubicacion))  # incluye ticks en vivo (editados)
+
+    # --------- CALLBACKS (un solo handler, despacho por tabla) ---------
+    app.add_handler(CallbackQueryHandler(despachar_callback))
+
+    # --------- RECORDATORIOS (un job para todas las sesiones) ---------
+    if app.job_queue is None:
+        logger.warning("[WARN] Sin JobQueue (instala python-telegram-bot[job-queue]): no habrá recordatorios")
+    else:
+        app.job_queue.run_repeating(
+            revisar_recordatorios,
+            interval=RECORDATORIO_INTERVALO_SEG,
+            first=RECORDATORIO_INTERVALO_SEG,
+            name="recordatorios",
+        )
 
     # --------- ERRORES ---------
     app.add_error_handler(log_error)
 
     print("🚀 Bot de Asistencia en ejecución...")
-    app.run_polling()  # <-- SIN await
+    if MODO_REPLICAS:
+        asyncio.run(correr_con_replicas(app))
+    else:
+        app.run_polling()  # <-- SIN await
 
 if __name__ == "__main__":
     main()  # <-- SIN asyncio.run y sin nest_asyncio
@@ -0,0 +1,82 @@
+import json
+import os
+import sys
+import tempfile
+from datetime import datetime
+
+import pytest
+
+from google_falso import GoogleFalso
+from telegram_falso import ChatFalso
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# main.py lee su configuración al importarse: se fija antes, apuntando todo
+# lo que escribe en disco a un directorio temporal.
+_TMP = tempfile.mkdtemp(prefix="asistencia-tests-")
+os.environ.update({
+    "BOT_TOKEN": "123:prueba",
+    "GOOGLE_CREDENTIALS_JSON": json.dumps({"type": "service_account", "client_email": "bot@prueba"}),
+    "IDEMPOTENCIA_DB": os.path.join(_TMP, "idempotencia.sqlite3"),
+    "SNAPSHOT_SESIONES": os.path.join(_TMP, "sesiones.json.gz"),
+    "INQUILINOS_FILE": os.path.join(_TMP, "inquilinos.json"),
+    "CHATS_PERMITIDOS_FILE": os.path.join(_TMP, "chats_permitidos.json"),
+    "ROLLOVER_REGISTROS": "mensual",
+    "GEOCERCA_ACTIVA": "0",
+    "MODO_REPLICAS": "0",
+    "COMPACTAR_HORA": "",
+    "HEALTH_PORT": "0",
+})
+
+GOOGLE = GoogleFalso()
+FOLDER_MIME = "application/vnd.google-apps.folder"
+
+
+@pytest.fixture(scope="session")
+def bot_main():
+    for modulo in ("telegram", "googleapiclient", "google.oauth2", "google_auth_httplib2", "openpyxl", "pytz"):
+        pytest.importorskip(modulo)
+    import googleapiclient.discovery
+    from google.oauth2 import service_account
+
+    mp = pytest.MonkeyPatch()
+    mp.setattr(googleapiclient.discovery, "build", GOOGLE.build)
+    mp.setattr(service_account.Credentials, "from_service_account_info", lambda info, scopes=None: object())
+    import main
+    yield main
+    mp.undo()
+
+
+@pytest.fixture
+def ahora(bot_main):
+    """Lunes 19/10/2026 09:00 en Lima: los payloads no cambian de tamaño según el mes."""
+    return bot_main.LIMA_TZ.localize(datetime(2026, 10, 19, 9, 0))
+
+
+@pytest.fixture
+def google(bot_main, ahora, tmp_path, monkeypatch):
+    """Backend de Google vacío (solo la carpeta principal) y estado del proceso limpio."""
+
+    class FechaFija(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return ahora if tz else ahora.replace(tzinfo=None)
+
+    GOOGLE.reiniciar()
+    monkeypatch.setattr(bot_main, "datetime", FechaFija)
+    monkeypatch.setattr(bot_main, "IDEMPOTENCIA", bot_main.IdempotenciaSQLite(str(tmp_path / "idem.sqlite3"), 3600))
+    monkeypatch.setattr(bot_main, "AGREGADOS", bot_main.AgregadosAsistencia())
+    monkeypatch.setattr(bot_main, "SNAPSHOT_SESIONES", str(tmp_path / "sesiones.json.gz"))
+    bot_main._HOJAS_LISTAS.clear()
+    bot_main.user_data.clear()
+    # main() resuelve la carpeta de cada inquilino al arrancar: no cuenta para las jornadas
+    carpeta = GOOGLE.crear_archivo(bot_main.NOMBRE_CARPETA_DRIVE, FOLDER_MIME, bot_main.DRIVE_ID)
+    monkeypatch.setattr(bot_main.INQUILINO_PRINCIPAL, "_carpeta_id", carpeta)
+    yield GOOGLE
+    bot_main._HOJAS_LISTAS.clear()
+    bot_main.user_data.clear()
+
+
+@pytest.fixture
+def chat(bot_main, google):
+    return ChatFalso(bot_main)
@@ -0,0 +1,335 @@
+"""
+Cliente falso de Google (Drive v3 + Sheets v4) para las pruebas de presupuesto.
+
+Simula en memoria lo justo que usa main.py (carpetas, spreadsheets, pestañas,
+valores, developer metadata) y registra cada llamada a execute(): API, método y
+tamaño del cuerpo enviado.
+"""
+import copy
+import itertools
+import json
+import re
+from collections import Counter
+
+
+def _fila_de(a1: str) -> int:
+    return int(re.search(r"(\d+)", a1).group(1))
+
+
+def _col_de(a1: str) -> int:
+    letras = re.match(r"([A-Z]+)", a1).group(1)
+    n = 0
+    for c in letras:
+        n = n * 26 + ord(c) - 64
+    return n - 1
+
+
+def _partir_rango(rango: str) -> tuple[str, str]:
+    """"'Registros Octubre 2026'!A1:I1" -> ("Registros Octubre 2026", "A1:I1")."""
+    if "!" not in rango:
+        return rango.strip("'"), ""
+    hoja, a1 = rango.rsplit("!", 1)
+    return hoja.strip("'"), a1
+
+
+class Llamada:
+    def __init__(self, api: str, metodo: str, kwargs: dict):
+        self.api = api
+        self.metodo = metodo
+        self.kwargs = kwargs
+        self.bytes = len(json.dumps(kwargs.get("body", {}), ensure_ascii=False).encode())
+
+    def __repr__(self):
+        return f"{self.api}.{self.metodo}({self.bytes} B)"
+
+
+class GoogleFalso:
+    def __init__(self):
+        self.reiniciar()
+
+    def reiniciar(self):
+        self.llamadas: list[Llamada] = []
+        self.archivos = {}   # id -> {"name", "mimeType", "parents"}
+        self.hojas = {}      # ssid -> [{"sheetId", "title", "filas": {n: [valores]}, "congeladas"}]
+        self.anclas = {}     # (ssid, valor) -> (sheetId, fila)
+        self._ids = itertools.count(1)
+
+    # --- contadores ---
+    def contar(self) -> int:
+        return len(self.llamadas)
+
+    def bytes_enviados(self) -> int:
+        return sum(c.bytes for c in self.llamadas)
+
+    def por_metodo(self) -> Counter:
+        return Counter(f"{c.api}.{c.metodo}" for c in self.llamadas)
+
+    def limpiar_contadores(self):
+        self.llamadas.clear()
+
+    # --- siembra ---
+    def crear_archivo(self, nombre: str, mime: str, padre: str) -> str:
+        fid = f"id{next(self._ids)}"
+        self.archivos[fid] = {"id": fid, "name": nombre, "mimeType": mime, "parents": [padre]}
+        if mime.endswith("spreadsheet"):
+            self.hojas[fid] = [{"sheetId": 0, "title": "Hoja 1", "filas": {}}]
+        return fid
+
+    def pestana(self, ssid: str, titulo: str) -> dict:
+        return next(p for p in self.hojas[ssid] if p["title"] == titulo)
+
+    def _pestana_por_id(self, ssid: str, sheet_id: int) -> dict:
+        return next(p for p in self.hojas[ssid] if p["sheetId"] == sheet_id)
+
+    # --- cliente ---
+    def build(self, api: str, version: str, **kwargs):
+        return _Recurso(self, api, ())
+
+    def ejecutar(self, api: str, ruta: tuple, kwargs: dict):
+        metodo = ".".join(ruta)
+        self.llamadas.append(Llamada(api, metodo, kwargs))
+        return getattr(self, f"_{api}_{metodo.replace('.', '_')}")(**kwargs)
+
+    # --- Drive ---
+    def _drive_files_list(self, q: str, **_):
+        nombre = re.search(r"name='((?:[^'\\]|\\.)*)'", q)  # literal con \' y \\ escapados
+        padre = re.search(r"'([^']*)' in parents", q)
+        mime = re.search(r"mimeType='([^']*)'", q)
+        if nombre:
+            nombre = re.sub(r"\\(.)", r"\1", nombre.group(1))
+        files = [
+            {"id": f["id"], "name": f["name"], "mimeType": f["mimeType"]}
+            for f in self.archivos.values()
+            if (not nombre or f["name"] == nombre)
+            and (not padre or padre.group(1) in f["parents"])
+            and (not mime or f["mimeType"] == mime.group(1))
+        ]
+        return {"files": files}
+
+    def _drive_files_create(self, body: dict, **_):
+        return {"id": self.crear_archivo(body["name"], body["mimeType"], body["parents"][0])}
+
+    def _drive_files_get(self, fileId: str, **_):
+        return {"id": fileId}
+
+    # --- Sheets ---
+    def _sheets_spreadsheets_get(self, spreadsheetId: str, ranges: list[str] = (), includeGridData: bool = False, **_):
+        if includeGridData:
+            return {"sheets": [self._grilla(spreadsheetId, r) for r in ranges]}
+        return {
+            "properties": {"title": self.archivos[spreadsheetId]["name"]},
+            "sheets": [{"properties": {
+                "sheetId": p["sheetId"], "title": p["title"],
+                "gridProperties": {"rowCount": max(p["filas"], default=1)},
+            }} for p in self.hojas[spreadsheetId]],
+        }
+
+    def _grilla(self, ssid: str, rango: str) -> dict:
+        """Una pestaña con includeGridData: valores con formato y developer metadata por fila."""
+        hoja, a1 = _partir_rango(rango)
+        p = next((p for p in self.hojas[ssid] if p["title"] == hoja), None)
+        if p is None:
+            import httplib2  # aquí y no arriba: conftest importa este módulo antes del importorskip
+            from googleapiclient.errors import HttpError
+            raise HttpError(httplib2.Response({"status": 400}), f"Unable to parse range: {rango}".encode())
+        desde = _fila_de(a1.split(":")[0])
+        filas = range_(desde, max(p["filas"], default=desde))
+        por_fila = {}
+        for (s, valor), (sid, n) in self.anclas.items():
+            if s == ssid and sid == p["sheetId"]:
+                por_fila.setdefault(n, []).append({"metadataKey": "asistencia_jornada", "metadataValue": valor})
+        return {"properties": {"sheetId": p["sheetId"], "title": p["title"]}, "data": [{
+            "startRow": desde - 1,
+            "rowData": [{"values": [{"formattedValue": str(v)} if v != "" else {} for v in p["filas"].get(n, [])]}
+                        for n in filas],
+            "rowMetadata": [{"developerMetadata": por_fila.get(n, [])} for n in filas],
+        }]}
+
+    def _sheets_spreadsheets_batchUpdate(self, spreadsheetId: str, body: dict):
+        # Como la API real, el batchUpdate es atómico: si un request falla no se aplica ninguno
+        antes = copy.deepcopy(self.hojas[spreadsheetId])
+        try:
+            return self._aplicar_requests(spreadsheetId, body["requests"])
+        except Exception:
+            self.hojas[spreadsheetId] = antes
+            raise
+
+    def _aplicar_requests(self, spreadsheetId: str, requests: list[dict]):
+        respuestas = []
+        for req in requests:
+            (tipo, datos), = req.items()
+            if tipo == "addSheet":
+                sid = max(p["sheetId"] for p in self.hojas[spreadsheetId]) + 1
+                self.hojas[spreadsheetId].append({
+                    "sheetId": sid, "title": datos["properties"]["title"], "filas": {},
+                    "congeladas": datos["properties"].get("gridProperties", {}).get("frozenRowCount", 0),
+                })
+                respuestas.append({"addSheet": {"properties": {"sheetId": sid}}})
+            elif tipo == "duplicateSheet":
+                origen = self._pestana_por_id(spreadsheetId, datos["sourceSheetId"])
+                self.hojas[spreadsheetId].append({
+                    "sheetId": datos["newSheetId"], "title": datos["newSheetName"],
+                    "filas": {n: list(v) for n, v in origen["filas"].items()},
+                    "congeladas": origen.get("congeladas", 0),
+                })
+                respuestas.append({})
+            elif tipo == "deleteDimension":
+                r = datos["range"]
+                p = self._pestana_por_id(spreadsheetId, r["sheetId"])
+                if r["startIndex"] <= p.get("congeladas", 0) and r["endIndex"] >= max(p["filas"], default=1):
+                    raise ValueError("Invalid requests[deleteDimension]: "
+                                     "It's not possible to delete all non-frozen rows.")
+                borradas = r["endIndex"] - r["startIndex"]
+                p["filas"] = {
+                    (n if n <= r["startIndex"] else n - borradas): v
+                    for n, v in p["filas"].items()
+                    if not (r["startIndex"] < n <= r["endIndex"])
+                }
+                respuestas.append({})
+            elif tipo == "updateCells":
+                inicio = datos.get("start") or {**datos["range"], "rowIndex": datos["range"].get("startRowIndex", 0),
+                                                "columnIndex": datos["range"].get("startColumnIndex", 0)}
+                p = self._pestana_por_id(spreadsheetId, inicio["sheetId"])
+                if "range" in datos:  # las filas del rango que no vienen en rows se borran
+                    desde, hasta = inicio["rowIndex"], datos["range"].get("endRowIndex", float("inf"))
+                    p["filas"] = {n: v for n, v in p["filas"].items() if not desde < n <= hasta}
+                for i, fila in enumerate(datos.get("rows", [])):
+                    valores = [next(iter(c.get("userEnteredValue", {"": None}).values())) for c in fila["values"]]
+                    self._escribir(spreadsheetId, f"'{p['title']}'!{_letra(inicio['columnIndex'])}{inicio['rowIndex'] + i + 1}", [valores])
+                respuestas.append({})
+            elif tipo == "updateSheetProperties":
+                props = datos["properties"]
+                if "title" in props:
+                    self._pestana_por_id(spreadsheetId, props["sheetId"])["title"] = props["title"]
+                respuestas.append({})
+            elif tipo == "deleteSheet":
+                self.hojas[spreadsheetId].remove(self._pestana_por_id(spreadsheetId, datos["sheetId"]))
+                respuestas.append({})
+            elif tipo == "deleteDeveloperMetadata":
+                lookup = datos["dataFilter"]["developerMetadataLookup"]
+                self.anclas.pop((spreadsheetId, lookup["metadataValue"]), None)
+                respuestas.append({})
+            elif tipo == "createDeveloperMetadata":
+                md = datos["developerMetadata"]
+                dr = md["location"]["dimensionRange"]
+                self.anclas[(spreadsheetId, md["metadataValue"])] = (dr["sheetId"], dr["startIndex"] + 1)
+                respuestas.append({})
+            else:
+                respuestas.append({})
+        return {"replies": respuestas}
+
+    def _sheets_spreadsheets_sheets_copyTo(self, spreadsheetId: str, sheetId: int, body: dict):
+        origen = self._pestana_por_id(spreadsheetId, sheetId)
+        destino = self.hojas[body["destinationSpreadsheetId"]]
+        sid = max((p["sheetId"] for p in destino), default=0) + 1
+        destino.append({"sheetId": sid, "title": f"Copia de {origen['title']}",
+                        "filas": {n: list(v) for n, v in origen["filas"].items()}})
+        return {"sheetId": sid, "title": f"Copia de {origen['title']}"}
+
+    def _sheets_spreadsheets_developerMetadata_search(self, spreadsheetId: str, body: dict):
+        return {"matchedDeveloperMetadata": [
+            {"developerMetadata": {
+                "metadataValue": valor,
+                "location": {"dimensionRange": {"sheetId": sid, "startIndex": fila - 1, "endIndex": fila}},
+            }}
+            for (ssid, valor), (sid, fila) in self.anclas.items() if ssid == spreadsheetId
+        ]}
+
+    def _escribir(self, ssid: str, rango: str, valores: list[list]):
+        hoja, a1 = _partir_rango(rango)
+        p = self.pestana(ssid, hoja)
+        inicio = a1.split(":")[0]
+        fila0, col0 = _fila_de(inicio), _col_de(inicio)
+        for i, fila in enumerate(valores):
+            destino = p["filas"].setdefault(fila0 + i, [])
+            for j, v in enumerate(fila):
+                if v is None:
+                    continue
+                while len(destino) <= col0 + j:
+                    destino.append("")
+                destino[col0 + j] = v
+
+    def _sheets_spreadsheets_values_get(self, spreadsheetId: str, range: str, **_):
+        hoja, a1 = _partir_rango(range)
+        p = self.pestana(spreadsheetId, hoja)
+        desde, _, hasta = a1.partition(":")
+        f0 = _fila_de(desde)
+        f1 = _fila_de(hasta) if re.search(r"\d", hasta) else max(p["filas"], default=0)
+        return {"range": range, "values": [p["filas"].get(n, []) for n in range_(f0, f1)]}
+
+    def _sheets_spreadsheets_values_batchGet(self, spreadsheetId: str, ranges: list[str], **_):
+        return {"valueRanges": [self._sheets_spreadsheets_values_get(spreadsheetId, r) for r in ranges]}
+
+    def _sheets_spreadsheets_values_update(self, spreadsheetId: str, range: str, body: dict, **_):
+        self._escribir(spreadsheetId, range, body["values"])
+        return {"updatedRange": range}
+
+    def _sheets_spreadsheets_values_batchUpdate(self, spreadsheetId: str, body: dict):
+        for d in body["data"]:
+            self._escribir(spreadsheetId, d["range"], d["values"])
+        return {"totalUpdatedCells": sum(len(f) for d in body["data"] for f in d["values"])}
+
+    def _sheets_spreadsheets_values_append(self, spreadsheetId: str, range: str, body: dict, **_):
+        hoja, _ = _partir_rango(range)
+        p = self.pestana(spreadsheetId, hoja)
+        fila = max(p["filas"], default=0) + 1
+        self._escribir(spreadsheetId, f"'{hoja}'!A{fila}", body["values"])
+        fin = fila + len(body["values"]) - 1
+        return {"updates": {"updatedRange": f"'{hoja}'!A{fila}:I{fin}"}}
+
+    def _sheets_spreadsheets_values_batchUpdateByDataFilter(self, spreadsheetId: str, body: dict):
+        respuestas, celdas = [], 0
+        for d in body["data"]:
+            if "a1Range" in d["dataFilter"]:
+                self._escribir(spreadsheetId, d["dataFilter"]["a1Range"], d["values"])
+                celdas += sum(v is not None for f in d["values"] for v in f)
+                respuestas.append({"updatedRange": d["dataFilter"]["a1Range"]})
+                continue
+            lookup = d["dataFilter"]["developerMetadataLookup"]
+            ancla = self.anclas.get((spreadsheetId, lookup["metadataValue"]))
+            if ancla is None:
+                continue
+            p = self._pestana_por_id(spreadsheetId, ancla[0])
+            self._escribir(spreadsheetId, f"'{p['title']}'!A{ancla[1]}", d["values"])
+            celdas += sum(v is not None for f in d["values"] for v in f)
+            respuestas.append({"updatedRange": f"'{p['title']}'!A{ancla[1]}:U{ancla[1]}"})
+        return {"totalUpdatedCells": celdas, "responses": respuestas}
+
+
+def _letra(indice: int) -> str:
+    letras = ""
+    indice += 1
+    while indice:
+        indice, r = divmod(indice - 1, 26)
+        letras = chr(65 + r) + letras
+    return letras
+
+
+def range_(desde: int, hasta: int):
+    return range(desde, hasta + 1)
+
+
+class _Recurso:
+    """service.spreadsheets().values().update(...).execute() -> GoogleFalso.ejecutar."""
+
+    def __init__(self, google: GoogleFalso, api: str, ruta: tuple):
+        self._google = google
+        self._api = api
+        self._ruta = ruta
+
+    def __getattr__(self, nombre):
+        def llamar(**kwargs):
+            ruta = self._ruta + (nombre,)
+            if not kwargs and nombre in ("files", "spreadsheets", "values", "sheets", "developerMetadata"):
+                return _Recurso(self._google, self._api, ruta)
+            return _Peticion(self._google, self._api, ruta, kwargs)
+        return llamar
+
+
+class _Peticion:
+    def __init__(self, google, api, ruta, kwargs):
+        self._args = (api, ruta, kwargs)
+        self._google = google
+
+    def execute(self):
+        return self._google.ejecutar(*self._args)
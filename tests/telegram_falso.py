@@ -0,0 +1,93 @@
+"""
+Objetos mínimos de Telegram para llamar a los handlers de main.py sin red.
+
+ChatFalso maneja un chat de grupo: los comandos mencionan al bot y el texto y las
+fotos van como respuesta a un mensaje del bot, igual que en los grupos reales.
+"""
+import itertools
+from types import SimpleNamespace
+
+BOT_USERNAME = "asistencia_bot"
+
+
+class BotFalso:
+    def __init__(self, chat):
+        self.username = BOT_USERNAME
+        self._chat = chat
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return self._chat.registrar_envio(text)
+
+
+class MensajeFalso:
+    def __init__(self, chat, texto=None, foto=False, responde_al_bot=False):
+        self._chat = chat
+        self.chat = chat.chat
+        self.chat_id = chat.chat.id
+        self.message_id = next(chat.ids)
+        self.text = texto
+        self.photo = [SimpleNamespace(file_id=f"foto{self.message_id}")] if foto else []
+        self.location = None
+        self.reply_to_message = (
+            SimpleNamespace(message_id=0, from_user=SimpleNamespace(username=BOT_USERNAME))
+            if responde_al_bot else None
+        )
+
+    async def reply_text(self, text, **kwargs):
+        return self._chat.registrar_envio(text)
+
+
+class ConsultaFalsa:
+    def __init__(self, chat, data):
+        self._chat = chat
+        self.id = f"cq{next(chat.ids)}"
+        self.data = data
+        self.message = MensajeFalso(chat)
+
+    async def answer(self, text=None):
+        return True
+
+    async def edit_message_text(self, text, **kwargs):
+        self._chat.enviados.append(text)
+        return True
+
+
+class ChatFalso:
+    def __init__(self, bot_main, chat_id: int = -1001234567890, titulo: str = "Cuadrilla Norte"):
+        self.main = bot_main
+        self.chat = SimpleNamespace(id=chat_id, title=titulo, type="supergroup")
+        self.ids = itertools.count(1)
+        self.enviados: list[str] = []
+        self.context = SimpleNamespace(bot=BotFalso(self), chat_data={}, user_data={})
+
+    def registrar_envio(self, text: str):
+        self.enviados.append(text)
+        return SimpleNamespace(message_id=next(self.ids), text=text)
+
+    def _update(self, message=None, callback_query=None):
+        return SimpleNamespace(
+            update_id=next(self.ids),
+            effective_chat=self.chat,
+            effective_user=SimpleNamespace(id=1),
+            message=message,
+            callback_query=callback_query,
+        )
+
+    @property
+    def sesion(self) -> dict:
+        return self.main.user_data.get(self.chat.id, {})
+
+    async def comando(self, nombre: str):
+        msg = MensajeFalso(self, texto=f"/{nombre}@{BOT_USERNAME}")
+        await getattr(self.main, nombre)(self._update(message=msg), self.context)
+
+    async def texto(self, texto: str):
+        msg = MensajeFalso(self, texto=texto, responde_al_bot=True)
+        await self.main.despachar_texto(self._update(message=msg), self.context)
+
+    async def foto(self):
+        msg = MensajeFalso(self, foto=True, responde_al_bot=True)
+        await self.main.manejar_fotos(self._update(message=msg), self.context)
+
+    async def boton(self, data: str):
+        await self.main.despachar_callback(self._update(callback_query=ConsultaFalsa(self, data)), self.context)
@@ -0,0 +1,333 @@
+"""
+Presupuesto de llamadas a Google por flujo de jornada.
+
+Cada prueba recorre un flujo completo con los handlers reales contra el cliente
+falso de google_falso.py y falla si el flujo hace más llamadas (execute()) o
+envía más bytes de lo presupuestado. Si un cambio sube un número a propósito,
+se actualiza aquí en el mismo commit y queda a la vista en la revisión.
+"""
+import asyncio
+from datetime import datetime
+
+import pytest
+
+# flujo -> (máximo de llamadas, máximo de bytes enviados en los cuerpos)
+PRESUPUESTO = {
+    "dia_normal": (11, 1850),
+    "ats_no": (11, 1850),
+    "selfies_repetidas": (13, 2350),
+    "grupo_nuevo": (14, 2200),
+    "reinicio_con_snapshot": (11, 1850),
+    "reinicio_sin_snapshot": (16, 2200),
+    "columnas_derivadas": (13, 3100),
+    "mes_nuevo": (12, 2200),
+}
+
+
+def correr(coro):
+    return asyncio.run(coro)
+
+
+def verificar(google, flujo: str):
+    llamadas, bytes_max = PRESUPUESTO[flujo]
+    detalle = dict(google.por_metodo())
+    assert google.contar() <= llamadas, f"{flujo}: {google.contar()} llamadas > {llamadas}: {detalle}"
+    assert google.bytes_enviados() <= bytes_max, f"{flujo}: {google.bytes_enviados()} B > {bytes_max} B: {detalle}"
+
+
+@pytest.fixture
+def grupo(bot_main, google, chat):
+    """Spreadsheet del grupo ya creado, con la pestaña del mes y sus encabezados."""
+    ssid = google.crear_archivo(chat.chat.title, bot_main.SHEET_MIME, bot_main.carpeta_principal())
+    titulo = bot_main.titulo_hoja()
+    google.hojas[ssid].append({"sheetId": 7, "title": titulo, "filas": {1: list(bot_main.HEADERS)}})
+    google.limpiar_contadores()
+    return ssid, titulo
+
+
+async def hasta_jornada(chat, ats: bool = True, repetir: bool = False):
+    await chat.comando("ingreso")
+    await chat.texto("T1: Juan Pérez")
+    await chat.boton("confirmar_nombre")
+    await chat.boton("tipo_ordenamiento")
+    await chat.foto()
+    if repetir:
+        await chat.boton("repetir_foto_inicio")
+        await chat.foto()
+    await chat.boton("continuar_ats")
+    if not ats:
+        await chat.boton("ats_no")
+        return
+    await chat.boton("ats_si")
+    await chat.foto()
+    if repetir:
+        await chat.boton("repetir_foto_ats")
+        await chat.foto()
+    await chat.boton("continuar_post_ats")
+
+
+async def cerrar_jornada(chat, repetir: bool = False):
+    await chat.comando("breakout")
+    await chat.comando("breakin")
+    await chat.comando("salida")
+    await chat.foto()
+    if repetir:
+        await chat.boton("repetir_foto_salida")
+        await chat.foto()
+    await chat.boton("finalizar_salida")
+
+
+def fila_de(google, ssid, titulo, n):
+    return google.pestana(ssid, titulo)["filas"][n]
+
+
+def test_dia_normal(google, chat, grupo):
+    ssid, titulo = grupo
+
+    async def flujo():
+        await hasta_jornada(chat)
+        await cerrar_jornada(chat)
+
+    correr(flujo())
+    fila = fila_de(google, ssid, titulo, 2)
+    assert fila[2:9] == ["T1: Juan Pérez", "Ordenamiento", "Sí", "09:00", "09:00", "09:00", "09:00"]
+    assert chat.sesion["paso"] is None
+    verificar(google, "dia_normal")
+
+
+def test_ats_no(google, chat, grupo):
+    ssid, titulo = grupo
+
+    async def flujo():
+        await hasta_jornada(chat, ats=False)
+        await cerrar_jornada(chat)
+
+    correr(flujo())
+    assert fila_de(google, ssid, titulo, 2)[4] == "No"
+    verificar(google, "ats_no")
+
+
+def test_selfies_repetidas(google, chat, grupo):
+    ssid, titulo = grupo
+
+    async def flujo():
+        await hasta_jornada(chat, repetir=True)
+        await cerrar_jornada(chat, repetir=True)
+
+    correr(flujo())
+    # La foto repetida del ATS no vuelve a escribir "Sí"
+    assert google.por_metodo()["sheets.spreadsheets.values.batchUpdateByDataFilter"] == 8
+    assert len(google.pestana(ssid, titulo)["filas"]) == 2
+    verificar(google, "selfies_repetidas")
+
+
+def test_grupo_nuevo(bot_main, google, chat):
+    async def flujo():
+        await hasta_jornada(chat)
+        await cerrar_jornada(chat)
+
+    correr(flujo())
+    ssid = chat.sesion["spreadsheet_id"]
+    assert google.archivos[ssid]["name"] == chat.chat.title
+    assert fila_de(google, ssid, bot_main.titulo_hoja(), 1) == bot_main.HEADERS
+    verificar(google, "grupo_nuevo")
+
+
+@pytest.mark.parametrize("filas_previas", [1, 40])
+def test_mes_nuevo(bot_main, google, chat, filas_previas):
+    """La pestaña del mes se crea duplicando la anterior (fila 1 congelada) sin borrar todas sus filas."""
+    ssid = google.crear_archivo(chat.chat.title, bot_main.SHEET_MIME, bot_main.carpeta_principal())
+    filas = {1: list(bot_main.HEADERS)}
+    for n in range(filas_previas):
+        filas[n + 2] = ["Septiembre", "2026-09-30", "T1", "Ordenamiento", "Sí", "08:00", "", "", ""]
+    google.hojas[ssid].append({"sheetId": 7, "title": "Registros Septiembre 2026", "filas": filas, "congeladas": 1})
+    google.limpiar_contadores()
+
+    async def flujo():
+        await hasta_jornada(chat)
+        await cerrar_jornada(chat)
+
+    correr(flujo())
+    nueva = google.pestana(ssid, bot_main.titulo_hoja())["filas"]
+    assert sorted(nueva) == [1, 2]
+    assert nueva[1] == bot_main.HEADERS and nueva[2][2] == "T1: Juan Pérez"
+    assert len(google.pestana(ssid, "Registros Septiembre 2026")["filas"]) == filas_previas + 1
+    verificar(google, "mes_nuevo")
+
+
+def test_archivo_tras_borrado_fallido(bot_main, google, monkeypatch):
+    """Si el deleteSheet falló tras copiar, la noche siguiente no copia otra vez: solo borra."""
+    ssid = google.crear_archivo("Cuadrilla Norte", bot_main.SHEET_MIME, bot_main.carpeta_principal())
+    google.hojas[ssid].append({"sheetId": 5, "title": "Registros Julio 2026", "filas": {1: list(bot_main.HEADERS)}})
+    grupo = {"id": ssid, "name": "Cuadrilla Norte"}
+    batch_update = google._sheets_spreadsheets_batchUpdate
+
+    def falla_borrado(spreadsheetId, body):
+        if "deleteSheet" in body["requests"][0]:
+            raise ConnectionError("se cortó")
+        return batch_update(spreadsheetId, body)
+
+    monkeypatch.setattr(google, "_sheets_spreadsheets_batchUpdate", falla_borrado)
+    with pytest.raises(ConnectionError):
+        bot_main.archivar_meses_cerrados(grupo)
+    monkeypatch.setattr(google, "_sheets_spreadsheets_batchUpdate", batch_update)
+    bot_main.archivar_meses_cerrados(grupo)
+
+    archivo = next(i for i, a in google.archivos.items() if a["name"] == "Cuadrilla Norte - Archivo 2026")
+    assert [p["title"] for p in google.hojas[archivo]] == ["Hoja 1", "Registros Julio 2026"]
+    assert [p["title"] for p in google.hojas[ssid]] == ["Hoja 1"]
+
+
+def test_reinicio_con_snapshot(bot_main, google, chat, grupo):
+    ssid, titulo = grupo
+
+    async def flujo():
+        await hasta_jornada(chat)
+        bot_main.guardar_snapshot_sesiones()
+        bot_main.user_data.clear()
+        bot_main._HOJAS_LISTAS.clear()
+        bot_main.cargar_snapshot_sesiones()
+        await cerrar_jornada(chat)
+
+    correr(flujo())
+    assert len(google.pestana(ssid, titulo)["filas"]) == 2  # sin fila fragmentada
+    verificar(google, "reinicio_con_snapshot")
+
+
+def test_reinicio_sin_snapshot(bot_main, google, chat, grupo):
+    """Caída sin snapshot: la sesión se pierde y el break abre una fila nueva (la compacta la tarea nocturna)."""
+    ssid, titulo = grupo
+
+    async def flujo():
+        await hasta_jornada(chat)
+        bot_main.user_data.clear()
+        bot_main._HOJAS_LISTAS.clear()
+        await chat.comando("breakout")
+        await chat.comando("breakin")
+        await chat.comando("salida")
+        await chat.foto()
+
+    correr(flujo())
+    assert len(google.pestana(ssid, titulo)["filas"]) == 3
+    verificar(google, "reinicio_sin_snapshot")
+
+
+def test_nombre_con_comilla(bot_main, google):
+    """El nombre va escapado en el q de Drive: una comilla no rompe (ni amplía) la búsqueda."""
+    carpeta = bot_main.carpeta_principal()
+    ssid = google.crear_archivo("Cuadrilla D'Onofrio", bot_main.SHEET_MIME, carpeta)
+    google.crear_archivo("Cuadrilla X", bot_main.SHEET_MIME, carpeta)
+    assert bot_main.buscar_archivo_en_drive("Cuadrilla D'Onofrio", bot_main.SHEET_MIME)["id"] == ssid
+    assert bot_main.buscar_archivo_en_drive("Cuadrilla X' or name='Cuadrilla X") is None
+
+
+def test_reconstruir_agregados(bot_main, google, chat, grupo):
+    """Un spreadsheets.get por grupo trae valores y anclas; un grupo sin la pestaña del mes no corta el resto."""
+    google.crear_archivo("Grupo sin mes", bot_main.SHEET_MIME, bot_main.carpeta_principal())
+
+    correr(hasta_jornada(chat))
+    clave = bot_main.clave_fila(bot_main.user_data[chat.chat.id])
+    bot_main.AGREGADOS = bot_main.AgregadosAsistencia()
+    google.limpiar_contadores()
+
+    bot_main.reconstruir_agregados()
+    assert google.por_metodo() == {"drive.files.list": 1, "sheets.spreadsheets.get": 2}
+    assert bot_main.AGREGADOS.jornadas[clave]["estado"] == "abierta"
+
+
+def test_compactacion_borra_anclas_cerradas(bot_main, google, ahora):
+    """Las anclas de días cerrados se borran en el batchUpdate de la compactación, salvo las activas."""
+    ssid = google.crear_archivo("Grupo 0", bot_main.SHEET_MIME, bot_main.carpeta_principal())
+    ayer = (ahora - bot_main.timedelta(days=1)).strftime("%Y-%m-%d")
+    hoy = ahora.strftime("%Y-%m-%d")
+    filas = {1: list(bot_main.HEADERS)}
+    for n, (fecha, cuadrilla) in enumerate([(ayer, "T1"), (ayer, "T2"), (hoy, "T3")], start=2):
+        filas[n] = ["Octubre", fecha, cuadrilla, "Ordenamiento", "Sí", "08:00", "", "", ""]
+    google.hojas[ssid].append({"sheetId": 7, "title": bot_main.titulo_hoja(), "filas": filas})
+    google.anclas.update({(ssid, "a"): (7, 2), (ssid, "b"): (7, 3), (ssid, "c"): (7, 4)})
+    google.limpiar_contadores()
+
+    bot_main.compactar_spreadsheet(ssid, activas={"b"})
+    assert set(google.anclas) == {(ssid, "b"), (ssid, "c")}
+    assert google.por_metodo()["sheets.spreadsheets.batchUpdate"] == 1
+
+
+def test_analisis_nocturno(bot_main, google, ahora):
+    """Dos llamadas por spreadsheet (grupos y archivos anuales) y una sola escritura de hallazgos."""
+    carpeta = bot_main.carpeta_principal()
+    ayer = (ahora.replace(tzinfo=None) - bot_main.EPOCA_SHEETS).days - 1  # número de serie de Sheets
+
+    def hora(hhmm):
+        return (int(hhmm[:2]) * 60 + int(hhmm[3:])) / 1440
+
+    for n in range(5):
+        ssid = google.crear_archivo(f"Grupo {n}", bot_main.SHEET_MIME, carpeta)
+        filas = {1: list(bot_main.HEADERS)}
+        for i in range(50):
+            ingreso = "08:30" if i == 0 else f"07:5{n}"
+            filas[i + 2] = ["Octubre", ayer - i, f"T{n}", "Ordenamiento", "Sí",
+                            hora(ingreso), hora("12:00"), hora("13:00"), hora(f"17:0{n}")]
+        google.hojas[ssid].append({"sheetId": 7, "title": bot_main.titulo_hoja(), "filas": filas})
+    archivo = google.crear_archivo("Grupo 0 - Archivo 2025", bot_main.SHEET_MIME, carpeta)
+    google.hojas[archivo].append({"sheetId": 3, "title": "Registros Diciembre 2025", "filas": {
+        2: ["Diciembre", ayer - 310, "T0", "Ordenamiento", "No", "08:00", "12:00", "", "17:00"],
+    }})
+    google.limpiar_contadores()
+
+    assert bot_main.analizar_asistencia() == 6
+    # lectura: 1 files.list + (get de títulos + batchGet) por spreadsheet;
+    # hallazgos: files.list + create del spreadsheet, get de su pestaña y 1 batchUpdate
+    assert google.por_metodo() == {
+        "drive.files.list": 2, "drive.files.create": 1,
+        "sheets.spreadsheets.get": 6 + 1, "sheets.spreadsheets.values.batchGet": 6,
+        "sheets.spreadsheets.batchUpdate": 1,
+    }
+    ssid = next(i for i, a in google.archivos.items() if a["name"] == bot_main.HALLAZGOS_SPREADSHEET)
+    filas = google.pestana(ssid, bot_main.HALLAZGOS_PESTANA)["filas"]
+    assert filas[1] == bot_main.HALLAZGOS_HEADERS
+    assert sorted(f[3] for n, f in filas.items() if n > 1) == ["Break sin regreso"] + ["Ingreso tarde"] * 5
+
+
+def test_columnas_derivadas(bot_main, google, chat, grupo, monkeypatch):
+    """Escrituras RAW tipadas por evento y las derivadas (J:L) en un solo lote."""
+    ssid, titulo = grupo
+    monkeypatch.setattr(bot_main, "COLUMNAS_DERIVADAS", True)
+    monkeypatch.setattr(bot_main, "ENTRADA_JORNADA", "RAW")
+    monkeypatch.setattr(bot_main, "DERIVADAS_PENDIENTES", {})
+
+    async def flujo():
+        await hasta_jornada(chat)
+        await cerrar_jornada(chat)
+        await bot_main.volcar_derivadas()
+
+    correr(flujo())
+    fila = fila_de(google, ssid, titulo, 2)
+    nueve = 9 * 60 / 1440
+    assert fila[1] == (datetime(2026, 10, 19) - bot_main.EPOCA_SHEETS).days  # FECHA como número de serie
+    assert fila[5:9] == [nueve] * 4
+    assert fila[9:12] == [0, 0, "Ingreso tarde"]
+    assert fila_de(google, ssid, titulo, 1)[9:12] == bot_main.DERIVADAS_HEADERS
+    assert google.por_metodo()["sheets.spreadsheets.values.batchUpdateByDataFilter"] == 7
+    assert not bot_main.DERIVADAS_PENDIENTES
+    verificar(google, "columnas_derivadas")
+
+
+def test_derivadas_pendientes(bot_main, google, chat, grupo, monkeypatch):
+    """Las derivadas sin volcar pasan por el snapshot y siguen a su fila si la compactación la mueve."""
+    ssid, titulo = grupo
+    monkeypatch.setattr(bot_main, "COLUMNAS_DERIVADAS", True)
+    monkeypatch.setattr(bot_main, "DERIVADAS_PENDIENTES", {})
+    google.pestana(ssid, titulo)["filas"][2] = ["Octubre", "2026-10-18", "T9"]  # fragmento que se compactará
+    correr(hasta_jornada(chat))
+    clave, ref = next(iter(bot_main.DERIVADAS_PENDIENTES["principal"].items()))
+
+    bot_main.guardar_snapshot_sesiones()
+    bot_main.DERIVADAS_PENDIENTES.clear()
+    bot_main.cargar_snapshot_sesiones()
+    assert bot_main.DERIVADAS_PENDIENTES["principal"] == {clave: ref}
+
+    ref = bot_main.DERIVADAS_PENDIENTES["principal"][clave]
+    assert ref["row"] == 3
+    ref["ancla"] = None  # fila sin ancla: solo se ubica por número
+    bot_main.renumerar_derivadas({(ssid, titulo): ([2], {})}, {})
+    assert [(c, r["row"]) for c, r in bot_main.DERIVADAS_PENDIENTES["principal"].items()] == [(f"{ssid}:{titulo}:2", 2)]
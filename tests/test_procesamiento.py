@@ -0,0 +1,171 @@
+"""
+Cola de salida, carriles, réplicas y apagado: el orden y la concurrencia alrededor
+de los handlers, sin Google de por medio.
+"""
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+
+def correr(coro):
+    return asyncio.run(coro)
+
+
+def test_edicion_fusionada_durante_retry_after(bot_main):
+    """Las ediciones encoladas durante un RetryAfter se fusionan con la que espera reintento."""
+    from telegram.error import RetryAfter
+    enviados = []
+
+    def editar(texto, fallar=False):
+        async def enviar():
+            if fallar and not enviados:
+                enviados.append(None)
+                raise RetryAfter(0.05)
+            enviados.append(texto)
+            return texto
+        return enviar
+
+    async def flujo():
+        cola = bot_main.ColaSalida(100, 6000, 100)
+        cola.iniciar()
+        try:
+            primero = cola.encolar(1, editar("v1", fallar=True), clave=(1, 7))
+            await asyncio.sleep(0.01)  # ya falló y está de vuelta en la cola, bloqueado
+            resto = [cola.encolar(1, editar(v), clave=(1, 7)) for v in ("v2", "v3")]
+            return await asyncio.gather(primero, *resto)
+        finally:
+            await cola.detener()
+
+    assert correr(flujo()) == ["v3"] * 3
+    assert enviados == [None, "v3"]
+
+
+def test_kv_sqlite_entre_procesos(bot_main, tmp_path):
+    """Dos conexiones al mismo archivo (como dos procesos) comparten lease, sesiones y colas."""
+    ruta = str(tmp_path / "kv.sqlite3")
+    a, b = bot_main.AlmacenKVSQLite(ruta), bot_main.AlmacenKVSQLite(ruta)
+
+    assert a.set_si_no_existe("lider", "a", ttl=0.05)
+    assert not b.set_si_no_existe("lider", "b", ttl=0.05)
+    assert a.cas("lider", "a", "a", ttl=0.05) and not b.cas("lider", "b", None)
+    time.sleep(0.06)
+    assert b.get("lider") is None and b.set_si_no_existe("lider", "b")
+
+    b.set("sesion:1", "{}")
+    a.push("cola:b", "u1")
+    a.push("cola:b", "u2")
+    assert sorted(a.claves("sesion:") + a.claves("cola:")) == ["cola:b", "sesion:1"]
+    assert b.mover("cola:b", "procesando:b") == "u1"
+    b.quitar("procesando:b", "u1")
+    assert a.vaciar("cola:b") == ["u2"] and a.claves("cola:") == []
+
+    threading.Timer(0.1, a.push, ("cola:b", "u3")).start()
+    t0 = time.monotonic()
+    assert b.mover("cola:b", "procesando:b", espera=2) == "u3"
+    assert time.monotonic() - t0 < 1
+    assert b.mover("cola:b", "procesando:b", espera=0.1) is None
+
+
+def test_reenviados_en_paralelo(bot_main, monkeypatch):
+    """Los updates reenviados a la réplica se procesan a la vez, hasta UPDATES_EN_VUELO_MAX."""
+    monkeypatch.setattr(bot_main, "UPDATES_EN_VUELO_MAX", 2)
+    monkeypatch.setattr(bot_main, "REPLICA_ESPERA_COLA_SEG", 0.05)
+    replicas = bot_main.Replicas(bot_main.AlmacenKVLocal(), "r1")
+    for i in range(3):
+        replicas.kv.push("cola:r1", f'{{"chat_id": {i}, "update": {{"update_id": {i}}}}}')
+
+    async def flujo():
+        en_vuelo, maximo, soltar = set(), [], asyncio.Event()
+
+        async def process_update(update):
+            en_vuelo.add(update.update_id)
+            maximo.append(len(en_vuelo))
+            await soltar.wait()
+            en_vuelo.discard(update.update_id)
+
+        app = SimpleNamespace(bot=None, process_update=process_update, create_task=asyncio.create_task)
+        consumo = asyncio.create_task(replicas._consumir(app))
+        await asyncio.sleep(0.2)
+        assert max(maximo) == 2 and replicas.kv.claves("cola:") == ["cola:r1"]  # el tercero espera cupo
+        soltar.set()
+        await asyncio.sleep(0.2)
+        consumo.cancel()
+        await asyncio.gather(consumo, return_exceptions=True)
+        return maximo
+
+    assert len(correr(flujo())) == 3
+
+
+def test_apagado_espera_descarga_de_foto(bot_main, monkeypatch, tmp_path):
+    """Una foto que aún se descarga al apagar termina antes de que se cierre el cliente del bot."""
+    monkeypatch.setattr(bot_main, "FOTOS_DIR", str(tmp_path))
+    monkeypatch.setattr(bot_main, "guardar_snapshot_sesiones", lambda: None)
+    descargadas = []
+
+    class BotDescarga:
+        local_mode = False
+        cerrado = False
+
+        async def get_file(self, file_id):
+            await asyncio.sleep(0.05)
+            if self.cerrado:
+                raise RuntimeError("cliente HTTP cerrado")
+
+            async def download_to_drive(destino):
+                descargadas.append(destino)
+            return SimpleNamespace(download_to_drive=download_to_drive)
+
+    async def flujo():
+        bot = BotDescarga()
+        foto = SimpleNamespace(file_id="f1", file_unique_id="u1")
+        update = SimpleNamespace(
+            message=SimpleNamespace(photo=[foto]),
+            effective_chat=SimpleNamespace(id=-100, title="Cuadrilla Norte", type="supergroup"),
+        )
+        bot_main.archivar_foto(update, SimpleNamespace(bot=bot), {"jornada": "j1"}, "selfie_inicio")
+        app = SimpleNamespace(bot=bot)
+        # Mismo orden que Application.run_polling: post_stop, shutdown, post_shutdown
+        await bot_main.al_detener(app)
+        bot.cerrado = True
+        await bot_main.al_apagar(app)
+
+    correr(flujo())
+    assert len(descargadas) == 1 and descargadas[0].endswith("j1_selfie_inicio_u1.jpg")
+
+
+def test_chat_no_permitido_no_ocupa_carril(bot_main, monkeypatch):
+    """Un callback de un chat no permitido no se contesta ni toma cupo de carril ni lock de chat."""
+    from telegram import CallbackQuery, Chat, Message, Update, User
+    monkeypatch.setattr(bot_main, "ALLOWED_CHATS", {-100})
+    contestadas, procesados = [], []
+
+    async def contestar(query, text=None):
+        contestadas.append(query.id)
+    monkeypatch.setattr(bot_main, "contestar", contestar)
+
+    def callback(chat_id, n):
+        chat = Chat(chat_id, "supergroup")
+        mensaje = Message(n, bot_main.datetime.now(), chat)
+        query = CallbackQuery(f"cq{n}", User(7, "Ana", False), "i", message=mensaje, data="confirmar_nombre")
+        return Update(n, callback_query=query)
+
+    async def flujo():
+        planificador = bot_main.PlanificadorUpdates({bot_main.CARRIL_RAPIDO: 1, bot_main.CARRIL_LENTO: 1})
+        lento = planificador.carriles[bot_main.CARRIL_LENTO]
+        soltar = asyncio.Event()
+
+        async def ocupar():
+            procesados.append(-100)
+            await soltar.wait()
+
+        permitido = asyncio.create_task(planificador.procesar(callback(-100, 1), ocupar))
+        await asyncio.sleep(0.01)  # el permitido ocupa el único cupo lento
+        await asyncio.wait_for(planificador.procesar(callback(-999, 2), lambda: procesados.append(-999)), 1)
+        estado = (lento.en_espera, lento.en_curso, set(planificador._locks))
+        soltar.set()
+        await permitido
+        return estado
+
+    assert correr(flujo()) == (0, 1, {-100})
+    assert contestadas == ["cq1"] and procesados == [-100]